@@ -0,0 +1,411 @@
+'''
+Benchmarks for the hot paths of portfoliobuilder.
+
+The API benchmarks replay Finnhub, Polygon, and Alpaca responses from
+a local stub server running in its own process, so they time
+portfoliobuilder rather than the network. The responses are recorded
+from the live APIs with --record; without recorded fixtures,
+synthetic responses of the same shape are used. Rate limits and the
+response cache are turned off unless --rate-limits is given.
+
+Results are printed and written as JSON (see write_results()) so
+they can be compared between commits.
+
+Run with: python benchmarks.py [--sizes 10 100] [--output results.json]
+Record fixtures with: python benchmarks.py --record AAPL MSFT ...
+'''
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import multiprocessing
+import os
+import platform
+import random
+import tempfile
+import time
+import uuid
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+from portfoliobuilder import (api_utils, basket_utils, commands, financials_reader,
+    trade_stream, weighting)
+from portfoliobuilder.models import Base, Basket, Stock
+from synthetic_responses import synthetic_response
+
+
+UNIVERSE_SIZES = [10, 100, 500, 3000]
+
+FIXTURES_PATH = 'benchmark_fixtures.json'
+RESULTS_PATH = 'benchmark_results.json'
+
+# The kinds of per-symbol responses in a fixtures file
+FIXTURE_KINDS = ['metrics', 'financials', 'profile2', 'financials_as_reported']
+
+ValueQuality = weighting.ValueQuality
+
+
+def _time(func, *args, repeat=3):
+    ''' Return the fastest of repeat runs of func(*args), in seconds. '''
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def _random_measures(num_symbols, seed=0):
+    '''
+    Return a list of measures series like those from
+    ValueQuality._get_measures(), with about 10% of measures missing.
+    '''
+    rng = np.random.default_rng(seed)
+    measures = ValueQuality._empty_measures_series.index
+    measures_series_list = []
+    for i in range(num_symbols):
+        values = rng.normal(10, 20, len(measures))
+        values[rng.random(len(measures)) < 0.1] = np.nan
+        measures_series_list.append(pd.Series(values, index=measures, name=f'S{i}'))
+    return measures_series_list
+
+
+def _symbols(num_symbols):
+    return [f'S{i}' for i in range(num_symbols)]
+
+
+################# Fixtures #################
+
+def record_fixtures(symbols, path=FIXTURES_PATH):
+    '''
+    Call the live APIs for each symbol and write the responses to
+    path. This is subject to the real rate limits, so it is slow.
+    '''
+    fixtures = {kind: {} for kind in FIXTURE_KINDS}
+    api_functions = {'metrics': api_utils.get_metrics,
+                    'financials': api_utils.get_financials,
+                    'profile2': api_utils.get_profile2,
+                    'financials_as_reported': api_utils.get_financials_as_reported}
+    for i, symbol in enumerate(symbols, 1):
+        print(f'Recording {symbol} ({i}/{len(symbols)})...')
+        for kind, api_function in api_functions.items():
+            response = api_function(symbol)
+            if response:
+                fixtures[kind][symbol] = response
+    with open(path, 'w') as f:
+        json.dump(fixtures, f)
+
+
+class Fixtures():
+    '''
+    Serves a response of each kind for any symbol. Symbols that were
+    not recorded are given one of the recorded responses, so a small
+    recording can stand in for a large universe.
+    '''
+    def __init__(self, path=None):
+        self.recorded = None
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self.recorded = json.load(f)
+            self._templates = {kind: list(self.recorded[kind].values())
+                                for kind in FIXTURE_KINDS}
+        self._bodies = {}
+
+    @property
+    def source(self):
+        return 'recorded' if self.recorded else 'synthetic'
+
+    def response(self, kind, symbol):
+        if self.recorded is None:
+            return synthetic_response(kind, symbol)
+        if symbol in self.recorded[kind]:
+            return self.recorded[kind][symbol]
+        templates = self._templates[kind]
+        return templates[zlib.crc32(symbol.encode()) % len(templates)]
+
+    def body(self, kind, symbol):
+        ''' Return the response as JSON bytes, serializing it only once. '''
+        if (kind, symbol) not in self._bodies:
+            self._bodies[(kind, symbol)] = json.dumps(self.response(kind, symbol)).encode()
+        return self._bodies[(kind, symbol)]
+
+
+################# Stub server #################
+
+class StubHandler(BaseHTTPRequestHandler):
+    '''
+    Answers the API calls portfoliobuilder makes. The first part of
+    the path names the provider (e.g., /finnhub/stock/metric).
+    '''
+    protocol_version = 'HTTP/1.1' # keep connections alive like the real APIs
+    disable_nagle_algorithm = True
+
+    def _send(self, body, status=200):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _route(self):
+        url = urlparse(self.path)
+        provider, _, path = url.path.lstrip('/').partition('/')
+        symbol = parse_qs(url.query).get('symbol', [''])[0]
+        fixtures = self.server.fixtures
+        universe = self.server.universe
+
+        if provider == 'finnhub':
+            kinds = {'stock/metric': 'metrics', 'stock/profile2': 'profile2',
+                    'stock/financials-reported': 'financials_as_reported'}
+            if path in kinds:
+                return fixtures.body(kinds[path], symbol)
+        elif provider == 'polygon' and path.startswith('financials/'):
+            return fixtures.body('financials', path.split('/')[-1])
+        elif provider == 'polygon_aggs' and path.startswith('grouped/'):
+            return self.server.grouped_daily
+        elif provider == 'alpaca':
+            if path == 'account':
+                return {'cash': '1000000000', 'equity': '1000000000'}
+            if path == 'positions':
+                return self.server.positions
+            if path == 'assets':
+                return [{'symbol': symbol, 'tradable': True} for symbol in universe]
+        return None
+
+    def do_GET(self):
+        body = self._route()
+        if body is None:
+            self._send({'message': 'not found'}, status=404)
+        else:
+            self._send(body)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self._send({'id': str(uuid.uuid4()), 'status': 'accepted'})
+
+    def do_DELETE(self):
+        self.do_POST()
+
+    def log_message(self, *args):
+        pass
+
+
+def _serve(fixtures_path, num_symbols, ports):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    server.daemon_threads = True
+    server.fixtures = Fixtures(fixtures_path)
+    server.universe = _symbols(num_symbols)
+    rand = random.Random(0)
+    server.grouped_daily = json.dumps({'status': 'OK', 'results':
+        [{'T': symbol, 'c': rand.uniform(5, 500)} for symbol in server.universe]}).encode()
+    # Hold every stock at a value around its equal weight of a small
+    # basket, so rebalancing trades most of them
+    server.positions = json.dumps([{'symbol': symbol, 'qty': '10',
+        'market_value': str(rand.uniform(1e3, 1e6))} for symbol in server.universe]).encode()
+    ports.put(server.server_port)
+    server.serve_forever()
+
+
+@contextlib.contextmanager
+def stub_apis(fixtures_path=FIXTURES_PATH, num_symbols=max(UNIVERSE_SIZES),
+                rate_limits=False):
+    '''
+    Start the stub server in another process and point api_utils at
+    it. Unless rate_limits is True, the rate limiters are opened up.
+    The response cache is turned off and financials_reader uses an
+    empty, temporary store. Commands don't connect to the trade
+    updates stream; their fills are left for ledger.sync_fills().
+    '''
+    ports = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_serve, daemon=True,
+                                        args=(fixtures_path, num_symbols, ports))
+    process.start()
+    url = f'http://127.0.0.1:{ports.get(timeout=30)}/'
+
+    endpoints = (api_utils.alpaca_endpoint, api_utils.finnhub_endpoint,
+                    api_utils.polygon_endpoint, api_utils.polygon_aggs_endpoint)
+    saved_rate_limits = dict(api_utils.RATE_LIMITS)
+    store, tracking_fills = financials_reader.store, trade_stream.tracking_fills
+    trade_stream.tracking_fills = lambda session: contextlib.nullcontext()
+    api_utils.alpaca_endpoint = url + 'alpaca/'
+    api_utils.finnhub_endpoint = url + 'finnhub/'
+    api_utils.polygon_endpoint = url + 'polygon/'
+    api_utils.polygon_aggs_endpoint = url + 'polygon_aggs/'
+    api_utils.response_cache.enabled = False
+    if not rate_limits:
+        for provider in saved_rate_limits:
+            api_utils.set_rate_limit(provider, 1e9, 1e9)
+    try:
+        yield url
+    finally:
+        (api_utils.alpaca_endpoint, api_utils.finnhub_endpoint,
+            api_utils.polygon_endpoint, api_utils.polygon_aggs_endpoint) = endpoints
+        api_utils.response_cache.enabled = True
+        for provider, (rate, burst) in saved_rate_limits.items():
+            api_utils.set_rate_limit(provider, rate, burst)
+        financials_reader.store, trade_stream.tracking_fills = store, tracking_fills
+        process.terminate()
+        process.join()
+
+
+def _fresh_financials_store():
+    financials_reader.store = financials_reader.FinancialsStore(
+                                os.path.join(tempfile.mkdtemp(), 'financials.db'))
+
+
+################# weighting benchmarks #################
+
+def bench_value_quality_weighting_data(num_symbols):
+    measures_series_list = _random_measures(num_symbols)
+    return _time(ValueQuality._get_weighting_data, measures_series_list)
+
+
+def bench_get_weights(weighting_method, num_symbols):
+    symbols = _symbols(num_symbols)
+    with contextlib.redirect_stdout(io.StringIO()):
+        return _time(basket_utils.get_weights, weighting_method, symbols, repeat=1)
+
+
+################# ordering benchmarks #################
+
+def _make_basket(num_symbols, session=None):
+    basket = Basket(active=True, weighting_method='equal', weight=10,
+                    stocks=[Stock(symbol=symbol) for symbol in _symbols(num_symbols)])
+    if session is not None:
+        session.add(basket)
+        session.commit()
+    return basket
+
+
+def bench_buy_basket(num_symbols):
+    basket = _make_basket(num_symbols)
+    with contextlib.redirect_stdout(io.StringIO()):
+        return _time(basket_utils.buy_basket, basket, repeat=1)
+
+
+def bench_rebalance(num_symbols):
+    ''' Time the rebalance command, including its database lookup. '''
+    engine = create_engine('sqlite://', future=True)
+    Base.metadata.create_all(bind=engine)
+    session, commands_session = Session(engine), getattr(commands, 'session', None)
+    commands.session = session
+    basket = _make_basket(num_symbols, session)
+    commands.user_input = f'rebalance {basket.id}'
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            return _time(commands.Rebalance.execute, repeat=1)
+    finally:
+        commands.session = commands_session
+        session.close()
+
+
+################# financials_reader benchmarks #################
+
+def _get_revenues(symbols):
+    _fresh_financials_store()
+    for symbol in symbols:
+        financials_reader.get_revenues(symbol)
+
+
+def _get_revenues_bulk(symbols):
+    _fresh_financials_store()
+    financials_reader.get_revenues_bulk(symbols)
+
+
+def bench_get_revenues(num_symbols):
+    ''' Time get_revenues() for each symbol, starting from an empty store. '''
+    with contextlib.redirect_stdout(io.StringIO()):
+        return _time(_get_revenues, _symbols(num_symbols), repeat=1)
+
+
+def bench_get_revenues_bulk(num_symbols):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return _time(_get_revenues_bulk, _symbols(num_symbols), repeat=1)
+
+
+################# Running #################
+
+API_BENCHMARKS = {
+    'get_weights[equal]': lambda n: bench_get_weights('equal', n),
+    'get_weights[market_cap]': lambda n: bench_get_weights('market_cap', n),
+    'get_weights[value]': lambda n: bench_get_weights('value', n),
+    'get_weights[value_quality]': lambda n: bench_get_weights('value_quality', n),
+    'buy_basket': bench_buy_basket,
+    'rebalance': bench_rebalance,
+    'get_revenues': bench_get_revenues,
+    'get_revenues_bulk': bench_get_revenues_bulk
+}
+
+
+def run_benchmarks(sizes=UNIVERSE_SIZES, fixtures_path=FIXTURES_PATH, rate_limits=False,
+                    names=None):
+    '''
+    Run the benchmarks whose names are in names (all of them by
+    default) at each universe size.
+
+    Return a list of dicts with the keys benchmark, symbols, and seconds.
+    '''
+    results = []
+    def record(name, num_symbols, seconds):
+        results.append({'benchmark': name, 'symbols': num_symbols, 'seconds': seconds})
+        print(f'{name:<30} {num_symbols:>6} symbols: {seconds * 1000:11.2f} ms')
+
+    if names is None or 'value_quality_weighting_data' in names:
+        for num_symbols in sizes:
+            record('value_quality_weighting_data', num_symbols,
+                    bench_value_quality_weighting_data(num_symbols))
+
+    api_benchmarks = {name: bench for name, bench in API_BENCHMARKS.items()
+                        if names is None or name in names}
+    if api_benchmarks:
+        with stub_apis(fixtures_path, max(sizes), rate_limits):
+            for name, bench in api_benchmarks.items():
+                for num_symbols in sizes:
+                    record(name, num_symbols, bench(num_symbols))
+    return results
+
+
+def write_results(results, path=RESULTS_PATH, **details):
+    ''' Write results, along with details of the run, to path as JSON. '''
+    report = {'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+                'python': platform.python_version(), 'machine': platform.machine(),
+                **details, 'results': results}
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark portfoliobuilder.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=UNIVERSE_SIZES)
+    parser.add_argument('--benchmarks', nargs='+',
+                        choices=['value_quality_weighting_data', *API_BENCHMARKS])
+    parser.add_argument('--fixtures', default=FIXTURES_PATH)
+    parser.add_argument('--output', default=RESULTS_PATH)
+    parser.add_argument('--rate-limits', action='store_true',
+                        help='keep the real rate limits')
+    parser.add_argument('--record', nargs='+', metavar='SYMBOL',
+                        help='record fixtures for these symbols from the live APIs')
+    args = parser.parse_args()
+
+    if args.record:
+        record_fixtures(args.record, args.fixtures)
+        return
+    fixtures = Fixtures(args.fixtures)
+    print(f'Using {fixtures.source} fixtures.')
+    results = run_benchmarks(args.sizes, args.fixtures, args.rate_limits, args.benchmarks)
+    write_results(results, args.output, sizes=args.sizes, fixtures=fixtures.source,
+                    rate_limits=args.rate_limits)
+    print(f'Results written to {args.output}.')
+
+
+if __name__ == '__main__':
+    main()
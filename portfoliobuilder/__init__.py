@@ -4,6 +4,7 @@ import os
 ############### Alpaca constants ###############
 
 alpaca_endpoint = 'https://paper-api.alpaca.markets/v2/'
+alpaca_stream_endpoint = 'wss://paper-api.alpaca.markets/stream'
 
 try:
     alpaca_paper_key = os.environ['PORTFOLIOBUILDER_ALPACA_PAPER_KEY']
@@ -30,6 +31,7 @@ except KeyError:
 ############### Polygon constants ###############
 
 polygon_endpoint = 'https://api.polygon.io/v2/reference/'
+polygon_aggs_endpoint = 'https://api.polygon.io/v2/aggs/'
 
 try:
     polygon_key = os.environ['PORTFOLIOBUILDER_POLYGON_KEY']
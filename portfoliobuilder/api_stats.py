@@ -0,0 +1,188 @@
+'''
+Per-endpoint instrumentation of the API calls made by api_utils.
+
+For each endpoint, the number of calls, retries, responses served
+from the cache, time spent waiting on the rate limiter, a histogram
+of HTTP latencies, the status codes, the bytes received, and the time
+spent decoding JSON are recorded.
+
+If the PORTFOLIOBUILDER_STATS_FILE environment variable is set, the
+stats are written to that file at exit: in the Prometheus text format
+if the file ends with .prom, as JSON otherwise.
+'''
+import atexit
+import json
+import os
+import threading
+
+
+# Upper bounds, in seconds, of the latency histogram buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float('inf'))
+
+STATS_FILE_VARIABLE = 'PORTFOLIOBUILDER_STATS_FILE'
+
+
+class EndpointStats():
+    ''' The stats of one endpoint. Updated under ApiStats' lock. '''
+    def __init__(self, provider, endpoint):
+        self.provider = provider
+        self.endpoint = endpoint
+        self.calls = 0
+        self.retries = 0
+        self.cache_hits = 0
+        self.throttle_seconds = 0.0
+        self.latency_seconds = 0.0
+        self.latency_counts = [0] * len(LATENCY_BUCKETS)
+        self.decode_seconds = 0.0
+        self.bytes_received = 0
+        self.status_codes = {} # maps status codes (or 'error') to counts
+
+    def latency_quantile(self, q):
+        '''
+        Return the upper bound of the histogram bucket that holds
+        the q-quantile of the latencies, or None if there are none.
+        '''
+        total = sum(self.latency_counts)
+        if not total:
+            return None
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS, self.latency_counts):
+            seen += count
+            if seen >= q * total:
+                return bound
+
+    def to_dict(self):
+        return {'provider': self.provider, 'endpoint': self.endpoint,
+                'calls': self.calls, 'retries': self.retries,
+                'cache_hits': self.cache_hits,
+                'throttle_seconds': self.throttle_seconds,
+                'latency_seconds': self.latency_seconds,
+                'latency_histogram': {str(bound): count for bound, count
+                                        in zip(LATENCY_BUCKETS, self.latency_counts)},
+                'decode_seconds': self.decode_seconds,
+                'bytes_received': self.bytes_received,
+                'status_codes': {str(status): count
+                                    for status, count in self.status_codes.items()}}
+
+
+class ApiStats():
+    '''
+    The stats of every endpoint, keyed by (provider, endpoint). The
+    record methods are safe to call from multiple threads.
+    '''
+    def __init__(self):
+        self._endpoints = {}
+        self._lock = threading.Lock()
+
+    def _get(self, provider, endpoint):
+        key = (provider, endpoint)
+        if key not in self._endpoints:
+            self._endpoints[key] = EndpointStats(provider, endpoint)
+        return self._endpoints[key]
+
+    def record_cache_hit(self, provider, endpoint):
+        with self._lock:
+            self._get(provider, endpoint).cache_hits += 1
+
+    def record_retry(self, provider, endpoint):
+        with self._lock:
+            self._get(provider, endpoint).retries += 1
+
+    def record_throttle(self, provider, endpoint, seconds):
+        with self._lock:
+            self._get(provider, endpoint).throttle_seconds += seconds
+
+    def record_response(self, provider, endpoint, latency, status, num_bytes=0):
+        '''
+        Record a call that took latency seconds. status is the HTTP
+        status code, or 'error' if no response was received.
+        '''
+        with self._lock:
+            stats = self._get(provider, endpoint)
+            stats.calls += 1
+            stats.status_codes[status] = stats.status_codes.get(status, 0) + 1
+            stats.bytes_received += num_bytes
+            stats.latency_seconds += latency
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if latency <= bound:
+                    stats.latency_counts[i] += 1
+                    break
+
+    def record_decode(self, provider, endpoint, seconds):
+        with self._lock:
+            self._get(provider, endpoint).decode_seconds += seconds
+
+    def endpoints(self):
+        ''' Return the EndpointStats of every endpoint, sorted by provider and endpoint. '''
+        with self._lock:
+            return [self._endpoints[key] for key in sorted(self._endpoints)]
+
+    def reset(self):
+        with self._lock:
+            self._endpoints = {}
+
+    def to_json(self):
+        return json.dumps([stats.to_dict() for stats in self.endpoints()], indent=2)
+
+    def to_prometheus(self):
+        ''' Return the stats in the Prometheus text exposition format. '''
+        def labels(stats, **extra):
+            pairs = {'provider': stats.provider, 'endpoint': stats.endpoint, **extra}
+            return '{' + ','.join(f'{name}="{value}"' for name, value in pairs.items()) + '}'
+
+        endpoints = self.endpoints()
+        lines = []
+        counters = [
+            ('calls_total', 'API calls made', 'calls'),
+            ('retries_total', 'Failed API calls that were retried', 'retries'),
+            ('cache_hits_total', 'Responses served from the response cache', 'cache_hits'),
+            ('throttle_seconds_total', 'Seconds spent waiting on the rate limiter',
+                'throttle_seconds'),
+            ('decode_seconds_total', 'Seconds spent decoding JSON', 'decode_seconds'),
+            ('received_bytes_total', 'Bytes received', 'bytes_received')
+        ]
+        for name, description, attribute in counters:
+            lines.append(f'# HELP portfoliobuilder_api_{name} {description}')
+            lines.append(f'# TYPE portfoliobuilder_api_{name} counter')
+            for stats in endpoints:
+                lines.append(f'portfoliobuilder_api_{name}{labels(stats)} '
+                                f'{getattr(stats, attribute)}')
+
+        lines.append('# HELP portfoliobuilder_api_responses_total Responses by status code')
+        lines.append('# TYPE portfoliobuilder_api_responses_total counter')
+        for stats in endpoints:
+            for status, count in stats.status_codes.items():
+                lines.append(f'portfoliobuilder_api_responses_total'
+                                f'{labels(stats, status=status)} {count}')
+
+        lines.append('# HELP portfoliobuilder_api_latency_seconds HTTP latency')
+        lines.append('# TYPE portfoliobuilder_api_latency_seconds histogram')
+        for stats in endpoints:
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS, stats.latency_counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else bound
+                lines.append(f'portfoliobuilder_api_latency_seconds_bucket'
+                                f'{labels(stats, le=le)} {cumulative}')
+            lines.append(f'portfoliobuilder_api_latency_seconds_sum{labels(stats)} '
+                            f'{stats.latency_seconds}')
+            lines.append(f'portfoliobuilder_api_latency_seconds_count{labels(stats)} '
+                            f'{cumulative}')
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path):
+        ''' Write the stats to path; see the module docstring for the format. '''
+        text = self.to_prometheus() if path.endswith('.prom') else self.to_json()
+        with open(path, 'w') as f:
+            f.write(text)
+
+
+api_stats = ApiStats()
+
+
+def _dump_at_exit():
+    path = os.environ.get(STATS_FILE_VARIABLE)
+    if path and api_stats.endpoints():
+        api_stats.dump(path)
+
+atexit.register(_dump_at_exit)
@@ -1,61 +1,333 @@
-import requests
+import datetime
+import os
+import random
+import threading
 import time
+from email.utils import parsedate_to_datetime
+
+import ijson
+import requests
+from requests.adapters import HTTPAdapter
 
 from portfoliobuilder import (alpaca_endpoint, alpaca_headers, 
-    finnhub_endpoint, finnhub_key, polygon_endpoint, polygon_key)
+    finnhub_endpoint, finnhub_key, polygon_endpoint, polygon_aggs_endpoint, 
+    polygon_key)
+from portfoliobuilder.api_stats import api_stats
+from portfoliobuilder.rate_limiter import TokenBucket
+from portfoliobuilder.response_cache import DAY, ResponseCache
+
+
+# Number of seconds the response of each endpoint stays fresh.
+# Endpoints not listed here are never cached.
+_CACHE_TTLS = {
+    'get_profile2': 30 * DAY, # used for shares outstanding
+    'get_metrics': DAY,
+    'get_financials_as_reported': 90 * DAY,
+    'get_index_constituents': DAY,
+    'get_earnings_calendar': DAY,
+    'get_financials': 90 * DAY,
+    'get_grouped_daily': DAY,
+    'get_assets': DAY
+}
+
+# Endpoints whose responses are only cached if they have results. A
+# day's grouped bars are empty until Polygon has them.
+_CACHE_IF_RESULTS = {'get_grouped_daily'}
+
+response_cache = ResponseCache(
+    os.path.dirname(os.path.abspath(__file__)) + '/api_cache.db', _CACHE_TTLS)
+
+# The (rate, burst) of each provider's token bucket. The rate is in
+# calls per second. Each pair keeps burst + 60 * rate within the
+# provider's per-minute limit.
+RATE_LIMITS = {
+    'alpaca': (3, 20),       # 200 calls per minute
+    'finnhub': (55/60, 5),   # 60 calls per minute
+    'polygon': (5/60, 1)     # 5 calls per minute
+}
+
+rate_limiters = {provider: TokenBucket(*RATE_LIMITS[provider]) 
+                    for provider in RATE_LIMITS}
+
+
+# Maximum number of connections kept alive to each provider
+HTTP_POOL_SIZE = 10
+
+# Seconds to wait for a connection, and then for each read of the
+# response, before a call times out
+TIMEOUT = (5, 30)
+
+# Calls that fail with one of RETRY_STATUSES, a ConnectionError, or a
+# timeout are retried up to MAX_RETRIES times, waiting about
+# RETRY_BACKOFF seconds before the first retry and twice as long before
+# each one after (or as long as the server's Retry-After asks). A call
+# is given up on rather than wait, for a retry or for the rate limiter,
+# past MAX_RETRY_SECONDS after it was first sent.
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+MAX_RETRIES = 4
+RETRY_BACKOFF = 0.5
+MAX_RETRY_SECONDS = 60
+
+# Calls that may have taken effect even if they failed. These are
+# only retried after a 429, which means the call was rejected.
+_NON_IDEMPOTENT = {'place_order', 'close_position'}
+
+# Calls whose response body is read by the caller, after request()
+# returns
+_STREAMED = {'_get_financials_as_reported_stream'}
+
+# The HTTP status of each thread's last failed call; see
+# last_failure_status()
+_last_failure = threading.local()
+
+
+def _make_session(headers=None, params=None):
+    '''
+    Return a requests.Session that keeps up to HTTP_POOL_SIZE
+    connections alive and sends headers and params with every request.
+    '''
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_SIZE)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers.update({'Connection': 'keep-alive'})
+    session.headers.update(headers or {})
+    session.params.update(params or {})
+    return session
+
+sessions = {
+    'alpaca': _make_session(headers=alpaca_headers),
+    'finnhub': _make_session(headers={'X-Finnhub-Token': finnhub_key}),
+    'polygon': _make_session(params={'apiKey': polygon_key})
+}
+
+
+def set_rate_limit(provider, rate, burst):
+    '''
+    Change the rate (calls per second) and burst capacity of
+    provider's rate limiter.
+    '''
+    RATE_LIMITS[provider] = (rate, burst)
+    rate_limiters[provider].configure(rate, burst)
 
 
-def call_api(func, *args, **kwargs):
+def throttle(provider, endpoint, timeout=None):
     '''
-    A method to handle errors and exceptions that might
-    arise from an API call.
+    Wait for provider's rate limiter and record the wait in api_stats.
+    Return False, without waiting, if the wait would be longer than
+    timeout seconds.
+    '''
+    wait = rate_limiters[provider].acquire(timeout)
+    if wait is None:
+        return False
+    api_stats.record_throttle(provider, endpoint, wait)
+    return True
+
+
+def send(provider, func, *args, **kwargs):
     '''
+    Return the HTTP response of func(*args, **kwargs), recording
+    its latency, status code, and size in api_stats. A
+    ConnectionError or Timeout is recorded and re-raised.
+    '''
+    start = time.perf_counter()
     try:
         response = func(*args, **kwargs)
-    except requests.exceptions.ConnectionError:
-        print('API call failed due to ConnectionError.')
+    except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+        api_stats.record_response(provider, func.__name__, 
+                                    time.perf_counter() - start, 'error')
+        raise
+    # A streamed body has not been read, so only its declared length is known
+    if func.__name__ in _STREAMED:
+        num_bytes = int(response.headers.get('Content-Length', 0))
+    else:
+        num_bytes = len(response.content)
+    api_stats.record_response(provider, func.__name__, time.perf_counter() - start,
+                                response.status_code, num_bytes)
+    return response
+
+
+def decode(provider, endpoint, response):
+    ''' Return response's JSON, recording the time spent decoding it. '''
+    start = time.perf_counter()
+    body = response.json()
+    api_stats.record_decode(provider, endpoint, time.perf_counter() - start)
+    return body
+
+
+def retry_delay(attempt, retry_after=None):
+    '''
+    Return the number of seconds to wait before retry number attempt
+    (starting at 0). The exponential backoff is jittered so that
+    concurrent callers don't retry at once. retry_after is the value
+    of a Retry-After header (seconds or an HTTP date), if any.
+    '''
+    if retry_after:
+        try:
+            seconds = float(retry_after)
+        except ValueError:
+            try:
+                retry_at = parsedate_to_datetime(retry_after)
+                seconds = (retry_at - datetime.datetime.now(datetime.timezone.utc)) \
+                            .total_seconds()
+            except (TypeError, ValueError):
+                seconds = None
+        if seconds is not None:
+            return max(seconds, 0) + random.uniform(0, RETRY_BACKOFF)
+    return random.uniform(0, min(RETRY_BACKOFF * 2 ** attempt, MAX_RETRY_SECONDS))
+
+
+def should_retry(endpoint, status):
+    '''
+    Return True if a failed call to endpoint should be retried.
+    status is the HTTP status code, or None if the connection failed
+    or timed out.
+    '''
+    if status == 429:
+        return True
+    return (status is None or status in RETRY_STATUSES) and endpoint not in _NON_IDEMPOTENT
+
+
+def should_cache(endpoint, response):
+    '''
+    Return True if a response from endpoint should be stored in
+    response_cache (see _CACHE_IF_RESULTS).
+    '''
+    return endpoint not in _CACHE_IF_RESULTS or bool(response and response.get('results'))
+
+
+def request(provider, func, *args, **kwargs):
+    '''
+    Make the rate-limited HTTP request of func(*args, **kwargs),
+    retrying it as described above RETRY_STATUSES. A 429 also slows
+    down provider's rate limiter.
+
+    Return the response if it succeeded, None otherwise.
+    '''
+    endpoint = func.__name__
+    _last_failure.status = None
+    throttle(provider, endpoint)
+    deadline = time.monotonic() + MAX_RETRY_SECONDS
+    for attempt in range(MAX_RETRIES + 1):
+        if attempt and not throttle(provider, endpoint, deadline - time.monotonic()):
+            break
+        status = retry_after = None
+        try:
+            response = send(provider, func, *args, **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            response = None
+        else:
+            if response.status_code in range(200, 226):
+                rate_limiters[provider].recover()
+                return response
+            response.close()
+            status = response.status_code
+            retry_after = response.headers.get('Retry-After')
+
+        if not should_retry(endpoint, status) or attempt == MAX_RETRIES:
+            break
+        delay = retry_delay(attempt, retry_after)
+        if time.monotonic() + delay > deadline:
+            break
+        if status == 429:
+            rate_limiters[provider].slow_down(delay)
+            delay = 0 # throttle() waits out the pause
+        api_stats.record_retry(provider, endpoint)
+        time.sleep(delay)
+
+    _last_failure.status = status
+    if response is None:
+        print('API call failed due to a ConnectionError or Timeout.')
         print('Pleasure make sure you are connected to the internet.')
-        return None
-    
-    if response.status_code in range(200, 226):
-        return response.json()
     return None
 
 
-################# Alpaca utility functions #################
+def last_failure_status():
+    '''
+    Return the HTTP status of the calling thread's last call if it
+    failed, or None if it failed without a response (a ConnectionError
+    or timeout) or succeeded.
+    '''
+    return getattr(_last_failure, 'status', None)
+
 
-_last_alpaca_call = 0
-# _alpaca_limit = 10/3 # number of calls per second
+def call_api(provider, func, *args, **kwargs):
+    '''
+    A method to handle errors and exceptions that might
+    arise from an API call. Return the JSON of the response,
+    or None if the call failed.
+    '''
+    response = request(provider, func, *args, **kwargs)
+    if response is None:
+        return None
+    return decode(provider, func.__name__, response)
+
+
+def cached_call(provider, func, args, kwargs, call):
+    '''
+    Return the response of func(*args, **kwargs) from response_cache
+    if a fresh entry exists. Otherwise, return call() and store its
+    result in the cache, unless it is empty (see _CACHE_IF_RESULTS).
+    '''
+    endpoint = func.__name__
+    if not response_cache.caches(endpoint):
+        return call()
+    key = response_cache.make_key(endpoint, args, kwargs)
+    response = response_cache.get(endpoint, key)
+    if response is None:
+        response = call()
+        if should_cache(endpoint, response):
+            response_cache.put(endpoint, key, response)
+    else:
+        api_stats.record_cache_hit(provider, endpoint)
+    return response
+
+
+def invalidate_cache(endpoint, calls):
+    '''
+    Delete the cached responses of endpoint (the name of an api_utils
+    function, e.g., 'get_metrics') for each tuple of positional
+    arguments in calls, so that the next such calls go to the API.
+    '''
+    response_cache.delete([response_cache.make_key(endpoint, args, {}) for args in calls])
+
+
+################# Alpaca utility functions #################
 
 def alpaca_call(func):
     '''
-    Method to ensure the API call rate limit isn't reached and
-    to return None in the event that the call fails.
+    Method to ensure the API call rate limit isn't reached, to
+    retry failed calls (see request()), and to return None in the
+    event that the call still fails. Responses from endpoints
+    listed in _CACHE_TTLS are cached.
     '''
     def wrapper(*args, **kwargs):
-        global _last_alpaca_call
-        next_available_call = _last_alpaca_call + 0.3
-        now = time.time()
-        if next_available_call >= now:
-            time.sleep(next_available_call - now)
-        _last_alpaca_call = time.time()
-
-        return call_api(func, *args, **kwargs)
+        return cached_call('alpaca', func, args, kwargs, 
+                            lambda: call_api('alpaca', func, *args, **kwargs))
 
     return wrapper
 
 @alpaca_call
 def get_account():
     url = alpaca_endpoint + 'account'
-    return requests.get(url=url, headers=alpaca_headers)
+    return sessions['alpaca'].get(url=url, timeout=TIMEOUT)
 
 @alpaca_call
 def get_asset(symbol):
     url = alpaca_endpoint + f'assets/{symbol}'
-    return requests.get(url=url, headers=alpaca_headers)
+    return sessions['alpaca'].get(url=url, timeout=TIMEOUT)
+
+@alpaca_call
+def get_assets():
+    '''
+    Return a list of all active US equity assets in a single call.
+    '''
+    url = alpaca_endpoint + 'assets'
+    params = {'status': 'active', 'asset_class': 'us_equity'}
+    return sessions['alpaca'].get(url=url, params=params, timeout=TIMEOUT)
 
 @alpaca_call
-def place_order(symbol, notional, side):
+def place_order(symbol, notional, side, client_order_id=None, qty=None):
     '''
     Place a market day order to buy or sell notional amount of symbol. 
 
@@ -65,68 +337,89 @@ def place_order(symbol, notional, side):
         How much, in dollars, of the stock to buy
     side : str
         'buy' or 'sell'
+    client_order_id : str
+        A unique id for the order. Alpaca rejects a second order
+        with the same id, so retrying with it cannot place the
+        order twice.
+    qty : float
+        If given, the number of (possibly fractional) shares to buy
+        or sell instead of notional
 
     Return the HTTP response if the order was placed successfully, 
     None otherwise.
     '''
     url = alpaca_endpoint + 'orders'
-    payload = {'symbol': symbol, 'notional': str(notional), 'side': side,
-                'type': 'market', 'time_in_force': 'day'}
-    return requests.post(url=url, json=payload, headers=alpaca_headers)
+    payload = {'symbol': symbol, 'side': side, 'type': 'market', 'time_in_force': 'day'}
+    if qty is None:
+        payload['notional'] = str(notional)
+    else:
+        payload['qty'] = str(qty)
+    if client_order_id:
+        payload['client_order_id'] = client_order_id
+    return sessions['alpaca'].post(url=url, json=payload, timeout=TIMEOUT)
+
+@alpaca_call
+def get_orders(status='closed', after=None, limit=500):
+    '''
+    Return a list of up to limit orders with the given status ('open',
+    'closed', or 'all'), oldest first. If after (an ISO timestamp) is
+    given, only orders submitted after it are returned.
+    '''
+    url = alpaca_endpoint + 'orders'
+    params = {'status': status, 'limit': limit, 'direction': 'asc'}
+    if after:
+        params['after'] = after
+    return sessions['alpaca'].get(url=url, params=params, timeout=TIMEOUT)
+
+@alpaca_call
+def get_order_by_client_order_id(client_order_id):
+    url = alpaca_endpoint + 'orders:by_client_order_id'
+    params = {'client_order_id': client_order_id}
+    return sessions['alpaca'].get(url=url, params=params, timeout=TIMEOUT)
 
 @alpaca_call
 def get_position(symbol):
     url = alpaca_endpoint + f'positions/{symbol}'
-    return requests.get(url=url, headers=alpaca_headers)
+    return sessions['alpaca'].get(url=url, timeout=TIMEOUT)
 
 @alpaca_call
 def get_positions():
     url = alpaca_endpoint + f'positions'
-    return requests.get(url=url, headers=alpaca_headers)
+    return sessions['alpaca'].get(url=url, timeout=TIMEOUT)
 
 @alpaca_call
 def close_position(symbol):
     url = alpaca_endpoint + f'positions/{symbol}'
     payload = {'percentage': 100}
-    return requests.delete(url=url, json=payload, headers=alpaca_headers)
+    return sessions['alpaca'].delete(url=url, json=payload, timeout=TIMEOUT)
 
 
 ################# Finnhub utility functions #################
 
-_last_finnhub_call = 0
-# _finnhub_limit = 1 # number of calls per second
-
 def finnhub_call(func):
     '''
-    Method to ensure the API call rate limit isn't reached.
+    Method to ensure the API call rate limit isn't reached, to
+    retry failed calls (see request()), and to serve fresh
+    responses from response_cache without a call.
     '''
     def wrapper(*args, **kwargs):
-        global _last_finnhub_call
-        next_available_call = _last_finnhub_call + 1
-        now = time.time()
-        if next_available_call >= now:
-            time.sleep(next_available_call - now)
-        _last_finnhub_call = time.time()
-
-        response = func(*args, **kwargs)
-        if response.status_code in range(200, 226):
-            return response.json()
-        return None
+        return cached_call('finnhub', func, args, kwargs, 
+                            lambda: call_api('finnhub', func, *args, **kwargs))
 
     return wrapper
 
 @finnhub_call
 def get_profile2(symbol):
     url = finnhub_endpoint + 'stock/profile2'
-    params = {'symbol': symbol, 'token': finnhub_key}
-    return requests.get(url=url, params=params)
+    params = {'symbol': symbol}
+    return sessions['finnhub'].get(url=url, params=params, timeout=TIMEOUT)
 
 @finnhub_call
 def get_metrics(symbol):
     ''' Return the JSON response from the stock/metrics Finnhub endpoint. '''
     url = finnhub_endpoint + 'stock/metric'
-    params = {'symbol': symbol, 'metric': 'all', 'token': finnhub_key}
-    return requests.get(url=url, params=params)
+    params = {'symbol': symbol, 'metric': 'all'}
+    return sessions['finnhub'].get(url=url, params=params, timeout=TIMEOUT)
 
 @finnhub_call
 def get_financials_as_reported(symbol):
@@ -135,8 +428,67 @@ def get_financials_as_reported(symbol):
     endpoint.
     '''
     url = finnhub_endpoint + 'stock/financials-reported'
-    params = {'symbol': symbol, 'token': finnhub_key}
-    return requests.get(url=url, params=params)
+    params = {'symbol': symbol}
+    return sessions['finnhub'].get(url=url, params=params, timeout=TIMEOUT)
+
+def iter_financials_as_reported(symbol, statements=('ic', 'bs', 'cf')):
+    '''
+    Stream the response from the Financials as Reported endpoint
+    and parse it one report at a time, so only one report is held
+    in memory. Streamed responses are not cached.
+
+    statements : tuple
+        The statements to keep from each report: 'ic' (income
+        statement), 'bs' (balance sheet), and/or 'cf' (cash flow)
+
+    Return an iterator of reports of the form
+        {'year': year, 'filedDate': filed_date, 'report': {statement: items}}
+    in the order of the response, or None if the call failed. The
+    filing date tells an amended report from the original.
+    '''
+    response = request('finnhub', _get_financials_as_reported_stream, symbol)
+    if response is None:
+        return None
+    return _iter_reports(response, statements)
+
+def get_financials_as_reported_body(symbol):
+    '''
+    Return the body of the response from the Financials as Reported
+    endpoint as undecoded JSON bytes, e.g., to parse in another
+    process, or None if the call failed. The body is not cached;
+    financials_reader keeps the parsed items instead.
+    '''
+    response = request('finnhub', _get_financials_as_reported_stream, symbol)
+    if response is None:
+        return None
+    with response:
+        return response.content
+
+def _get_financials_as_reported_stream(symbol):
+    # Only the headers are read before this returns
+    url = finnhub_endpoint + 'stock/financials-reported'
+    params = {'symbol': symbol}
+    return sessions['finnhub'].get(url=url, params=params, stream=True, 
+                                    timeout=TIMEOUT)
+
+def _iter_reports(response, statements):
+    with response:
+        response.raw.decode_content = True
+        for report in ijson.items(response.raw, 'data.item', use_float=True):
+            sections = report.get('report') or {}
+            yield {'year': report['year'], 'filedDate': report.get('filedDate'),
+                    'report': {statement: sections[statement] 
+                                for statement in statements if statement in sections}}
+
+@finnhub_call
+def get_earnings_calendar(from_date, to_date):
+    '''
+    Return the earnings releases of all US stocks from from_date
+    to to_date ('YYYY-MM-DD' strings) in a single response.
+    '''
+    url = finnhub_endpoint + 'calendar/earnings'
+    params = {'from': from_date, 'to': to_date}
+    return sessions['finnhub'].get(url=url, params=params, timeout=TIMEOUT)
 
 @finnhub_call
 def get_index_constituents(index_symbol):
@@ -144,28 +496,21 @@ def get_index_constituents(index_symbol):
     Return a list of the stock symbols, None if unsuccessful.
     '''
     url = finnhub_endpoint + 'index/constituents'
-    params = {'symbol': index_symbol, 'token': finnhub_key}
-    return requests.get(url=url, params=params)
+    params = {'symbol': index_symbol}
+    return sessions['finnhub'].get(url=url, params=params, timeout=TIMEOUT)
 
 
 ################# Polygon utility functions #################
 
-_last_polygon_call = 0
-# _polygon_limit = 0.084 # number of calls per second
-
 def polygon_call(func):
     '''
-    Method to ensure the API call rate limit isn't reached.
+    Method to ensure the API call rate limit isn't reached, to
+    retry failed calls (see request()), and to serve fresh
+    responses from response_cache without a call.
     '''
     def wrapper(*args, **kwargs):
-        global _last_polygon_call
-        next_available_call = _last_polygon_call + 12
-        now = time.time()
-        if next_available_call >= now:
-            time.sleep(next_available_call - now)
-        _last_polygon_call = time.time()
-
-        return call_api(func, *args, **kwargs)
+        return cached_call('polygon', func, args, kwargs, 
+                            lambda: call_api('polygon', func, *args, **kwargs))
 
     return wrapper
 
@@ -174,7 +519,16 @@ def get_financials(symbol):
     # TODO: Test that this method returns data for the expected years
     url = polygon_endpoint + f'financials/{symbol}'
     params = {'limit': 10, 'type': 'Y', 
-                'sort':'-reportPeriod', 
-                'apiKey': polygon_key}
-    response = requests.get(url, params=params)
+                'sort':'-reportPeriod'}
+    response = sessions['polygon'].get(url, params=params, timeout=TIMEOUT)
     return response
+
+@polygon_call
+def get_grouped_daily(date):
+    '''
+    Return the daily open, high, low, and close of every US stock
+    on date (a 'YYYY-MM-DD' string) in a single response.
+    '''
+    url = polygon_aggs_endpoint + f'grouped/locale/us/market/stocks/{date}'
+    params = {'adjusted': 'true'}
+    return sessions['polygon'].get(url, params=params, timeout=TIMEOUT)
@@ -0,0 +1,232 @@
+'''
+An asyncio version of the api_utils functions.
+
+The coroutines return the same JSON as their api_utils counterparts,
+share api_utils' rate limiters and response cache, and let one event
+loop fan out many calls while staying within each provider's quota.
+
+Example:
+    async with AsyncClient() as client:
+        metrics = await client.map_symbols(client.get_metrics, symbols)
+'''
+import asyncio
+import json
+import time
+
+import aiohttp
+
+from portfoliobuilder import (alpaca_endpoint, alpaca_headers,
+    finnhub_endpoint, finnhub_key, polygon_endpoint, polygon_aggs_endpoint,
+    polygon_key)
+from portfoliobuilder import api_utils
+from portfoliobuilder.api_stats import api_stats
+
+
+def client_timeout():
+    '''
+    Return api_utils.TIMEOUT, a (connect, read) tuple or a number for
+    both like requests takes, as an aiohttp.ClientTimeout.
+    '''
+    timeout = api_utils.TIMEOUT
+    connect, read = timeout if isinstance(timeout, tuple) else (timeout, timeout)
+    return aiohttp.ClientTimeout(total=None, sock_connect=connect, sock_read=read)
+
+
+class AsyncClient():
+    '''
+    An async context manager that holds one aiohttp session per
+    API provider.
+    '''
+    def __init__(self, alpaca_url=alpaca_endpoint, finnhub_url=finnhub_endpoint,
+                    polygon_url=polygon_endpoint, polygon_aggs_url=polygon_aggs_endpoint):
+        '''
+        The URL arguments default to the real endpoints and can be
+        pointed at a local server for testing.
+        '''
+        self.alpaca_url = alpaca_url
+        self.finnhub_url = finnhub_url
+        self.polygon_url = polygon_url
+        self.polygon_aggs_url = polygon_aggs_url
+        self._sessions = {}
+
+    async def __aenter__(self):
+        def make_session(headers=None):
+            connector = aiohttp.TCPConnector(limit=api_utils.HTTP_POOL_SIZE)
+            return aiohttp.ClientSession(connector=connector, headers=headers,
+                                            timeout=client_timeout())
+
+        self._sessions = {
+            'alpaca': make_session(alpaca_headers),
+            'finnhub': make_session({'X-Finnhub-Token': finnhub_key}),
+            'polygon': make_session()
+        }
+        return self
+
+    async def __aexit__(self, *exc_info):
+        for session in self._sessions.values():
+            await session.close()
+        self._sessions = {}
+
+    async def _call(self, provider, endpoint, args, method, url, **kwargs):
+        '''
+        Make a rate-limited request and return its JSON, or None if
+        the call failed. Failed calls are retried like in
+        api_utils.request(). Responses from endpoints listed in
+        api_utils._CACHE_TTLS are served from and stored in
+        api_utils.response_cache, whose SQLite reads and writes run in
+        the loop's default executor so they do not block the loop. The
+        call is recorded in api_stats.
+
+        endpoint : str
+            The name of the matching api_utils function
+        args : tuple
+            The arguments of the call, used for the cache key
+        '''
+        loop = asyncio.get_running_loop()
+        cache = api_utils.response_cache
+        key = None
+        if cache.caches(endpoint):
+            key = cache.make_key(endpoint, args, {})
+            response = await loop.run_in_executor(None, cache.get, endpoint, key)
+            if response is not None:
+                api_stats.record_cache_hit(provider, endpoint)
+                return response
+
+        limiter = api_utils.rate_limiters[provider]
+        deadline = time.monotonic() + api_utils.MAX_RETRY_SECONDS
+        for attempt in range(api_utils.MAX_RETRIES + 1):
+            wait = limiter.reserve()
+            if wait > 0:
+                api_stats.record_throttle(provider, endpoint, wait)
+                await asyncio.sleep(wait)
+            status = retry_after = None
+            start = time.perf_counter()
+            try:
+                async with self._sessions[provider].request(method, url, **kwargs) as response:
+                    status = response.status
+                    retry_after = response.headers.get('Retry-After')
+                    body = await response.read()
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                # e.g., the connection failed or timed out, or the body was cut off
+                status = retry_after = None
+                api_stats.record_response(provider, endpoint, 
+                                            time.perf_counter() - start, 'error')
+            else:
+                api_stats.record_response(provider, endpoint, time.perf_counter() - start,
+                                            status, len(body))
+                if status in range(200, 226):
+                    limiter.recover()
+                    break
+
+            if not api_utils.should_retry(endpoint, status) or \
+                    attempt == api_utils.MAX_RETRIES:
+                return self._failed(status)
+            delay = api_utils.retry_delay(attempt, retry_after)
+            if time.monotonic() + delay > deadline:
+                return self._failed(status)
+            if status == 429:
+                limiter.slow_down(delay)
+                delay = 0 # the next reserve() waits out the pause
+            api_stats.record_retry(provider, endpoint)
+            await asyncio.sleep(delay)
+
+        start = time.perf_counter()
+        response = json.loads(body)
+        api_stats.record_decode(provider, endpoint, time.perf_counter() - start)
+
+        if key is not None and api_utils.should_cache(endpoint, response):
+            await loop.run_in_executor(None, cache.put, endpoint, key, response)
+        return response
+
+    @staticmethod
+    def _failed(status):
+        if status is None:
+            print('API call failed due to ConnectionError.')
+        return None
+
+    async def map_symbols(self, api_function, symbols):
+        '''
+        Call api_function (one of this client's coroutines) for every
+        symbol concurrently.
+
+        Return a dict mapping each symbol to its response.
+        '''
+        responses = await asyncio.gather(*[api_function(symbol) for symbol in symbols])
+        return dict(zip(symbols, responses))
+
+    ################# Alpaca #################
+
+    async def get_account(self):
+        url = self.alpaca_url + 'account'
+        return await self._call('alpaca', 'get_account', (), 'GET', url)
+
+    async def get_asset(self, symbol):
+        url = self.alpaca_url + f'assets/{symbol}'
+        return await self._call('alpaca', 'get_asset', (symbol,), 'GET', url)
+
+    async def get_assets(self):
+        url = self.alpaca_url + 'assets'
+        params = {'status': 'active', 'asset_class': 'us_equity'}
+        return await self._call('alpaca', 'get_assets', (), 'GET', url, params=params)
+
+    async def place_order(self, symbol, notional, side, client_order_id=None, qty=None):
+        ''' See api_utils.place_order(). '''
+        url = self.alpaca_url + 'orders'
+        payload = {'symbol': symbol, 'side': side, 'type': 'market', 'time_in_force': 'day'}
+        if qty is None:
+            payload['notional'] = str(notional)
+        else:
+            payload['qty'] = str(qty)
+        if client_order_id:
+            payload['client_order_id'] = client_order_id
+        return await self._call('alpaca', 'place_order', (symbol, notional, side),
+                                'POST', url, json=payload)
+
+    async def get_position(self, symbol):
+        url = self.alpaca_url + f'positions/{symbol}'
+        return await self._call('alpaca', 'get_position', (symbol,), 'GET', url)
+
+    async def get_positions(self):
+        url = self.alpaca_url + 'positions'
+        return await self._call('alpaca', 'get_positions', (), 'GET', url)
+
+    ################# Finnhub #################
+
+    async def get_profile2(self, symbol):
+        url = self.finnhub_url + 'stock/profile2'
+        params = {'symbol': symbol}
+        return await self._call('finnhub', 'get_profile2', (symbol,), 'GET', url,
+                                params=params)
+
+    async def get_metrics(self, symbol):
+        url = self.finnhub_url + 'stock/metric'
+        params = {'symbol': symbol, 'metric': 'all'}
+        return await self._call('finnhub', 'get_metrics', (symbol,), 'GET', url,
+                                params=params)
+
+    async def get_financials_as_reported(self, symbol):
+        url = self.finnhub_url + 'stock/financials-reported'
+        params = {'symbol': symbol}
+        return await self._call('finnhub', 'get_financials_as_reported', (symbol,),
+                                'GET', url, params=params)
+
+    async def get_index_constituents(self, index_symbol):
+        url = self.finnhub_url + 'index/constituents'
+        params = {'symbol': index_symbol}
+        return await self._call('finnhub', 'get_index_constituents', (index_symbol,),
+                                'GET', url, params=params)
+
+    ################# Polygon #################
+
+    async def get_financials(self, symbol):
+        url = self.polygon_url + f'financials/{symbol}'
+        params = {'limit': 10, 'type': 'Y', 'sort': '-reportPeriod',
+                    'apiKey': polygon_key}
+        return await self._call('polygon', 'get_financials', (symbol,), 'GET', url,
+                                params=params)
+
+    async def get_grouped_daily(self, date):
+        url = self.polygon_aggs_url + f'grouped/locale/us/market/stocks/{date}'
+        params = {'adjusted': 'true', 'apiKey': polygon_key}
+        return await self._call('polygon', 'get_grouped_daily', (date,), 'GET', url,
+                                params=params)
@@ -0,0 +1,236 @@
+'''
+A module for backtesting the weighting methods over stored
+fundamentals and price history.
+
+At each rebalance date, the weighting methods are given the
+fundamentals that were known on that date, in the same form as the
+API responses they normally use. Between rebalances, the holdings
+drift with prices; this is computed for all stocks and days of a
+period at once.
+'''
+import contextlib
+import datetime
+import io
+import os
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+from portfoliobuilder import basket_utils, warehouse
+
+
+# Number of days after the end of a fiscal year before its annual
+# financials are assumed to be public
+FILING_LAG_DAYS = 90
+
+
+BacktestResult = namedtuple('BacktestResult', ['values', 'returns', 'weights',
+                                                'turnover', 'drawdown', 'summary'])
+
+'''
+BacktestResult notes:
+- values is a pd.Series of the portfolio value (starting at 1) per day
+- returns is a pd.Series of the daily portfolio returns
+- weights is a pd.DataFrame of the target weights (rebalance dates x symbols)
+- turnover is a pd.Series of the one-way turnover at each rebalance
+- drawdown is a pd.Series of the fall from the running peak per day
+- summary is a dict with total_return, annualized_return,
+  annualized_volatility, max_drawdown, and average_turnover
+'''
+
+
+################# Loading local files #################
+
+def load_prices(path):
+    '''
+    Load daily closing prices from a CSV or Parquet file with a
+    'date' column and one column per symbol.
+
+    Return a pd.DataFrame indexed by date (dates x symbols).
+    '''
+    if path.endswith('.parquet'):
+        prices = pd.read_parquet(path)
+    else:
+        prices = pd.read_csv(path)
+    prices['date'] = pd.to_datetime(prices['date'])
+    return prices.set_index('date').sort_index()
+
+
+def load_fundamentals(path):
+    '''
+    Load a table exported by warehouse.export_numpy() (a directory)
+    or warehouse.export_parquet() (a .parquet file).
+
+    Return a pd.DataFrame with the table's columns.
+    '''
+    if os.path.isdir(path):
+        return pd.DataFrame({column: np.asarray(values)
+                            for column, values in warehouse.load_numpy(path).items()})
+    return pd.read_parquet(path)
+
+
+################# Point-in-time data #################
+
+def _sorted_by_date(frame):
+    ''' Return a copy of frame with as_of as datetime64, sorted by as_of. '''
+    if frame is None:
+        return None
+    frame = frame.assign(as_of=pd.to_datetime(frame['as_of']))
+    return frame.sort_values('as_of', kind='stable')
+
+
+def _latest_rows(frame, as_of):
+    '''
+    Return the latest row of each symbol dated on or before as_of.
+    frame must be sorted by _sorted_by_date().
+    '''
+    known = frame.iloc[:frame['as_of'].searchsorted(pd.Timestamp(as_of), side='right')]
+    return known.groupby('symbol').tail(1)
+
+
+def _field_dicts(rows, fields):
+    '''
+    Return a dict per row of rows mapping the API names in fields
+    (e.g., warehouse.METRIC_FIELDS) to the row's values.
+    '''
+    names = list(fields)
+    columns = [rows[column].tolist() for column in fields.values()]
+    return [dict(zip(names, values)) for values in zip(*columns)]
+
+
+def point_in_time_responses(metric_frame, financials_frame, date,
+                            filing_lag_days=FILING_LAG_DAYS):
+    '''
+    Rebuild the API responses the weighting methods use from the
+    stored rows known on date.
+
+    metric_frame, financials_frame : pd.DataFrame
+        Rows of MetricSnapshot and AnnualFinancials (e.g., from
+        warehouse.load_frame() or load_fundamentals()), sorted by
+        _sorted_by_date()
+
+    Return a tuple (metrics, financials) of dicts mapping symbols to
+    responses shaped like those from api_utils.get_metrics() and
+    api_utils.get_financials().
+    '''
+    metrics = {}
+    if metric_frame is not None:
+        rows = _latest_rows(metric_frame, date)
+        for symbol, metric in zip(rows['symbol'], _field_dicts(rows, warehouse.METRIC_FIELDS)):
+            metrics[symbol] = {'symbol': symbol, 'metric': metric}
+
+    financials = {}
+    if financials_frame is not None:
+        filed_by = date - datetime.timedelta(days=filing_lag_days)
+        rows = _latest_rows(financials_frame, filed_by)
+        for symbol, result in zip(rows['symbol'], _field_dicts(rows, warehouse.FINANCIALS_FIELDS)):
+            financials[symbol] = {'status': 'OK', 'results': [result]}
+    return metrics, financials
+
+
+def _get_weights(weighting_method, symbols, metrics, financials):
+    '''
+    Call the weighting method with point-in-time responses. Its
+    printed output is suppressed. Return {} if no weights could be
+    computed (e.g., no stock has fundamentals yet).
+    '''
+    method = basket_utils._WEIGHTING_METHODS[weighting_method]
+    if weighting_method != 'equal':
+        symbols = [symbol for symbol in symbols if symbol in metrics]
+    if not symbols:
+        return {}
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            return method._weights_from_responses(symbols, metrics, financials)
+    except (TypeError, ValueError, ZeroDivisionError):
+        return {}
+
+
+################# Engine #################
+
+def rebalance_dates(dates, frequency='Q'):
+    '''
+    Return the indices of the first trading day in each period
+    (a pandas frequency such as 'M', 'Q', or 'A') of dates.
+    '''
+    periods = pd.DatetimeIndex(dates).to_period(frequency)
+    is_first = np.ones(len(periods), dtype=bool)
+    is_first[1:] = periods[1:] != periods[:-1]
+    return np.flatnonzero(is_first)
+
+
+def run_backtest(prices, weighting_method, metric_frame=None, financials_frame=None,
+                    frequency='Q', filing_lag_days=FILING_LAG_DAYS):
+    '''
+    Backtest a weighting method over the symbols in prices.
+
+    prices : pd.DataFrame
+        Daily closes (dates x symbols), like from load_prices().
+        A stock is only bought on dates it has a price.
+    weighting_method : str
+        One of the keys of basket_utils._WEIGHTING_METHODS
+    metric_frame, financials_frame : pd.DataFrame
+        Stored fundamentals; not needed for the 'equal' method
+    frequency : str
+        How often to rebalance, as a pandas frequency
+    filing_lag_days : int
+        See FILING_LAG_DAYS
+
+    Return a BacktestResult.
+    '''
+    metric_frame = _sorted_by_date(metric_frame)
+    financials_frame = _sorted_by_date(financials_frame)
+    dates = prices.index
+    symbols = np.array(prices.columns)
+    closes = prices.to_numpy(dtype=float)
+    returns = np.nan_to_num(closes[1:] / closes[:-1] - 1, nan=0.0, posinf=0.0)
+    growth = np.vstack([np.zeros(len(symbols)), returns]) + 1 # growth on each day
+
+    starts = rebalance_dates(dates, frequency)
+    ends = np.append(starts[1:], len(dates) - 1)
+    values = np.ones(len(dates))
+    weights = np.zeros((len(starts), len(symbols)))
+    turnover = np.zeros(len(starts))
+    drifted = np.zeros(len(symbols)) # weights just before a rebalance
+
+    for i, (start, end) in enumerate(zip(starts, ends)):
+        tradable = symbols[~np.isnan(closes[start])].tolist()
+        metrics, financials = point_in_time_responses(metric_frame, financials_frame,
+                                                        dates[start].date(), filing_lag_days)
+        target = _get_weights(weighting_method, tradable, metrics, financials)
+        weights[i] = [target.get(symbol, 0) for symbol in symbols]
+
+        # Cash is counted as a holding, so turnover is 1 when buying from all cash
+        cash_change = abs((1 - weights[i].sum()) - (1 - drifted.sum()))
+        turnover[i] = (np.abs(weights[i] - drifted).sum() + cash_change) / 2
+
+        # Value of each holding relative to the rebalance, for each day of the period
+        holdings = np.cumprod(growth[start + 1:end + 1], axis=0) * weights[i]
+        cash = 1 - weights[i].sum()
+        period_values = holdings.sum(axis=1) + cash
+        values[start + 1:end + 1] = values[start] * period_values
+        if len(holdings):
+            drifted = holdings[-1] / period_values[-1]
+        else:
+            drifted = weights[i]
+
+    return _make_result(dates, symbols, starts, values, weights, turnover)
+
+
+def _make_result(dates, symbols, starts, values, weights, turnover):
+    values = pd.Series(values, index=dates)
+    daily_returns = values.pct_change().fillna(0)
+    drawdown = 1 - values / values.cummax()
+    years = max((dates[-1] - dates[0]).days / 365.25, 1 / 365.25)
+    summary = {
+        'total_return': values.iloc[-1] - 1,
+        'annualized_return': values.iloc[-1] ** (1 / years) - 1,
+        'annualized_volatility': daily_returns.std() * np.sqrt(252),
+        'max_drawdown': drawdown.max(),
+        'average_turnover': turnover.mean()
+    }
+    rebalance_index = dates[starts]
+    return BacktestResult(values, daily_returns,
+                            pd.DataFrame(weights, index=rebalance_index, columns=symbols),
+                            pd.Series(turnover, index=rebalance_index), drawdown, summary)
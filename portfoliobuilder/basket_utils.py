@@ -1,6 +1,6 @@
-import sys
+import numpy as np
 
-from portfoliobuilder import api_utils, weighting
+from portfoliobuilder import api_utils, incremental_weighting, ledger, orders, weighting
 
 
 _WEIGHTING_METHODS = {'equal': weighting.Equal, 
@@ -8,6 +8,11 @@ _WEIGHTING_METHODS = {'equal': weighting.Equal,
                     'value': weighting.Value, 
                     'value_quality': weighting.ValueQuality}
 
+# When rebalancing, trades smaller than MIN_TRADE_VALUE dollars or
+# smaller than MIN_DRIFT times the stock's goal market value are skipped.
+MIN_TRADE_VALUE = 1.0
+MIN_DRIFT = 0.01
+
 
 def get_weights(weighting_method, symbols):
     '''
@@ -31,11 +36,30 @@ def get_weights(weighting_method, symbols):
         raise Exception('Invalid weighting method')
 
 
+def get_basket_weights(basket, refresh=False):
+    '''
+    Get the weight of each stock in the basket. For the weighting
+    methods in incremental_weighting.INCREMENTAL_METHODS, only the
+    fundamentals that changed since the basket's last run are
+    refetched, unless refresh is True.
+
+    Return a dictionary like the one returned by get_weights().
+    '''
+    if basket.weighting_method in incremental_weighting.INCREMENTAL_METHODS:
+        return incremental_weighting.get_weights(basket, refresh=refresh)
+    symbols = [stock.symbol for stock in basket.stocks]
+    return get_weights(basket.weighting_method, symbols)
+
+
 def buy_basket(basket):
     '''
     Buy a basket of stocks (designated by the symbols argument). 
     The amount of each stock to purchase is determined using
-    the weighting_method and the total basket_weight.
+    the weighting_method and the total basket_weight. The orders
+    are recorded in the basket's ledger (see ledger.py).
+
+    Return a list of orders.OrderResult, one per order, or None
+    if no orders were submitted.
     '''
     # Determine account value and cash available
     account = api_utils.get_account()
@@ -48,7 +72,6 @@ def buy_basket(basket):
     
     weighting_method = basket.weighting_method
     basket_weight = basket.weight
-    symbols = [stock.symbol for stock in basket.stocks]
 
     # Ensure there is enough cash to give the basket its full weight
     if (basket_weight/100) * acc_value > cash:
@@ -60,13 +83,128 @@ def buy_basket(basket):
         print('Invalid weighting_method. Exiting.')
         return
 
-    weights = get_weights(weighting_method, symbols)
+    weights = get_basket_weights(basket)
 
     basket_weight = basket_weight / 100
-    for symbol in weights.keys():
-        print(f'Placing order to buy {symbol}...', end='\r')
-        sys.stdout.write('\033[K')
-        notional = acc_value * basket_weight * weights[symbol]
-        if not api_utils.place_order(symbol, notional, 'buy'):
-            print(f'Order to buy {symbol} failed.')
+    # Stocks weighted 0 are not ordered
+    buy_orders = [(symbol, acc_value * basket_weight * weights[symbol], 'buy') 
+                    for symbol in weights if weights[symbol] > 0]
+    results = orders.submit_orders(buy_orders)
+    ledger.record_orders(results, ledger.basket_allocations(basket, weights))
+    return results
+
+
+def get_positions_by_symbol():
+    '''
+    Return a dict mapping each symbol held in the account to its
+    position, taken from a single call. Return None if the positions
+    could not be accessed.
+    '''
+    positions = api_utils.get_positions()
+    if positions is None:
+        return None
+    return {position['symbol']: position for position in positions}
+
+
+def plan_trades(goal_values, curr_values, min_trade_value=None, min_drift=None):
+    '''
+    Compute the trades that move the account from curr_values to
+    goal_values.
+
+    goal_values : dict
+        Maps each symbol to the market value, in dollars, it should have
+    curr_values : dict
+        Maps symbols to their current market value. Symbols not in
+        goal_values are ignored, and symbols missing from curr_values
+        are treated as having a market value of 0.
+    min_trade_value : float
+        Trades smaller than this many dollars are skipped. Defaults to
+        MIN_TRADE_VALUE.
+    min_drift : float
+        Trades smaller than this fraction of the goal market value
+        are skipped. Defaults to MIN_DRIFT.
+
+    Return a list of (symbol, notional, side) tuples, like the orders
+    argument of orders.submit_orders(), where all sells, largest
+    first, come before all buys, largest first. submit_orders()
+    places the sells before the buys, so sells free cash before buys
+    use it.
+    '''
+    if min_trade_value is None:
+        min_trade_value = MIN_TRADE_VALUE
+    if min_drift is None:
+        min_drift = MIN_DRIFT
+    symbols = np.array(list(goal_values), dtype=object)
+    goal = np.array([goal_values[symbol] for symbol in symbols], dtype=float)
+    curr = np.array([float(curr_values.get(symbol, 0)) for symbol in symbols])
 
+    delta = goal - curr
+    size = np.abs(delta)
+    keep = (size >= min_trade_value) & (size >= min_drift * goal)
+    sells = np.flatnonzero(keep & (delta < 0))
+    buys = np.flatnonzero(keep & (delta > 0))
+    sells = sells[np.argsort(-size[sells], kind='stable')]
+    buys = buys[np.argsort(-size[buys], kind='stable')]
+
+    trades = [(symbols[i], round(float(size[i]), 2), 'sell') for i in sells]
+    trades += [(symbols[i], round(float(size[i]), 2), 'buy') for i in buys]
+    return trades
+
+
+def plan_rebalance(basket, min_trade_value=None, min_drift=None, refresh=False):
+    '''
+    Compute the trades that rebalance the basket without placing
+    any orders. All trades are computed from one snapshot of the
+    account's positions. See plan_trades() for the arguments and
+    the return value, and get_basket_weights() for refresh.
+
+    If the basket's holdings are in the ledger, its own shares are
+    compared to its goal, and sells are for a number of shares (see
+    ledger.sells_by_qty()). Otherwise, the account's positions are.
+
+    Return None if the account could not be accessed.
+    '''
+    account = api_utils.get_account()
+    positions = get_positions_by_symbol()
+    if not account or positions is None:
+        print('Could not access account. Exiting. Try again or ensure API keys are correct.')
+        return
+    acc_value = float(account['equity'])
+
+    symbols = [stock.symbol for stock in basket.stocks]
+    weights = get_basket_weights(basket, refresh)
+
+    basket_weight = basket.weight / 100
+    goal_values = {symbol: acc_value * basket_weight * weights[symbol] 
+                    for symbol in symbols}
+    if not ledger.is_tracked(basket):
+        curr_values = {symbol: positions[symbol]['market_value'] 
+                        for symbol in symbols if symbol in positions}
+        return plan_trades(goal_values, curr_values, min_trade_value, min_drift)
+    # Sell the holdings of symbols that were removed from the basket
+    for holding in basket.holdings:
+        goal_values.setdefault(holding.symbol, 0)
+    trades = plan_trades(goal_values, ledger.holding_values(basket, positions), 
+                            min_trade_value, min_drift)
+    held_qty = {holding.symbol: holding.qty for holding in basket.holdings}
+    return ledger.sells_by_qty(trades, held_qty, positions)
+
+
+def rebalance_basket(basket, refresh=False):
+    '''
+    Buy or sell each stock in the basket so that its market value
+    matches its weight. The trades from plan_rebalance() are
+    submitted as a batch and, if the basket's holdings are in the
+    ledger, recorded there.
+
+    Return a list of orders.OrderResult, one per order, or None
+    if no orders were submitted.
+    '''
+    trades = plan_rebalance(basket, refresh=refresh)
+    if trades is None:
+        return
+    results = orders.submit_orders(trades)
+    if ledger.is_tracked(basket):
+        ledger.record_orders(results, ledger.basket_allocations(
+                                            basket, [trade[0] for trade in trades]))
+    return results
@@ -1,13 +1,20 @@
 '''
 This module implements the commands for the command line app.
+
+Each command's execute() returns False if the command failed (e.g.,
+its arguments were invalid, its basket is unknown, or an order or API
+call failed), and None otherwise.
 '''
 import os
-import sys
 from sqlalchemy import create_engine
 from sqlalchemy.orm import Session
 
-from portfoliobuilder import utils, api_utils, basket_utils
-from portfoliobuilder.models import Base, Basket, Stock
+from portfoliobuilder import (utils, api_utils, basket_utils, ledger, orders, 
+    portfolio, trade_stream, warehouse)
+from portfoliobuilder.models import (Base, Basket, Stock, MetricSnapshot, 
+    AnnualFinancials)
+from portfoliobuilder.weighting import ValueQuality
+from portfoliobuilder.api_stats import api_stats
 from portfoliobuilder.supported_indices import supported_indices_dict
 
 
@@ -20,10 +27,43 @@ def setup_db():
     Base.metadata.create_all(bind=engine) # Create tables
 
 
+def print_trades(trades):
+    ''' Print trades like those returned by basket_utils.plan_trades(). '''
+    for symbol, notional, side, *qty in trades:
+        if qty:
+            print(f'{side} {qty[0]} shares (~${notional:.2f}) of {symbol}')
+        else:
+            print(f'{side} ${notional:.2f} of {symbol}')
+
+
+def sync_ledger():
+    '''
+    Apply the fills of the orders closed since the last sync to the
+    baskets' holdings (see ledger.sync_fills()).
+    '''
+    ledger.sync_fills(ledger.pending_trades(session))
+    session.flush()
+
+
 # This variable is set in run.py everytime the user enters input
 user_input = ''
 
 
+def get_refresh_from_user_input(num_args=0):
+    '''
+    For commands of the form <command> <num_args arguments> (full),
+    e.g., rebalance <basket_id> (full), return True if full was given,
+    False if not, and None if the input is invalid.
+    '''
+    args = user_input.split(' ')[1:]
+    if len(args) == num_args:
+        return False
+    if len(args) == num_args + 1 and args[-1] == 'full':
+        return True
+    print('Invalid commands. Incorrect number of arguments.')
+    return None
+
+
 class BasketCommand():
     '''
     A class inherited by commands where <basket_id>
@@ -59,8 +99,14 @@ class Help():
             'buybasket <basket_id>\n' + \
             'sellbasket <basket_id>\n' + \
             'deletebasket <basket_id>\n' + \
-            'rebalance <basket_id>\n' + \
-            'listindices\n\n' + \
+            'rebalance <basket_id> (full)\n' + \
+            'planrebalance <basket_id> (full)\n' + \
+            'rebalanceall (full)\n' + \
+            'planrebalanceall (full)\n' + \
+            'listindices\n' + \
+            'storefundamentals <basket_id>\n' + \
+            'exportfundamentals <npy|parquet> <directory>\n' + \
+            'stats (<file>)\n\n' + \
             "Enter 'help' to see commands.\n"+ \
             "Enter 'quit' to quit, or kill with CTRL+C.")
 
@@ -77,6 +123,7 @@ class InspectAccount():
                 print(f'{key}: {response[key]}')
         else:
             print('Could not get account information.')
+            return False
 
 
 class LinkAlpaca():
@@ -86,9 +133,10 @@ class LinkAlpaca():
     @staticmethod
     def execute():
         if not LinkAlpaca.input_is_valid():
-            return
+            return False
         LinkAlpaca.set_environment_variables()
-        LinkAlpaca.check_account_connected()
+        if not LinkAlpaca.check_account_connected():
+            return False
 
     @staticmethod
     def input_is_valid():
@@ -110,6 +158,7 @@ class LinkAlpaca():
             print(f'Linked to Alpaca account with id: {acc["id"]}.')
         else:
             print('Could not link Alpaca account.') 
+        return bool(acc)
 
 
 class LinkFinnhub():
@@ -119,9 +168,10 @@ class LinkFinnhub():
     @staticmethod
     def execute():
         if not LinkAlpaca.input_is_valid():
-            return
+            return False
         LinkAlpaca.set_environment_variables()
-        LinkAlpaca.check_account_connected()
+        if not LinkAlpaca.check_account_connected():
+            return False
 
     @staticmethod
     def input_is_valid():
@@ -142,6 +192,7 @@ class LinkFinnhub():
             print(f'Connected to Finnhub API.')
         else:
             print('Could not connect to Finnhub.')
+        return bool(constituents)
 
 
 class LinkPolygon():
@@ -151,9 +202,10 @@ class LinkPolygon():
     @staticmethod
     def execute():
         if not LinkAlpaca.input_is_valid():
-            return
+            return False
         LinkAlpaca.set_environment_variables()
-        LinkAlpaca.check_account_connected()
+        if not LinkAlpaca.check_account_connected():
+            return False
 
     @staticmethod
     def input_is_valid():
@@ -174,6 +226,7 @@ class LinkPolygon():
             print(f'Connected to Polygon API.')
         else:
             print('Could not connect to Finnhub.') 
+        return bool(financials)
 
 
 class NewBasket():
@@ -187,8 +240,10 @@ class NewBasket():
             NewBasket.create_basket()
         except IndexError:
             print("Invalid command. Enter 'help' to see usage.")
+            return False
         except AssertionError:
             print('Assertion error. Ensure parameters are valid.')
+            return False
 
     @staticmethod
     def input_has_enough_args():
@@ -251,17 +306,20 @@ class NewBasketFromIndex():
     @staticmethod
     def execute():
         if not utils.has_num_args(user_input, 3):
-            return
+            return False
         symbols = NewBasketFromIndex.get_symbols_in_index()
+        if symbols is None:
+            print('Could not get the constituents of the index.')
+            return False
         NewBasketFromIndex.replace_index_with_symbols_in_user_input(symbols)
-        NewBasket.execute()
+        return NewBasket.execute()
 
     @staticmethod
     def get_symbols_in_index():
         split_input = user_input.split(' ')
         index = split_input[3]
         response = api_utils.get_index_constituents(index)
-        return response['constituents']
+        return response['constituents'] if response else None
 
     @staticmethod
     def replace_index_with_symbols_in_user_input(symbols):
@@ -294,12 +352,14 @@ class InspectBasket(BasketCommand):
     @staticmethod
     def execute():
         if not utils.has_num_args(user_input, 1):
-            return
+            return False
         basket = InspectBasket.get_basket_from_user_input()
         if basket:
+            sync_ledger()
             InspectBasket.print_basket_info(basket)
         else:
             print('Invalid command. Unknown basket.')
+            return False
 
     @staticmethod
     def print_basket_info(basket):
@@ -315,6 +375,10 @@ class InspectBasket(BasketCommand):
         print(f'Basket weight: {basket.weight}%')
         print(f'Basket is active: {active}')
         print(f'Basket constituents: {symbols}')
+        if ledger.is_tracked(basket):
+            print('Basket holdings (symbol | shares | cost basis):')
+            for holding in sorted(basket.holdings, key=lambda holding: holding.symbol):
+                print(f'{holding.symbol} | {holding.qty:.6f} | ${holding.cost_basis:.2f}')
 
 
 class AddSymbols(BasketCommand):
@@ -325,7 +389,7 @@ class AddSymbols(BasketCommand):
     def execute():
         basket = AddSymbols.get_basket_from_user_input()
         if not AddSymbols.basket_is_modifiable(basket):
-            return
+            return False
         new_symbols = AddSymbols.get_symbols_from_user_input()
         AddSymbols.add_new_symbols_not_in_basket(new_symbols, basket)
 
@@ -347,15 +411,11 @@ class AddSymbols(BasketCommand):
         '''
         new_symbols = user_input.split(' ')[2:]
         untradable_new_symbols = []
+        asset_index = utils.get_asset_index()
         for symbol in new_symbols:
-            print(f'Determining whether {symbol} is tradable...', end='\r')
-            asset = api_utils.get_asset(symbol)    
-            sys.stdout.write("\033[K")
-            if asset:
-                if asset['tradable']:
-                    continue
-            print(f'{symbol} appears to not be tradable.')
-            untradable_new_symbols.append(symbol)
+            if not utils.is_tradable(symbol, asset_index):
+                print(f'{symbol} appears to not be tradable.')
+                untradable_new_symbols.append(symbol)
         return set(new_symbols) - set(untradable_new_symbols)
 
     @staticmethod
@@ -400,24 +460,36 @@ class BuyBasket(BasketCommand):
     @staticmethod
     def execute():
         if not utils.has_num_args(user_input, 1):
-            return
+            return False
             
         basket = BuyBasket.get_basket_from_user_input()
+        if not basket:
+            print('Invalid command. Unknown basket.')
+            return False
         if basket.active:
-            print(f'{basket[0]} is already active. Exiting.')
-            return
-        basket_utils.buy_basket(basket)
-        BuyBasket.print_basket_and_purchase_info(basket)
+            print(f'Basket{basket.id} is already active. Exiting.')
+            return False
+        with trade_stream.tracking_fills(session):
+            results = basket_utils.buy_basket(basket)
+        if results is None:
+            return False
+        if len(orders.failed(results)) == len(results):
+            print(f'No orders to purchase stocks in Basket{basket.id} could be placed. ' + \
+                    'It stays inactive.')
+            orders.print_summary(results)
+            return False
+        BuyBasket.print_basket_and_purchase_info(basket, results)
         basket.active = True
         session.flush()
+        if orders.failed(results):
+            return False
 
     @staticmethod
-    def print_basket_and_purchase_info(basket):
+    def print_basket_and_purchase_info(basket, results):
         print(f'Orders to purchase stocks in Basket{basket.id} have been placed.')
         print(f'Weighting method: {basket.weighting_method}')
         print(f'Basket weight: {basket.weight}')
-        print('Note: Some purchase orders might not have been placed.', end=' ')
-        print('If no errors were printed above, all orders were placed successfully.')
+        orders.print_summary(results)
 
 
 class SellBasket(BasketCommand):
@@ -427,17 +499,21 @@ class SellBasket(BasketCommand):
     @staticmethod
     def execute():
         if not utils.has_num_args(user_input, 1):
-            return
+            return False
         basket = SellBasket.get_basket_from_user_input()
         if not SellBasket.basket_is_modifiable(basket):
-            return
-        SellBasket.sell(basket)
+            return False
+        num_failed = SellBasket.sell(basket)
+        if num_failed is None:
+            return False
         SellBasket.update_active_for_basket_in_db(basket)
+        if num_failed:
+            return False
         
     @staticmethod
     def basket_is_modifiable(basket):
         if not basket:
-            print(f'No basket with id {basket.id}.')
+            print('Invalid command. Unknown basket.')
             return False
         if not basket.active:
             print(f'Basket{basket.id} is not active. Cannot sell.')
@@ -447,20 +523,40 @@ class SellBasket(BasketCommand):
     @staticmethod
     def sell(basket):
         '''
-        basket : tuple
+        Sell the basket's stocks, keeping the shares of any stock
+        that other active baskets also hold (see portfolio.sell_basket()).
+
+        basket : models.Basket
             An entry from the baskets table in the database
+
+        Return the number of sells that could not be placed if some of
+        the basket was sold or it held nothing, or None if no sell could
+        be placed.
         '''
-        symbols = [stock.symbol for stock in basket.stocks]
-        for symbol in symbols:
-            if api_utils.close_position(symbol):
-                print('Successfully placed an order to sell '\
-                        f'all shares of {symbol}.', end='\r')
-                sys.stdout.write('\033[K')
-            else:
-                print(f'Could not place an order to sell {symbol}.', end=' ')
-                print(f'Ensure your account has a position in {symbol}.', end=' ')
-                print(f'If you have a position in {symbol}, you', end=' ')
-                print('must place your order manually in Alpaca.')
+        active_baskets = session.query(Basket).filter_by(active=True).all()
+        sync_ledger()
+        with trade_stream.tracking_fills(session):
+            sold = portfolio.sell_basket(basket, active_baskets)
+        if sold is None:
+            return None
+        results, closed_symbols, failed_symbols = sold
+        if results and ledger.is_tracked(basket):
+            print(f'Orders to sell the shares held by Basket{basket.id}:')
+            orders.print_summary(results)
+        elif results:
+            print('Orders to reduce the stocks shared with other baskets:')
+            orders.print_summary(results)
+        for symbol in failed_symbols:
+            print(f'Could not place an order to sell {symbol}.', end=' ')
+            print(f'Ensure your account has a position in {symbol}.', end=' ')
+            print(f'If you have a position in {symbol}, you', end=' ')
+            print('must place your order manually in Alpaca.')
+        num_failed = len(orders.failed(results)) + len(failed_symbols)
+        placed = len(results) - len(orders.failed(results)) + len(closed_symbols)
+        if placed or not num_failed:
+            return num_failed
+        print(f'No orders to sell Basket{basket.id} could be placed. It stays active.')
+        return None
 
     @staticmethod
     def update_active_for_basket_in_db(basket):
@@ -477,15 +573,19 @@ class DeleteBasket(BasketCommand):
     @staticmethod
     def execute():
         if not utils.has_num_args(user_input, 1):
-            return
+            return False
         basket = DeleteBasket.get_basket_from_user_input()
         if not basket:
-            print(f'No basket with id {basket.id}.')
-            return
-        if basket.active:
-            SellBasket.sell(basket)
+            print('Invalid command. Unknown basket.')
+            return False
+        num_failed = SellBasket.sell(basket) if basket.active else 0
+        if num_failed is None:
+            print(f'Basket{basket.id} was not deleted.')
+            return False
         session.delete(basket)
         session.flush()
+        if num_failed:
+            return False
 
 
 class Rebalance(BasketCommand):
@@ -494,58 +594,98 @@ class Rebalance(BasketCommand):
     '''
     @staticmethod
     def execute():
-        if not utils.has_num_args(user_input, 1):
-            return
+        refresh = get_refresh_from_user_input(1)
+        if refresh is None:
+            return False
         basket = Rebalance.get_basket_from_user_input()
         if not basket:
-            print(f'No basket with id {basket.id}.')
-            return
-        acc_value = Rebalance.get_account_value()
-        if acc_value <= 0:
-            print('Nothing to rebalance')
-            return
+            print('Invalid command. Unknown basket.')
+            return False
+        sync_ledger()
+        with trade_stream.tracking_fills(session):
+            results = basket_utils.rebalance_basket(basket, refresh=refresh)
+        session.flush()
+        if results is None:
+            return False
+        print(f'Basket{basket.id} rebalanced.')
+        orders.print_summary(results)
+        if orders.failed(results):
+            return False
 
-        weighting_method = basket.weighting_method
-        basket_weight = basket.weight
-        symbols = [stock.symbol for stock in basket.stocks]
-        weights = Basket.get_weights(weighting_method, symbols)
 
-        for symbol in symbols:
-            curr_position = api_utils.get_position(symbol)
-            if curr_position:
-                print(f'Rebalancing {symbol}...', end='\r')
-                goal_market_val = acc_value * (basket_weight / 100) * weights[symbol]
-                curr_market_val = curr_position['market_value']
-                Rebalance.rebalance(symbol, goal_market_val, curr_market_val)
-                sys.stdout.write("\033[K")
-            else:
-                print(f'Could not rebalance {symbol}.')
-        print(f'Basket{basket.id} rebalanced. See above for stocks that might not have been rebalanced.')
-
-    @staticmethod
-    def get_account_value():
-        account = api_utils.get_account()
-        if account:
-            return float(account['equity'])
-        else:
-            print('Could not access account.')
-            return 0
+class PlanRebalance(BasketCommand):
+    '''
+    Namespace for the methods that execute the planrebalance command.
+    '''
+    @staticmethod
+    def execute():
+        refresh = get_refresh_from_user_input(1)
+        if refresh is None:
+            return False
+        basket = PlanRebalance.get_basket_from_user_input()
+        if not basket:
+            print('Invalid command. Unknown basket.')
+            return False
+        sync_ledger()
+        trades = basket_utils.plan_rebalance(basket, refresh=refresh)
+        session.flush()
+        if trades is None:
+            return False
+        PlanRebalance.print_trades(basket, trades)
 
     @staticmethod
-    def rebalance(symbol, goal_market_val, curr_market_val):
-        '''
-        Sell or buy symbol so that the account holds
-        $goal_market_val instead of $curr_market_val of
-        symbol.
-        '''
-        if goal_market_val < curr_market_val:
-            notional = curr_market_val - goal_market_val
-            if not api_utils.place_order(symbol, notional, 'sell'):
-                print(f'Could not rebalance {symbol}')
-        elif goal_market_val > curr_market_val:
-            notional = goal_market_val - curr_market_val
-            if not api_utils.place_order(symbol, notional, 'buy'):
-                print(f'Could not rebalance {symbol}')
+    def print_trades(basket, trades):
+        print(f'Rebalancing Basket{basket.id} would place {len(trades)} orders ' + \
+                '(no orders have been placed):')
+        print_trades(trades)
+
+
+class RebalanceAll():
+    '''
+    Namespace for the methods that execute the rebalanceall command.
+    '''
+    @staticmethod
+    def execute():
+        refresh = get_refresh_from_user_input()
+        if refresh is None:
+            return False
+        baskets = session.query(Basket).filter_by(active=True).all()
+        if not baskets:
+            print('No active baskets.')
+            return
+        sync_ledger()
+        with trade_stream.tracking_fills(session):
+            results = portfolio.rebalance_portfolio(baskets, refresh=refresh)
+        session.flush()
+        if results is None:
+            return False
+        print(f'Rebalanced {len(baskets)} active baskets.')
+        orders.print_summary(results)
+        if orders.failed(results):
+            return False
+
+
+class PlanRebalanceAll():
+    '''
+    Namespace for the methods that execute the planrebalanceall command.
+    '''
+    @staticmethod
+    def execute():
+        refresh = get_refresh_from_user_input()
+        if refresh is None:
+            return False
+        baskets = session.query(Basket).filter_by(active=True).all()
+        if not baskets:
+            print('No active baskets.')
+            return
+        sync_ledger()
+        trades = portfolio.plan_portfolio(baskets, refresh=refresh)
+        session.flush()
+        if trades is None:
+            return False
+        print(f'Rebalancing {len(baskets)} active baskets would place ' + \
+                f'{len(trades)} orders (no orders have been placed):')
+        print_trades(trades)
 
 
 class ListIndices():
@@ -560,6 +700,94 @@ class ListIndices():
             print(f'{supported_indices_dict[symbol]}  |  {symbol}')
 
 
+class StoreFundamentals(BasketCommand):
+    '''
+    Namespace for the methods that execute the storefundamentals command.
+    '''
+    @staticmethod
+    def execute():
+        if not utils.has_num_args(user_input, 1):
+            return False
+        basket = StoreFundamentals.get_basket_from_user_input()
+        if not basket:
+            print('Invalid command. Unknown basket.')
+            return False
+        symbols = [stock.symbol for stock in basket.stocks]
+        metrics, financials = ValueQuality.fetch_responses(symbols)
+        num_metrics, num_financials = warehouse.store_fundamentals(
+                                            session, metrics, financials)
+        print(f'Stored {num_metrics} metric snapshots and ' + \
+                f'{num_financials} annual financials for Basket{basket.id}.')
+        failed_symbols = [symbol for symbol in symbols 
+                            if not metrics.get(symbol) or not financials.get(symbol)]
+        if failed_symbols:
+            print('Could not fetch the fundamentals of the following symbols: ' + \
+                    ' '.join(failed_symbols))
+            return False
+
+
+class ExportFundamentals():
+    '''
+    Namespace for the methods that execute the exportfundamentals command.
+    '''
+    _MODELS = [MetricSnapshot, AnnualFinancials]
+
+    @staticmethod
+    def execute():
+        if not utils.has_num_args(user_input, 2):
+            return False
+        export_format, directory = user_input.split(' ')[1:3]
+        if export_format == 'npy':
+            for model in ExportFundamentals._MODELS:
+                warehouse.export_numpy(session, model, 
+                                        os.path.join(directory, model.__tablename__))
+        elif export_format == 'parquet':
+            os.makedirs(directory, exist_ok=True)
+            for model in ExportFundamentals._MODELS:
+                path = os.path.join(directory, model.__tablename__ + '.parquet')
+                warehouse.export_parquet(session, model, path)
+        else:
+            print('Invalid command. Format must be npy or parquet.')
+            return False
+        print(f'Exported fundamentals to {directory}.')
+
+
+class Stats():
+    '''
+    Namespace for the methods that execute the stats command.
+    '''
+    @staticmethod
+    def execute():
+        args = user_input.split(' ')[1:]
+        if len(args) > 1:
+            print('Invalid commands. Incorrect number of arguments.')
+            return False
+        if args:
+            api_stats.dump(args[0])
+            print(f'API stats written to {args[0]}.')
+            return
+        Stats.print_stats()
+
+    @staticmethod
+    def print_stats():
+        endpoints = api_stats.endpoints()
+        if not endpoints:
+            print('No API calls made yet.')
+            return
+        print(f'{"Endpoint":<36}{"Calls":>7}{"Retries":>9}{"Cached":>8}{"Throttled":>11}' + \
+                f'{"Latency":>10}{"p95":>8}{"Decode":>9}{"KB":>10}  Statuses')
+        for stats in endpoints:
+            mean_latency = stats.latency_seconds / stats.calls if stats.calls else 0
+            p95 = stats.latency_quantile(0.95)
+            statuses = ' '.join(f'{status}:{count}' 
+                                for status, count in stats.status_codes.items())
+            print(f'{stats.provider + "." + stats.endpoint:<36}{stats.calls:>7}' + \
+                    f'{stats.retries:>9}{stats.cache_hits:>8}{stats.throttle_seconds:>10.2f}s' + \
+                    f'{mean_latency:>9.3f}s{"-" if p95 is None else f"<{p95}s":>8}' + \
+                    f'{stats.decode_seconds:>8.3f}s{stats.bytes_received / 1000:>10.1f}' + \
+                    f'  {statuses}')
+
+
 class Quit():
     '''
     Namespace for the methods that execute the quit command.
@@ -3,7 +3,19 @@ This module provides functions to help read the response
 from the Financials as Reported Finnhub endpoint.
 '''
 
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
 from portfoliobuilder import api_utils
+from portfoliobuilder.response_cache import DAY
 
 
 # TODO: Plan for implementing this module: Iterate over each
@@ -38,22 +50,274 @@ REVENUE_LABELS = ['sales', 'net sales', 'revenue', 'revenues',
     'revenues:', 'total revenue', 'total revenues', 
     'total net revenues', 'revenue from operations']
 
+# Revenue concepts for symbols that report revenue under a concept
+# not in REVENUE_CONCEPTS (see the REVENUE_CONCEPTS notes). These are
+# tried before any other rule.
+REVENUE_OVERRIDES = {
+    'AES': ['ElectricUtilityRevenue'],
+    'CCL': ['SalesRevenueServicesGross'],
+    'HCA': ['HealthCareOrganizationPatientServiceRevenue'],
+    'ROL': ['SalesRevenueServicesNet'],
+    'RHI': ['SalesRevenueServicesNet'],
+    'NEM': ['RevenueMineralSales'],
+    'VLO': ['RefiningAndMarketingRevenue']
+}
+
+# Namespaces, besides the lowercase symbol, that may prefix a concept
+# (e.g., 'us-gaap_Revenues' or 'aapl:Revenues')
+CONCEPT_PREFIXES = ['us-gaap']
+
+
+class FinancialsStore():
+    '''
+    A local SQLite store of parsed Financials as Reported payloads.
+
+    Each line item is stored under (symbol, year, statement, concept),
+    where statement is 'ic' (income statement), 'bs' (balance sheet),
+    or 'cf' (cash flow). Only one report is kept per year, and one
+    item per concept of each statement (see parse_reports()). A
+    symbol's items are reloaded from the API after ttl seconds.
+    '''
+    def __init__(self, path, ttl=90 * DAY):
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._connection = None
+
+    def _connect(self):
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.path, check_same_thread=False)
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS items (symbol TEXT, year INTEGER, '
+                'statement TEXT, concept TEXT, label TEXT, value, '
+                'PRIMARY KEY (symbol, year, statement, concept))')
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS symbols (symbol TEXT PRIMARY KEY, '
+                'loaded_at REAL)')
+        return self._connection
+
+    def has(self, symbol):
+        ''' Return True if symbol's items were loaded less than ttl seconds ago. '''
+        with self._lock:
+            row = self._connect().execute(
+                'SELECT loaded_at FROM symbols WHERE symbol = ?', (symbol,)).fetchone()
+        return row is not None and row[0] + self.ttl >= time.time()
+
+    @staticmethod
+    def parse_reports(reports):
+        '''
+        Parse the reports from the Financials as Reported endpoint,
+        i.e., the items of a response's 'data' or the reports from
+        api_utils.iter_financials_as_reported().
+
+        Return a list of (year, statement, concept, label, value) tuples.
+        Of the reports for a year, the one filed last (by 'filedDate',
+        e.g., an amended 10-K/A) wins, and of reports with the same or
+        no filing date, the first. Within a statement, the first item
+        of each concept wins.
+        '''
+        kept = {} # maps years to (filing date, rows) of the winning report
+        for report in reports:
+            year = report['year']
+            filed_date = report.get('filedDate') or ''
+            if year in kept and filed_date <= kept[year][0]:
+                continue
+            rows = []
+            for statement, items in report['report'].items():
+                # Some reports map concepts to values instead of listing items
+                if isinstance(items, dict):
+                    items = [{'concept': concept, 'label': '', 'value': value}
+                                for concept, value in items.items()]
+                concepts = set()
+                for item in items:
+                    if item['concept'] in concepts:
+                        continue
+                    concepts.add(item['concept'])
+                    rows.append((year, statement, item['concept'],
+                                    item.get('label', ''), item['value']))
+            kept[year] = (filed_date, rows)
+        return [row for _, rows in kept.values() for row in rows]
+
+    @staticmethod
+    def parse_payload(payload):
+        ''' Parse a whole response from the Financials as Reported endpoint. '''
+        return FinancialsStore.parse_reports(payload['data'])
+
+    def add(self, symbol, rows):
+        '''
+        Replace symbol's items with rows, which have the form returned
+        by parse_payload().
+        '''
+        with self._lock:
+            connection = self._connect()
+            connection.execute('DELETE FROM items WHERE symbol = ?', (symbol,))
+            connection.executemany(
+                'INSERT INTO items VALUES (?, ?, ?, ?, ?, ?)',
+                [(symbol,) + row for row in rows])
+            connection.execute('INSERT OR REPLACE INTO symbols VALUES (?, ?)',
+                                (symbol, time.time()))
+            connection.commit()
+
+    def get_rows(self, symbol):
+        ''' Return symbol's items as (year, statement, concept, label, value) tuples. '''
+        with self._lock:
+            return self._connect().execute(
+                'SELECT year, statement, concept, label, value FROM items '
+                'WHERE symbol = ? ORDER BY year DESC, rowid', (symbol,)).fetchall()
+
+    def get_statements(self, symbol, statement):
+        '''
+        Return a list of statements, one per year stored for symbol, most
+        recent first, where each statement is a list of items with
+        'concept', 'label', and 'value'. A year whose report has none of
+        the statement's items has an empty statement.
+        '''
+        with self._lock:
+            connection = self._connect()
+            years = connection.execute(
+                'SELECT DISTINCT year FROM items WHERE symbol = ? ORDER BY year DESC',
+                (symbol,)).fetchall()
+            rows = connection.execute(
+                'SELECT year, concept, label, value FROM items '
+                'WHERE symbol = ? AND statement = ? ORDER BY year DESC, rowid',
+                (symbol, statement)).fetchall()
+        statements = {year: [] for year, in years}
+        for year, concept, label, value in rows:
+            item = {'concept': concept, 'label': label, 'value': value}
+            statements[year].append(item)
+        return list(statements.values())
+
+    def get_value(self, symbol, year, statement, concept):
+        ''' Return the value of a single item, or None if it is not stored. '''
+        with self._lock:
+            row = self._connect().execute(
+                'SELECT value FROM items WHERE symbol = ? AND year = ? '
+                'AND statement = ? AND concept = ?',
+                (symbol, year, statement, concept)).fetchone()
+        return row[0] if row else None
+
+
+store = FinancialsStore(os.path.dirname(os.path.abspath(__file__)) + '/financials.db')
+
+
+def load(symbol):
+    '''
+    Ensure store holds symbol's financials, downloading them only
+    if they are missing or stale. The response is streamed, so memory
+    use does not grow with the length of the filing history.
+    Return False if the download failed.
+    '''
+    if store.has(symbol):
+        return True
+    reports = api_utils.iter_financials_as_reported(symbol)
+    if reports is None:
+        return False
+    store.add(symbol, FinancialsStore.parse_reports(reports))
+    return True
+
+def get_statements(symbol, statement):
+    '''
+    Return a list of symbol's statements of the given type ('ic',
+    'bs', or 'cf'), one per year, most recent first.
+    '''
+    if not load(symbol):
+        return []
+    return store.get_statements(symbol, statement)
 
 def get_income_statements(symbol):
     '''
     Return a list of income statements from the Financials
     as Reported Finnhub endpoint.
     '''
-    response = api_utils.get_financials_as_reported(symbol)
-    data = response['data']
-    # Ensure we get only one report per year
-    new_data = []
-    years_covered = []
-    for item in data:
-        if item['year'] not in years_covered:
-            new_data.append(item)
-            years_covered.append(item['year'])
-    return [item['report']['ic'] for item in new_data]
+    return get_statements(symbol, 'ic')
+
+def get_balance_sheets(symbol):
+    return get_statements(symbol, 'bs')
+
+def get_cash_flow_statements(symbol):
+    return get_statements(symbol, 'cf')
+
+class RevenueMatcher():
+    '''
+    Finds the total revenue in an income statement in a single pass.
+
+    The rules, from highest to lowest priority, are:
+    - 'override': the concept is in the symbol's override list
+    - 'concept': the concept is a revenue concept
+    - 'prefixed_concept': the concept is a revenue concept prefixed by
+        the lowercase symbol or a namespace in CONCEPT_PREFIXES
+    - 'label': the lowercase label is a revenue label
+    '''
+    _RULES = ['override', 'concept', 'prefixed_concept', 'label']
+
+    def __init__(self, concepts=REVENUE_CONCEPTS, labels=REVENUE_LABELS, 
+                    overrides=REVENUE_OVERRIDES, prefixes=CONCEPT_PREFIXES):
+        self.concepts = frozenset(concepts)
+        self.labels = frozenset(label.lower() for label in labels)
+        self.overrides = {symbol.upper(): frozenset(override_concepts) 
+                            for symbol, override_concepts in overrides.items()}
+        self.prefixes = frozenset(prefixes)
+
+    @staticmethod
+    def _split_prefix(concept):
+        ''' Split 'aapl:Revenues' or 'us-gaap_Revenues' into its prefix and concept. '''
+        for separator in (':', '_'):
+            prefix, found, stripped_concept = concept.partition(separator)
+            if found:
+                return prefix.lower(), stripped_concept
+        return None, concept
+
+    def _rule_for(self, concept, label, symbol, override_concepts):
+        ''' Return the rule an item matches, or None. '''
+        if concept in override_concepts:
+            return 'override'
+        if concept in self.concepts:
+            return 'concept'
+        prefix, stripped_concept = self._split_prefix(concept)
+        if prefix and (prefix == symbol.lower() or prefix in self.prefixes):
+            if stripped_concept in override_concepts:
+                return 'override'
+            if stripped_concept in self.concepts:
+                return 'prefixed_concept'
+        if label.lower() in self.labels:
+            return 'label'
+        return None
+
+    def match(self, income_statement, symbol):
+        '''
+        income_statement : list of dictionaries
+            An income statement formatted like those from the
+            Financials as Reported Finnhub endpoint, or a dict
+            mapping concepts to values
+
+        Return a tuple (revenue, rule), where rule is the name of the
+        rule that matched, or (None, None) if no item matched.
+        '''
+        if isinstance(income_statement, dict):
+            income_statement = [{'concept': concept, 'label': '', 'value': value}
+                                for concept, value in income_statement.items()]
+        elif not isinstance(income_statement, list):
+            return None, None
+
+        override_concepts = self.overrides.get(symbol.upper(), frozenset())
+        # Stop at the first item that matches the highest rule possible
+        highest_priority = 0 if override_concepts else 1
+        best = (None, None)
+        best_priority = len(self._RULES)
+        for item in income_statement:
+            rule = self._rule_for(item['concept'], item['label'] or '', 
+                                    symbol, override_concepts)
+            if rule is None:
+                continue
+            priority = self._RULES.index(rule)
+            if priority < best_priority:
+                best, best_priority = (item['value'], rule), priority
+                if priority == highest_priority:
+                    break
+        return best
+
+
+revenue_matcher = RevenueMatcher()
 
 def _find_revenue(income_statement, symbol):
     '''
@@ -65,30 +329,7 @@ def _find_revenue(income_statement, symbol):
         An income statement formatted like those from the
         Financials as Reported Finnhub endpoint
     '''
-    if isinstance(income_statement, list):
-        for item in income_statement:
-            if item['concept'] in REVENUE_CONCEPTS:
-                return item['value']
-
-        # Try '{symbol}:{concept}'
-        lower_symbol = symbol.lower()
-        for item in income_statement:
-            for concept in REVENUE_CONCEPTS:
-                sym_concept = f'{lower_symbol}:{concept}'
-                if item['concept'] == sym_concept:
-                    return item['value']
-        
-        # Try using the labels instead of concepts
-        for item in income_statement:
-            if item['label'].lower() in REVENUE_LABELS:
-                return item['value']
-
-    elif isinstance(income_statement, dict):
-        for key in income_statement:
-            if key in REVENUE_CONCEPTS:
-                return income_statement[key]
-
-    return None
+    return revenue_matcher.match(income_statement, symbol)[0]
 
 def get_revenues(symbol):
     '''
@@ -100,3 +341,83 @@ def get_revenues(symbol):
     return [_find_revenue(stmnt, symbol) for stmnt in inc_statements]
 
 
+def _revenues_from_rows(rows, symbol, matcher):
+    '''
+    Return a list of (year, revenue, rule) tuples, one per year, most
+    recent first, from rows of the form returned by
+    FinancialsStore.parse_payload(). A year without an income
+    statement has no revenue.
+    '''
+    income_statements = {}
+    for year, statement, concept, label, value in rows:
+        income_statements.setdefault(year, [])
+        if statement == 'ic':
+            item = {'concept': concept, 'label': label, 'value': value}
+            income_statements[year].append(item)
+    revenues = []
+    for year in sorted(income_statements, reverse=True):
+        revenue, rule = matcher.match(income_statements[year], symbol)
+        revenues.append((year, revenue, rule))
+    return revenues
+
+def _parse_and_extract_revenues(symbol, body, matcher):
+    '''
+    Decode and parse the body of a Financials as Reported response
+    and extract its revenues. Runs in a worker process of
+    get_revenues_bulk().
+
+    Return a tuple (symbol, rows, revenues).
+    '''
+    rows = FinancialsStore.parse_payload(json.loads(body))
+    return symbol, rows, _revenues_from_rows(rows, symbol, matcher)
+
+def get_revenues_bulk(symbols, max_workers=None):
+    '''
+    Get the annual revenues of many stocks. Payloads are read from
+    the store when possible; otherwise they are downloaded as raw
+    bytes and decoded and parsed in a process pool while the next
+    payloads download. At most two payloads per worker wait to be
+    parsed at once, so memory use does not grow with len(symbols).
+
+    Return a tuple (revenues, unresolved) where revenues is a 
+    pd.DataFrame with the columns symbol, year, revenue, and rule,
+    and unresolved is a list of the symbols with no financials or
+    with a year whose revenue could not be found.
+    '''
+    results = []
+    missing = []
+    max_pending = 2 * (max_workers or os.cpu_count() or 1)
+    with ProcessPoolExecutor(max_workers) as pool:
+        futures = deque()
+        for i, symbol in enumerate(symbols, 1):
+            print(f'Reading financials for {symbol} ({i}/{len(symbols)})...', end='\r')
+            if store.has(symbol):
+                results.append((symbol, None, _revenues_from_rows(
+                    store.get_rows(symbol), symbol, revenue_matcher)))
+                continue
+            body = api_utils.get_financials_as_reported_body(symbol)
+            if body:
+                if len(futures) == max_pending:
+                    results.append(futures.popleft().result())
+                futures.append(pool.submit(_parse_and_extract_revenues, symbol, 
+                                            body, revenue_matcher))
+            else:
+                missing.append(symbol)
+        for future in futures:
+            results.append(future.result())
+    sys.stdout.write("\033[K")
+
+    table = []
+    unresolved = set(missing)
+    for symbol, rows, revenues in results:
+        if rows is not None:
+            store.add(symbol, rows)
+        if not revenues:
+            unresolved.add(symbol)
+        for year, revenue, rule in revenues:
+            if revenue is None:
+                unresolved.add(symbol)
+            else:
+                table.append((symbol, year, revenue, rule))
+    revenues = pd.DataFrame(table, columns=['symbol', 'year', 'revenue', 'rule'])
+    return revenues, [symbol for symbol in symbols if symbol in unresolved]
@@ -1,6 +1,7 @@
 '''
 The following is a list of symbols that have not been accounted
-for in financials_reader's get_revenues()
+for in financials_reader's get_revenues(). The unresolved symbols
+returned by financials_reader.get_revenues_bulk() give an up-to-date list.
 '''
 
-stocks = '''WFC USB PBCT FITB NVR DHI NTRS TROW JPM ZION RF BK KEY VNO MS AXP DFS EMN BIO EXR CFG WEC SIVB REG PWR AES EFX GS'''
\ No newline at end of file
+stocks = '''WFC USB PBCT FITB NVR DHI NTRS TROW JPM ZION RF BK KEY VNO MS AXP DFS EMN BIO EXR CFG WEC SIVB REG PWR EFX GS'''
\ No newline at end of file
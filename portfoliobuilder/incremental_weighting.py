@@ -0,0 +1,229 @@
+'''
+A module for weighting a basket incrementally.
+
+The fundamentals, measures, and weight of each stock are kept in the
+database (see models.WeightingState) between runs. A run only
+refetches the fundamentals that are older than their TTL or whose
+company has released earnings since they were fetched; the weights
+are then recomputed from the kept measures, which takes milliseconds.
+'''
+import datetime
+
+import numpy as np
+import pandas as pd
+
+from portfoliobuilder import api_utils, warehouse
+from portfoliobuilder.models import WeightingState
+from portfoliobuilder.response_cache import DAY
+from portfoliobuilder.weighting import Value, ValueQuality
+
+
+# The weighting methods that can be run incrementally. The others
+# are already cheap (see weighting.py).
+INCREMENTAL_METHODS = ['value', 'value_quality']
+
+# Number of seconds the kept fundamentals are used before they are
+# refetched. The metrics include price ratios, so they are refetched
+# more often than the annual financials.
+METRICS_TTL = 7 * DAY
+FINANCIALS_TTL = 90 * DAY
+
+
+def _compact_metrics(response):
+    ''' Keep only the fields of a get_metrics() response that are used. '''
+    metrics = response['metric']
+    return {'metric': {field: metrics.get(field) for field in warehouse.METRIC_FIELDS}}
+
+
+def _compact_financials(response):
+    ''' Keep only the latest result of a get_financials() response, and its used fields. '''
+    if not response.get('results'):
+        return {'status': response.get('status'), 'results': []}
+    result = response['results'][0]
+    fields = list(warehouse.FINANCIALS_FIELDS) + ['reportPeriod']
+    return {'status': response.get('status'),
+            'results': [{field: result.get(field) for field in fields}]}
+
+
+def _measures_to_json(measures):
+    ''' Return a measures pd.Series as a dict, with NaN as None. '''
+    return {measure: None if pd.isna(value) else float(value)
+            for measure, value in measures.items()}
+
+
+def _measures_from_json(symbol, measures):
+    index = ValueQuality._empty_measures_series.index
+    return pd.Series(measures, index=index, dtype=float, name=symbol)
+
+
+def reported_since(since, today):
+    '''
+    Return a dict mapping the symbols that released earnings on or
+    after the date since and before the date today to the date of
+    their latest release, or None if the earnings calendar could not
+    be accessed. Releases on today are left for the next run, since
+    the fundamentals may not be updated yet.
+    '''
+    if since >= today:
+        return {}
+    response = api_utils.get_earnings_calendar(since.isoformat(),
+                                                (today - datetime.timedelta(days=1)).isoformat())
+    if response is None:
+        return None
+    releases = {}
+    for release in response.get('earningsCalendar') or []:
+        date = datetime.date.fromisoformat(release['date'])
+        releases[release['symbol']] = max(date, releases.get(release['symbol'], date))
+    return releases
+
+
+def _is_stale(fetched_at, ttl, symbol, reported, now):
+    '''
+    Return whether fundamentals fetched at fetched_at are older than
+    ttl seconds or than the symbol's latest release in reported (see
+    reported_since()). Fundamentals fetched on the day of a release
+    may predate it, so they are refetched.
+    '''
+    if fetched_at is None:
+        return True
+    if (now - fetched_at).total_seconds() > ttl:
+        return True
+    return reported is not None and symbol in reported and \
+            reported[symbol] >= fetched_at.date() and fetched_at.date() < now.date()
+
+
+def _symbols_to_fetch(states, symbols, uses_financials, now, refresh):
+    '''
+    Return a tuple (metrics_symbols, financials_symbols) of the symbols
+    whose kept fundamentals must be refetched.
+    '''
+    if refresh:
+        return list(symbols), list(symbols) if uses_financials else []
+    reported = None
+    fetch_dates = [state.metrics_fetched_at.date() for state in states.values()
+                    if state.metrics_fetched_at]
+    if fetch_dates:
+        reported = reported_since(min(fetch_dates), now.date())
+        if reported is None:
+            print('Could not get the earnings calendar; only fundamentals older ' + \
+                    'than their TTL will be refetched.')
+
+    metrics_symbols = []
+    financials_symbols = []
+    for symbol in symbols:
+        state = states.get(symbol)
+        if state is None or _is_stale(state.metrics_fetched_at, METRICS_TTL,
+                                        symbol, reported, now):
+            metrics_symbols.append(symbol)
+        if uses_financials and (state is None or _is_stale(state.financials_fetched_at,
+                                        FINANCIALS_TTL, symbol, reported, now)):
+            financials_symbols.append(symbol)
+    return metrics_symbols, financials_symbols
+
+
+def _update_states(basket, symbols, metrics, financials, now):
+    '''
+    Store the fetched responses in the basket's WeightingStates and
+    recompute the measures of the stocks whose fundamentals changed.
+    A failed fetch keeps the fundamentals from the previous run.
+
+    Return a dict mapping each symbol to its WeightingState.
+    '''
+    states = {state.symbol: state for state in basket.weighting_states}
+    # Forget stocks that were removed from the basket
+    basket.weighting_states = [states[symbol] for symbol in symbols if symbol in states]
+    failed_symbols = []
+    for symbol in symbols:
+        state = states.get(symbol)
+        if state is None:
+            state = WeightingState(symbol=symbol)
+            basket.weighting_states.append(state)
+            states[symbol] = state
+        changed = False
+        if symbol in metrics:
+            if metrics[symbol] and metrics[symbol].get('metric'):
+                state.metrics = _compact_metrics(metrics[symbol])
+                state.metrics_fetched_at = now
+                changed = True
+            else:
+                failed_symbols.append(symbol)
+        if symbol in financials:
+            if financials[symbol]:
+                state.financials = _compact_financials(financials[symbol])
+                state.financials_fetched_at = now
+                changed = True
+            else:
+                failed_symbols.append(symbol)
+        if changed and basket.weighting_method == 'value_quality':
+            try:
+                state.measures = _measures_to_json(ValueQuality._compute_measures(
+                                    symbol, state.metrics, state.financials))
+            except (IndexError, KeyError, TypeError, ZeroDivisionError) as e:
+                print(f'{type(e)} for {symbol}')
+                state.measures = None
+    if failed_symbols:
+        print('Could not refetch the fundamentals of the following symbols; ' + \
+                'their previous fundamentals are used if there are any: ' + \
+                ' '.join(sorted(set(failed_symbols))))
+    return states
+
+
+def _weights_from_states(weighting_method, symbols, states):
+    ''' Return the weights computed from the kept fundamentals or measures. '''
+    if weighting_method == 'value':
+        metrics = {symbol: states[symbol].metrics for symbol in symbols
+                    if states[symbol].metrics}
+        weights = Value._weights_from_responses(list(metrics), metrics)
+    else:
+        measures_series_list = [_measures_from_json(symbol, states[symbol].measures)
+                                for symbol in symbols if states[symbol].measures]
+        if not measures_series_list:
+            return {symbol: 0 for symbol in symbols}
+        data = ValueQuality._get_weighting_data(measures_series_list)
+        weights = data.loc['weight'].to_dict()
+    return {symbol: weights.get(symbol, 0) for symbol in symbols}
+
+
+def get_weights(basket, refresh=False, now=None):
+    '''
+    Get the weight of each stock in the basket like
+    basket_utils.get_weights(), refetching only the fundamentals
+    that have changed since the last run. The basket's
+    WeightingStates are updated (but not committed).
+
+    basket : models.Basket
+        A basket whose weighting_method is in INCREMENTAL_METHODS
+    refresh : bool
+        If True, refetch the fundamentals of every stock
+    now : datetime.datetime
+        The current time; defaults to datetime.datetime.now()
+
+    Return a dictionary like the one returned by basket_utils.get_weights().
+    '''
+    if basket.weighting_method not in INCREMENTAL_METHODS:
+        raise Exception('Invalid weighting method')
+    now = now or datetime.datetime.now()
+    symbols = [stock.symbol for stock in basket.stocks]
+    uses_financials = basket.weighting_method == 'value_quality'
+
+    states = {state.symbol: state for state in basket.weighting_states}
+    metrics_symbols, financials_symbols = _symbols_to_fetch(
+                                states, symbols, uses_financials, now, refresh)
+    print(f'Refetching the metrics of {len(metrics_symbols)} and the financials ' + \
+            f'of {len(financials_symbols)} of {len(symbols)} stocks.')
+    # The kept fundamentals of these stocks are out of date, so their
+    # cached responses are too
+    api_utils.invalidate_cache('get_metrics', [(symbol,) for symbol in metrics_symbols
+                                    if symbol in states and states[symbol].metrics_fetched_at])
+    api_utils.invalidate_cache('get_financials', [(symbol,) for symbol in financials_symbols
+                                    if symbol in states and states[symbol].financials_fetched_at])
+    metrics, financials = {}, {}
+    if metrics_symbols or financials_symbols:
+        metrics, financials = ValueQuality.fetch_responses(metrics_symbols,
+                                                           financials_symbols)
+
+    states = _update_states(basket, symbols, metrics, financials, now)
+    weights = _weights_from_states(basket.weighting_method, symbols, states)
+    for symbol, weight in weights.items():
+        states[symbol].weight = float(np.nan_to_num(weight))
+    return weights
@@ -0,0 +1,223 @@
+'''
+A module for keeping a ledger of what each basket holds.
+
+Every order placed for a basket is recorded as a Trade, and the fills
+of closed orders are fetched in bulk (one call per ORDERS_PER_CALL
+orders) and applied to the basket's Holdings (see models.py). The
+shares of a symbol that belong to each basket are then known locally,
+so a basket can be sold or rebalanced by quantity, in one batch,
+without closing positions other baskets share.
+
+Baskets bought before the ledger existed have no Trades; they are
+sold and rebalanced from the account's positions as before.
+'''
+import datetime
+
+from portfoliobuilder import api_utils
+from portfoliobuilder.models import Holding, Trade
+
+
+# Number of orders Alpaca returns per call
+ORDERS_PER_CALL = 500
+
+# Holdings with fewer shares than this are removed
+MIN_QTY = 1e-9
+
+# A sell within this fraction of a holding sells the whole holding,
+# so no dust is left behind by price moves
+SELL_ALL_FRACTION = 0.01
+
+
+def is_tracked(basket):
+    ''' Return whether the basket's holdings are kept in the ledger. '''
+    return bool(basket.trades)
+
+
+def open_trades(basket):
+    ''' Return the basket's Trades whose orders have not closed yet. '''
+    return [trade for trade in basket.trades if trade.status == 'placed']
+
+
+def basket_allocations(basket, symbols):
+    ''' Return allocations (see record_orders()) giving basket all of each order. '''
+    return {symbol: [(basket, 1.0)] for symbol in symbols}
+
+
+def record_orders(results, allocations, now=None):
+    '''
+    Record the placed orders in results as Trades of the baskets they
+    were placed for. The Trades are added to the baskets but not
+    committed.
+
+    results : list of orders.OrderResult
+    allocations : dict
+        Maps symbols to a list of (basket, share) tuples; see
+        models.Trade.share. Orders for other symbols are not recorded.
+
+    Return the list of new Trades.
+    '''
+    now = now or datetime.datetime.utcnow()
+    trades = []
+    for result in results:
+        if result.status != 'placed':
+            continue
+        for basket, share in allocations.get(result.symbol, []):
+            trade = Trade(symbol=result.symbol, side=result.side, order_id=result.order_id,
+                            share=share, status='placed', submitted_at=now)
+            basket.trades.append(trade)
+            trades.append(trade)
+    return trades
+
+
+def pending_trades(session):
+    ''' Return the Trades whose orders were not closed the last time they were checked. '''
+    return session.query(Trade).filter_by(status='placed').all()
+
+
+def get_closed_orders(after):
+    '''
+    Return a dict mapping ids to the closed orders submitted after the
+    datetime after (in UTC), or None if the orders could not be accessed.
+    '''
+    closed_orders = {}
+    after = after.strftime('%Y-%m-%dT%H:%M:%SZ')
+    while True:
+        page = api_utils.get_orders('closed', after, ORDERS_PER_CALL)
+        if page is None:
+            return None
+        closed_orders.update({order['id']: order for order in page})
+        if len(page) < ORDERS_PER_CALL:
+            return closed_orders
+        after = page[-1]['submitted_at']
+
+
+def _parse_time(timestamp):
+    ''' Return an Alpaca timestamp as a naive datetime in UTC, to the second. '''
+    if not timestamp:
+        return None
+    return datetime.datetime.strptime(timestamp[:19], '%Y-%m-%dT%H:%M:%S')
+
+
+def apply_fill(basket, holdings, symbol, qty, price):
+    '''
+    Add qty shares of symbol (remove them if qty is negative), filled
+    at price, to the basket's holding. Removed shares take their
+    average cost out of the cost basis.
+
+    holdings : dict
+        Maps symbols to the basket's Holdings; kept up to date
+    '''
+    holding = holdings.get(symbol)
+    if holding is None:
+        holding = Holding(symbol=symbol, qty=0.0, cost_basis=0.0)
+        basket.holdings.append(holding)
+        holdings[symbol] = holding
+    if qty > 0:
+        holding.cost_basis += qty * price
+    elif holding.qty > 0:
+        holding.cost_basis *= max(1 + qty / holding.qty, 0)
+    holding.qty += qty
+    if holding.qty < MIN_QTY:
+        basket.holdings.remove(holding)
+        del holdings[symbol]
+
+
+def apply_order(trades, order, holdings_by_basket=None):
+    '''
+    Close trades, the Trades of one order, with the order's final
+    state and apply its fills to their baskets' Holdings.
+
+    order : dict
+        An Alpaca order (or the order of a trade update) that is
+        filled, canceled, expired, or rejected
+    holdings_by_basket : dict
+        Maps baskets' ids to dicts like the holdings argument of
+        apply_fill(); kept up to date
+    '''
+    if holdings_by_basket is None:
+        holdings_by_basket = {}
+    filled_qty = float(order.get('filled_qty') or 0)
+    price = float(order.get('filled_avg_price') or 0)
+    for trade in trades:
+        trade.status = order['status']
+        trade.qty = (1 if trade.side == 'buy' else -1) * filled_qty * trade.share
+        trade.price = price
+        trade.filled_at = _parse_time(order.get('filled_at'))
+        if trade.qty:
+            basket = trade.basket
+            if basket.id not in holdings_by_basket:
+                holdings_by_basket[basket.id] = {holding.symbol: holding
+                                                    for holding in basket.holdings}
+            apply_fill(basket, holdings_by_basket[basket.id], trade.symbol, trade.qty, price)
+
+
+def sync_fills(trades):
+    '''
+    Apply the fills of the closed orders of trades to their baskets'
+    Holdings. Trades whose orders are still open are left for the
+    next sync.
+
+    trades : list of models.Trade
+        e.g., from pending_trades()
+
+    Return the number of Trades closed, or None if the orders could
+    not be accessed.
+    '''
+    pending = [trade for trade in trades if trade.status == 'placed']
+    if not pending:
+        return 0
+    # Allow for a difference between the local and Alpaca's clocks
+    after = min(trade.submitted_at for trade in pending) - datetime.timedelta(minutes=5)
+    closed_orders = get_closed_orders(after)
+    if closed_orders is None:
+        print('Could not get the status of orders. The ledger will be updated next time.')
+        return None
+
+    trades_by_order = {}
+    for trade in pending:
+        if trade.order_id in closed_orders:
+            trades_by_order.setdefault(trade.order_id, []).append(trade)
+    holdings_by_basket = {}
+    for order_id, order_trades in trades_by_order.items():
+        apply_order(order_trades, closed_orders[order_id], holdings_by_basket)
+    return sum(len(order_trades) for order_trades in trades_by_order.values())
+
+
+def holding_values(basket, positions):
+    '''
+    Return a dict mapping the symbols of the basket's holdings to
+    their market value at the current prices in positions (see
+    basket_utils.get_positions_by_symbol()). Symbols not in positions
+    are left out.
+    '''
+    return {holding.symbol: holding.qty * float(positions[holding.symbol]['current_price'])
+            for holding in basket.holdings if holding.symbol in positions}
+
+
+def sells_by_qty(trades, held_qty, positions):
+    '''
+    Turn the sells in trades (see basket_utils.plan_trades()) into
+    (symbol, notional, side, qty) sells of a number of shares at the
+    current prices in positions, no more than held_qty[symbol]. Sells
+    of symbols missing from held_qty or positions are left as they are.
+    '''
+    by_qty = []
+    for trade in trades:
+        symbol, notional, side = trade[:3]
+        if side != 'sell' or symbol not in held_qty or symbol not in positions:
+            by_qty.append(trade)
+            continue
+        qty = notional / float(positions[symbol]['current_price'])
+        if qty >= held_qty[symbol] * (1 - SELL_ALL_FRACTION):
+            qty = held_qty[symbol]
+        by_qty.append((symbol, notional, side, round(qty, 9)))
+    return by_qty
+
+
+def sell_orders(basket):
+    '''
+    Return (symbol, notional, 'sell', qty) orders selling every holding
+    of the basket, where notional is the holding's cost basis.
+    '''
+    return [(holding.symbol, round(holding.cost_basis, 2), 'sell', round(holding.qty, 9))
+            for holding in sorted(basket.holdings, key=lambda holding: holding.symbol)]
@@ -1,4 +1,5 @@
-from sqlalchemy import Column, ForeignKey, Integer, Float, Boolean, String
+from sqlalchemy import (Column, ForeignKey, Index, Integer, Float, Boolean, 
+    String, Date, DateTime, JSON)
 from sqlalchemy.orm import declarative_base
 from sqlalchemy.orm import relationship
 
@@ -14,6 +15,9 @@ class Basket(Base):
     weight = Column(Float)
 
     stocks = relationship('Stock', cascade='all, delete')
+    weighting_states = relationship('WeightingState', cascade='all, delete-orphan')
+    trades = relationship('Trade', cascade='all, delete-orphan', back_populates='basket')
+    holdings = relationship('Holding', cascade='all, delete-orphan')
 
 
 class Stock(Base):
@@ -24,3 +28,122 @@ class Stock(Base):
 
     symbol = Column(String)
 
+
+class MetricSnapshot(Base):
+    '''
+    The Finnhub metrics of a stock on the date as_of.
+    '''
+    __tablename__ = 'metric_snapshot'
+    __table_args__ = (Index('ix_metric_snapshot_symbol_as_of', 'symbol', 'as_of', 
+                            unique=True),)
+
+    id = Column(Integer, primary_key=True)
+    symbol = Column(String, nullable=False)
+    as_of = Column(Date, nullable=False)
+
+    market_cap = Column(Float)
+    pe_ttm = Column(Float)
+    ev_fcf_ttm = Column(Float)
+    ps_ttm = Column(Float)
+    pb_quarterly = Column(Float)
+    net_profit_margin_5y = Column(Float)
+    revenue_growth_5y = Column(Float)
+    ebitda_cagr_5y = Column(Float)
+    roe_ttm = Column(Float)
+    current_ratio_quarterly = Column(Float)
+
+
+class AnnualFinancials(Base):
+    '''
+    The Polygon annual financials of a stock for the fiscal year
+    ending on as_of (Polygon's reportPeriod).
+    '''
+    __tablename__ = 'annual_financials'
+    __table_args__ = (Index('ix_annual_financials_symbol_as_of', 'symbol', 'as_of', 
+                            unique=True),)
+
+    id = Column(Integer, primary_key=True)
+    symbol = Column(String, nullable=False)
+    as_of = Column(Date, nullable=False)
+
+    enterprise_value = Column(Float)
+    ebitda = Column(Float)
+    assets = Column(Float)
+    revenues = Column(Float)
+    ev_ebitda = Column(Float)
+    free_cash_flow = Column(Float)
+    return_on_average_assets = Column(Float)
+    return_on_invested_capital = Column(Float)
+    average_equity = Column(Float)
+    invested_capital_average = Column(Float)
+    total_liabilities = Column(Float)
+
+
+class WeightingState(Base):
+    '''
+    The fundamentals, measures, and weight of a stock in a basket
+    from the last time the basket's weights were computed. See
+    incremental_weighting.py.
+    '''
+    __tablename__ = 'weighting_state'
+    __table_args__ = (Index('ix_weighting_state_basket_id_symbol', 'basket_id', 'symbol',
+                            unique=True),)
+
+    id = Column(Integer, primary_key=True)
+    basket_id = Column(Integer, ForeignKey('basket.id'), nullable=False)
+    symbol = Column(String, nullable=False)
+
+    metrics_fetched_at = Column(DateTime)
+    financials_fetched_at = Column(DateTime)
+    # The fields of the API responses used by the weighting methods
+    metrics = Column(JSON)
+    financials = Column(JSON)
+    # The ValueQuality measures; None if they could not be computed
+    measures = Column(JSON)
+    weight = Column(Float)
+
+
+class Trade(Base):
+    '''
+    A basket's share of an order. An order netted across several
+    baskets (see portfolio.py) has one Trade per basket. See ledger.py.
+    '''
+    __tablename__ = 'trade'
+    __table_args__ = (Index('ix_trade_order_id_basket_id', 'order_id', 'basket_id',
+                            unique=True),
+                        Index('ix_trade_status', 'status'))
+
+    id = Column(Integer, primary_key=True)
+    basket_id = Column(Integer, ForeignKey('basket.id'), nullable=False)
+    symbol = Column(String, nullable=False)
+    side = Column(String, nullable=False)
+    order_id = Column(String, nullable=False)
+    # The fraction of the order's filled shares that belong to the
+    # basket; negative if the basket sells shares a buy order nets out
+    share = Column(Float, nullable=False)
+    # 'placed' until the order is closed, then the order's final status
+    status = Column(String, nullable=False)
+    submitted_at = Column(DateTime, nullable=False)
+    filled_at = Column(DateTime)
+    # The shares the basket gained (negative if lost) and their price
+    qty = Column(Float)
+    price = Column(Float)
+
+    basket = relationship('Basket', back_populates='trades')
+
+
+class Holding(Base):
+    '''
+    The shares of a symbol that belong to a basket and what they cost,
+    kept up to date from the basket's filled Trades. See ledger.py.
+    '''
+    __tablename__ = 'holding'
+    __table_args__ = (Index('ix_holding_basket_id_symbol', 'basket_id', 'symbol',
+                            unique=True),)
+
+    id = Column(Integer, primary_key=True)
+    basket_id = Column(Integer, ForeignKey('basket.id'), nullable=False)
+    symbol = Column(String, nullable=False)
+
+    qty = Column(Float, nullable=False)
+    cost_basis = Column(Float, nullable=False) # the total cost of qty shares
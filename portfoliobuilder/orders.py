@@ -0,0 +1,123 @@
+'''
+A module for submitting batches of orders to Alpaca.
+'''
+import sys
+import time
+import uuid
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from portfoliobuilder import api_utils
+
+
+# Number of orders in flight at once. The Alpaca rate limiter in
+# api_utils still decides how fast they are sent.
+MAX_WORKERS = 10
+
+# Number of times an order is tried before it is reported as failed
+MAX_ATTEMPTS = 3
+
+# Seconds to wait before the first retry; doubles after each retry
+BACKOFF = 0.5
+
+
+OrderResult = namedtuple('OrderResult', ['symbol', 'side', 'notional', 'status',
+                                            'order_id', 'latency', 'attempts', 'qty'],
+                            defaults=[None])
+
+'''
+OrderResult notes:
+- status is 'placed' or 'failed'
+- order_id is Alpaca's id for the order, None if the order failed
+- latency is the number of seconds from the first attempt until
+  the order was placed or given up on
+- qty is the number of shares ordered, None if the order was for
+  a notional amount
+'''
+
+
+def is_permanent_failure(status):
+    '''
+    Return whether an order that failed with the HTTP status would
+    fail again if retried, e.g., a 403 for insufficient buying power
+    or a 422 for an invalid order. A 429 and failures without a
+    response (status None) are transient.
+    '''
+    return status is not None and 400 <= status < 500 and status != 429
+
+
+def submit_order(symbol, notional, side, qty=None):
+    '''
+    Place a market order, retrying with backoff if it fails for a
+    transient reason (see is_permanent_failure()). If qty is given,
+    qty shares are ordered and notional is only reported.
+
+    Every attempt uses the same client_order_id. Before a retry,
+    Alpaca is asked whether an earlier attempt went through (e.g.,
+    if the connection dropped after the order was received), so the
+    order is never placed twice.
+
+    Return an OrderResult.
+    '''
+    client_order_id = str(uuid.uuid4())
+    start = time.perf_counter()
+    order = None
+    attempts = 0
+    while attempts < MAX_ATTEMPTS and not order:
+        if attempts:
+            time.sleep(BACKOFF * 2 ** (attempts - 1))
+            order = api_utils.get_order_by_client_order_id(client_order_id)
+        attempts += 1
+        if not order:
+            order = api_utils.place_order(symbol, notional, side,
+                                            client_order_id=client_order_id, qty=qty)
+            if not order and is_permanent_failure(api_utils.last_failure_status()):
+                break
+    latency = time.perf_counter() - start
+
+    if order:
+        return OrderResult(symbol, side, notional, 'placed', order['id'],
+                            latency, attempts, qty)
+    return OrderResult(symbol, side, notional, 'failed', None, latency, attempts, qty)
+
+
+def submit_orders(orders):
+    '''
+    Submit orders concurrently. The sells are submitted as one batch,
+    and every one of them is placed or given up on before the buys
+    are submitted, so that the buys can use the cash the sells free.
+
+    orders : list of tuples
+        Each tuple has the form (symbol, notional, side), like the
+        arguments of api_utils.place_order(), or (symbol, notional,
+        side, qty) to order qty shares
+
+    Return a list of OrderResults in the same order as orders.
+    '''
+    results = [None] * len(orders)
+    num_submitted = 0
+    with ThreadPoolExecutor(MAX_WORKERS) as pool:
+        for side in ('sell', 'buy'):
+            indices = [i for i, order in enumerate(orders) if order[2] == side]
+            futures = [pool.submit(submit_order, *orders[i]) for i in indices]
+            for i, future in zip(indices, futures):
+                results[i] = future.result()
+                num_submitted += 1
+                print(f'Submitted {num_submitted}/{len(orders)} orders...', end='\r')
+    sys.stdout.write('\033[K')
+    return results
+
+
+def failed(results):
+    ''' Return the OrderResults in results whose orders failed. '''
+    return [result for result in results if result.status == 'failed']
+
+
+def print_summary(results):
+    ''' Print the number of orders placed and list those that failed. '''
+    failed_results = failed(results)
+    print(f'{len(results) - len(failed_results)} of {len(results)} orders placed.')
+    for result in failed_results:
+        amount = f'${result.notional:.2f}' if result.qty is None else f'{result.qty} shares'
+        print(f'Order to {result.side} {amount} of ' + \
+                f'{result.symbol} failed after {result.attempts} attempts.')
@@ -0,0 +1,203 @@
+'''
+A module for trading several baskets as one portfolio.
+
+The goal market value of each symbol is summed across the active
+baskets and compared to one snapshot of the account's positions, so
+a symbol held by several baskets gets one netted order rather than
+one order per basket. The filled shares of a netted order are split
+among the baskets whose holdings are in the ledger (see ledger.py)
+by how far each is from its goal.
+'''
+from portfoliobuilder import api_utils, basket_utils, ledger, orders
+
+
+def get_basket_goal_values(baskets, acc_value, refresh=False):
+    '''
+    Return a dict mapping each basket's id to a dict mapping its
+    symbols to the market value, in dollars, they should have in it.
+
+    acc_value : float
+        The equity of the account
+    refresh : bool
+        See basket_utils.get_basket_weights()
+    '''
+    basket_goal_values = {}
+    for basket in baskets:
+        print(f'Weighting Basket{basket.id}...')
+        weights = basket_utils.get_basket_weights(basket, refresh)
+        basket_value = acc_value * basket.weight / 100
+        basket_goal_values[basket.id] = {symbol: basket_value * weight 
+                                            for symbol, weight in weights.items()}
+    return basket_goal_values
+
+
+def get_goal_values(baskets, acc_value, refresh=False):
+    '''
+    Return a dict mapping each symbol in baskets to the market value,
+    in dollars, it should have across all of them. See
+    get_basket_goal_values() for the arguments.
+    '''
+    return _total_goal_values(get_basket_goal_values(baskets, acc_value, refresh))
+
+
+def _total_goal_values(basket_goal_values):
+    goal_values = {}
+    for basket_goals in basket_goal_values.values():
+        for symbol, goal in basket_goals.items():
+            goal_values[symbol] = goal_values.get(symbol, 0) + goal
+    return goal_values
+
+
+def allocate_trades(trades, baskets, basket_goal_values, positions):
+    '''
+    Split each of the netted trades among the baskets whose holdings
+    are in the ledger. Each basket is allocated its own gap (how far its
+    holding of the symbol is from its goal) as a fraction of the
+    trade's notional, signed by the trade's side, so a basket that is
+    over its goal gets a negative share of a buy (see
+    models.Trade.share). The baskets whose gap is in the trade's
+    direction are capped, together, at the trade's notional plus what
+    the baskets on the other side give up. The rest of the trade is
+    left unallocated, for the baskets whose holdings are not in the
+    ledger.
+
+    Return allocations like those taken by ledger.record_orders().
+    '''
+    tracked = [basket for basket in baskets if ledger.is_tracked(basket)]
+    curr_values = {basket.id: ledger.holding_values(basket, positions) for basket in tracked}
+    allocations = {}
+    for symbol, notional, side in trades:
+        if not notional:
+            continue
+        signed_notional = notional if side == 'buy' else -notional
+        gaps = [(basket, basket_goal_values.get(basket.id, {}).get(symbol, 0) - 
+                    curr_values[basket.id].get(symbol, 0)) for basket in tracked]
+        with_trade = sum(abs(gap) for _, gap in gaps if gap * signed_notional > 0)
+        against_trade = sum(abs(gap) for _, gap in gaps if gap * signed_notional < 0)
+        scale = 1
+        if with_trade > notional + against_trade:
+            scale = (notional + against_trade) / with_trade
+        shares = [(basket, (gap * scale if gap * signed_notional > 0 else gap) / signed_notional)
+                    for basket, gap in gaps if abs(gap) >= 0.01]
+        if shares:
+            allocations[symbol] = shares
+    return allocations
+
+
+def plan_portfolio(baskets, sold_symbols=(), min_trade_value=None, min_drift=None,
+                    refresh=False):
+    '''
+    Compute the netted trades that bring every symbol in baskets to
+    its goal market value, without placing any orders.
+
+    baskets : list of models.Basket
+        The baskets the account should hold, e.g., every active basket
+    sold_symbols : iterable
+        Symbols that should be sold down to their goal market value in
+        baskets (0 if they are in none of them), e.g., the symbols of
+        a basket being sold. Symbols in neither baskets nor
+        sold_symbols are never traded.
+
+    See basket_utils.plan_trades() for the other arguments and the
+    return value. Return None if the account could not be accessed.
+    '''
+    planned = _plan_portfolio(baskets, sold_symbols, min_trade_value, min_drift, refresh)
+    if planned is None:
+        return
+    return planned[0]
+
+
+def _plan_portfolio(baskets, sold_symbols=(), min_trade_value=None, min_drift=None,
+                    refresh=False):
+    '''
+    Return a tuple (trades, allocations) where trades is returned by
+    plan_portfolio() and allocations by allocate_trades(), or None if
+    the account could not be accessed.
+    '''
+    account = api_utils.get_account()
+    positions = basket_utils.get_positions_by_symbol()
+    if not account or positions is None:
+        print('Could not access account. Exiting. Try again or ensure API keys are correct.')
+        return
+    acc_value = float(account['equity'])
+
+    basket_goal_values = get_basket_goal_values(baskets, acc_value, refresh)
+    goal_values = _total_goal_values(basket_goal_values)
+    for symbol in sold_symbols:
+        goal_values.setdefault(symbol, 0)
+    curr_values = {symbol: positions[symbol]['market_value']
+                    for symbol in goal_values if symbol in positions}
+    trades = basket_utils.plan_trades(goal_values, curr_values, min_trade_value, min_drift)
+    return trades, allocate_trades(trades, baskets, basket_goal_values, positions)
+
+
+def rebalance_portfolio(baskets, refresh=False):
+    '''
+    Rebalance all of baskets at once with one netted order per symbol.
+    Each order is recorded in the ledger of the baskets it is for.
+
+    Return a list of orders.OrderResult, one per order, or None
+    if no orders were submitted.
+    '''
+    planned = _plan_portfolio(baskets, refresh=refresh)
+    if planned is None:
+        return
+    trades, allocations = planned
+    results = orders.submit_orders(trades)
+    ledger.record_orders(results, allocations)
+    return results
+
+
+def sell_basket(basket, active_baskets):
+    '''
+    Sell basket without selling what the other active baskets hold.
+
+    If the basket's holdings are in the ledger, exactly its shares of
+    each symbol are sold in one batch (see ledger.sell_orders()); if
+    some of its orders have not closed yet, its holdings are not
+    known, so nothing is sold. Otherwise, positions in symbols that no other active basket holds
+    are closed, and positions in shared symbols are brought to the
+    other baskets' goal market value with one netted order each; only
+    the baskets that share a symbol with basket are weighted.
+
+    Return a tuple (results, closed_symbols, failed_symbols) where
+    results is a list of orders.OrderResult for the orders placed,
+    closed_symbols lists the symbols whose position was closed, and
+    failed_symbols those whose position could not be closed. Return
+    None if nothing was sold because the account could not be
+    accessed or the basket has open orders.
+    '''
+    if ledger.is_tracked(basket):
+        num_open = len(ledger.open_trades(basket))
+        if num_open:
+            print(f'Basket{basket.id} has {num_open} orders that have not closed yet, ' + \
+                    'so its holdings are not known. Try again once they have closed.')
+            return
+        sells = ledger.sell_orders(basket)
+        results = orders.submit_orders(sells)
+        ledger.record_orders(results, ledger.basket_allocations(
+                                            basket, [sell[0] for sell in sells]))
+        return results, [], []
+
+    symbols = {stock.symbol for stock in basket.stocks}
+    sharing_baskets = [other for other in active_baskets if other.id != basket.id and
+                        symbols.intersection(stock.symbol for stock in other.stocks)]
+    shared_symbols = symbols.intersection(stock.symbol for other in sharing_baskets
+                                            for stock in other.stocks)
+
+    results = []
+    if shared_symbols:
+        trades = plan_portfolio(sharing_baskets, sold_symbols=shared_symbols)
+        if trades is None:
+            return
+        # Leave the other symbols of the sharing baskets alone
+        results = orders.submit_orders([trade for trade in trades 
+                                        if trade[0] in shared_symbols])
+
+    closed_symbols, failed_symbols = [], []
+    for symbol in sorted(symbols - shared_symbols):
+        if api_utils.close_position(symbol):
+            closed_symbols.append(symbol)
+        else:
+            failed_symbols.append(symbol)
+    return results, closed_symbols, failed_symbols
@@ -0,0 +1,97 @@
+'''
+A thread-safe token-bucket rate limiter for the API providers.
+'''
+import threading
+import time
+
+
+class TokenBucket():
+    '''
+    A bucket that holds up to capacity tokens and gains rate tokens
+    per second. Each call takes one token; when the bucket is empty,
+    the caller waits until its token has been added.
+
+    Tokens are reserved under a lock, so concurrent callers are
+    spaced out in the order they arrive rather than all waking up
+    at once.
+
+    When a provider rejects calls for exceeding its rate limit,
+    slow_down() halves the rate (but not below MIN_RATE_FRACTION of
+    the configured rate), and each successful call then restores
+    RECOVERY_STEP of the configured rate.
+    '''
+    MIN_RATE_FRACTION = 1 / 8
+    RECOVERY_STEP = 0.05
+
+    def __init__(self, rate, capacity):
+        '''
+        rate : float
+            Number of tokens added per second
+        capacity : float
+            Maximum number of tokens, i.e., the size of a burst
+        '''
+        self.rate = rate
+        self.max_rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def configure(self, rate, capacity):
+        ''' Change the rate and capacity of the bucket. '''
+        with self._lock:
+            self._refill()
+            self.rate = rate
+            self.max_rate = rate
+            self.capacity = capacity
+            self._tokens = min(self._tokens, capacity)
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._last_refill
+        self._tokens = min(self.capacity, self._tokens + elapsed * self.rate)
+        self._last_refill = now
+
+    def reserve(self, timeout=None):
+        '''
+        Take a token and return the number of seconds the caller
+        must wait before using it. Does not sleep. Return None,
+        without taking a token, if the wait would be longer than
+        timeout seconds.
+        '''
+        with self._lock:
+            self._refill()
+            wait = max(1 - self._tokens, 0) / self.rate
+            if timeout is not None and wait > timeout:
+                return None
+            self._tokens -= 1
+            return wait
+
+    def acquire(self, timeout=None):
+        '''
+        Take a token, sleeping until it is available. Return the
+        number of seconds slept, or None if the token would not be
+        available within timeout seconds (see reserve()).
+        '''
+        wait = self.reserve(timeout)
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    def slow_down(self, pause=0):
+        '''
+        Halve the rate and make the next caller wait at least pause
+        seconds (e.g., a server's Retry-After).
+        '''
+        with self._lock:
+            self._refill()
+            self.rate = max(self.rate / 2, self.max_rate * self.MIN_RATE_FRACTION)
+            self._tokens = min(self._tokens, -pause * self.rate)
+
+    def recover(self):
+        ''' Move the rate back toward the configured rate after a successful call. '''
+        if self.rate >= self.max_rate:
+            return
+        with self._lock:
+            self._refill()
+            self.rate = min(self.max_rate, self.rate + self.max_rate * self.RECOVERY_STEP)
@@ -0,0 +1,131 @@
+'''
+A persistent, on-disk cache for the JSON responses of API calls.
+'''
+import json
+import sqlite3
+import threading
+import time
+
+
+DAY = 24 * 60 * 60
+
+
+class ResponseCache():
+    '''
+    An LRU cache of JSON responses stored in a SQLite file.
+
+    Entries are keyed by endpoint and call arguments. Each endpoint
+    has its own time to live (TTL); endpoints without a TTL are never
+    cached. When the cache holds more than max_entries entries, the
+    least recently used ones are evicted.
+    '''
+    _EVICT_EVERY = 100 # number of puts between evictions
+
+    def __init__(self, path, ttls, max_entries=50000):
+        '''
+        path : str
+            Path to the SQLite file that stores the cache
+        ttls : dict
+            Maps an endpoint name to the number of seconds its
+            responses stay fresh
+        max_entries : int
+            The maximum number of responses kept on disk
+        '''
+        self.path = path
+        self.ttls = ttls
+        self.max_entries = max_entries
+        self.enabled = True
+        self.hits = 0
+        self.misses = 0
+        self._puts = 0
+        self._lock = threading.Lock()
+        self._connection = None
+
+    def _connect(self):
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.path, check_same_thread=False)
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS responses ('
+                'key TEXT PRIMARY KEY, endpoint TEXT, stored_at REAL, '
+                'last_used REAL, body TEXT)')
+            self._connection.execute(
+                'CREATE INDEX IF NOT EXISTS responses_last_used '
+                'ON responses (last_used)')
+        return self._connection
+
+    @staticmethod
+    def make_key(endpoint, args, kwargs):
+        ''' Return a string that identifies a call to endpoint. '''
+        return json.dumps([endpoint, list(args), kwargs], sort_keys=True, default=str)
+
+    def caches(self, endpoint):
+        ''' Return True if responses from endpoint are cached. '''
+        return self.enabled and endpoint in self.ttls
+
+    def get(self, endpoint, key):
+        '''
+        Return the cached response for key, or None if there is no
+        fresh entry for it.
+        '''
+        if not self.caches(endpoint):
+            return None
+        now = time.time()
+        with self._lock:
+            connection = self._connect()
+            row = connection.execute(
+                'SELECT stored_at, body FROM responses WHERE key = ?',
+                (key,)).fetchone()
+            if row is None or row[0] + self.ttls[endpoint] < now:
+                self.misses += 1
+                return None
+            connection.execute('UPDATE responses SET last_used = ? WHERE key = ?',
+                                (now, key))
+            connection.commit()
+            self.hits += 1
+        return json.loads(row[1])
+
+    def put(self, endpoint, key, response):
+        ''' Store response under key. Responses that are None are not stored. '''
+        if response is None or not self.caches(endpoint):
+            return
+        now = time.time()
+        body = json.dumps(response)
+        with self._lock:
+            connection = self._connect()
+            connection.execute(
+                'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)',
+                (key, endpoint, now, now, body))
+            self._puts += 1
+            if self._puts % self._EVICT_EVERY == 0:
+                self._evict(connection)
+            connection.commit()
+
+    def delete(self, keys):
+        ''' Delete the entries for keys, if there are any. '''
+        with self._lock:
+            connection = self._connect()
+            connection.executemany('DELETE FROM responses WHERE key = ?',
+                                    [(key,) for key in keys])
+            connection.commit()
+
+    def _evict(self, connection):
+        ''' Delete the least recently used entries beyond max_entries. '''
+        connection.execute(
+            'DELETE FROM responses WHERE key IN (SELECT key FROM responses '
+            'ORDER BY last_used DESC LIMIT -1 OFFSET ?)', (self.max_entries,))
+
+    def clear(self):
+        ''' Delete every entry and reset the hit and miss counters. '''
+        with self._lock:
+            connection = self._connect()
+            connection.execute('DELETE FROM responses')
+            connection.commit()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        ''' Return a dict with the number of hits, misses, and entries. '''
+        with self._lock:
+            connection = self._connect()
+            entries = connection.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+        return {'hits': self.hits, 'misses': self.misses, 'entries': entries}
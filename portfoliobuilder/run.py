@@ -1,3 +1,14 @@
+'''
+The entry point of the command line app.
+
+Run without arguments for the interactive prompt, with a command to
+run just that command (e.g., portfoliobuilder buy 3 or portfoliobuilder
+rebalance --all), or with --file to run a file of commands, one per
+line. Each run uses one database session, and one set of caches and
+HTTP connections, for all of its commands.
+'''
+import argparse
+import sys
 
 from portfoliobuilder import commands
 
@@ -17,32 +28,149 @@ command_executables = {
     'sellbasket': commands.SellBasket,
     'deletebasket': commands.DeleteBasket,
     'rebalance': commands.Rebalance,
+    'planrebalance': commands.PlanRebalance,
+    'rebalanceall': commands.RebalanceAll,
+    'planrebalanceall': commands.PlanRebalanceAll,
     'listindices': commands.ListIndices,
+    'storefundamentals': commands.StoreFundamentals,
+    'exportfundamentals': commands.ExportFundamentals,
+    'stats': commands.Stats,
     'quit': commands.Quit
 }
 
 
 def parse_user_input(user_input):
+    '''
+    Execute a command entered like at the prompt. Return False if
+    the command is unknown, its arguments could not be read, or it
+    failed (see commands.py).
+    '''
     try:
         commands.user_input = user_input
         command = user_input.split(' ')[0]
-        command_executables[command].execute()
+        return command_executables[command].execute() is not False
     except (IndexError, KeyError) as error:
         print(f'Invalid command. {type(error)}')
+        return False
+
 
+def run_prompt():
+    ''' Read and execute commands until the user quits. '''
+    print("Welcome to the portfoliobuilder command line application. Enter " +
+        "'help' to see commands. Enter 'quit' to quit, or kill with CTRL+C.")
+    try:
+        user_input = ''
+        while True:
+            user_input = input('> ')
+            if user_input == 'quit':
+                break
+            parse_user_input(user_input)
+    except EOFError:
+        pass
 
-print("Welcome to the portfoliobuilder command line application. Enter " +
-    "'help' to see commands. Enter 'quit' to quit, or kill with CTRL+C.")
 
-commands.setup_db()
+def run_lines(lines):
+    '''
+    Execute the commands in lines, one per line, skipping blank lines
+    and lines starting with #. A quit line stops the run. A command
+    that raises an exception is reported and the run goes on.
 
-try:
-    user_input = ''
-    while True:
-        user_input = input('> ')
+    Return the number of commands that failed.
+    '''
+    num_failed = 0
+    for line_number, line in enumerate(lines, 1):
+        user_input = ' '.join(line.split())
+        if not user_input or user_input.startswith('#'):
+            continue
         if user_input == 'quit':
-            command_executables['quit'].execute()
             break
-        parse_user_input(user_input)
-except KeyboardInterrupt:
-    command_executables['quit'].execute()
+        print(f'> {user_input}')
+        try:
+            succeeded = parse_user_input(user_input)
+        except Exception as error:
+            print(f'{type(error).__name__}: {error}')
+            succeeded = False
+        if not succeeded:
+            print(f'(line {line_number} failed)')
+            num_failed += 1
+    return num_failed
+
+
+def run_file(path):
+    ''' Execute the commands in the file at path ('-' for stdin); see run_lines(). '''
+    if path == '-':
+        return run_lines(sys.stdin)
+    with open(path) as f:
+        return run_lines(f)
+
+
+################# Arguments #################
+
+# The commands with their own arguments; every other command takes
+# the arguments it takes at the prompt
+_SHORTCUTS = {'buy': 'buybasket', 'sell': 'sellbasket', 'inspect': 'inspectbasket'}
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(prog='portfoliobuilder',
+        description='Build and maintain baskets of stocks. Run without arguments ' + \
+                    'for the interactive prompt. See docs/commands.md for the commands.')
+    parser.add_argument('-f', '--file',
+        help="run the commands in FILE, one per line like at the prompt ('-' for stdin)")
+    subparsers = parser.add_subparsers(dest='command', metavar='<command>')
+
+    for shortcut, command in _SHORTCUTS.items():
+        subparser = subparsers.add_parser(shortcut, help=f'same as {command}')
+        subparser.add_argument('basket_id', type=int)
+
+    for command, description in [('rebalance', 'rebalance a basket or every active basket'),
+                                    ('planrebalance', 'list the trades rebalance would place')]:
+        subparser = subparsers.add_parser(command, help=description)
+        target = subparser.add_mutually_exclusive_group(required=True)
+        target.add_argument('basket_id', type=int, nargs='?')
+        target.add_argument('--all', action='store_true', help='every active basket at once')
+        subparser.add_argument('--full', action='store_true',
+                                help='download the fundamentals of every stock again')
+
+    for command in command_executables:
+        if command in ('rebalance', 'planrebalance', 'quit'):
+            continue
+        subparser = subparsers.add_parser(command, help='see docs/commands.md')
+        subparser.add_argument('args', nargs='*')
+    return parser
+
+
+def to_user_input(args):
+    ''' Return the command, as entered at the prompt, given by the parsed args. '''
+    if args.command in _SHORTCUTS:
+        return f'{_SHORTCUTS[args.command]} {args.basket_id}'
+    if args.command in ('rebalance', 'planrebalance'):
+        words = [args.command + 'all'] if args.all else [args.command, str(args.basket_id)]
+        return ' '.join(words + (['full'] if args.full else []))
+    return ' '.join([args.command] + args.args)
+
+
+def main(argv=None):
+    '''
+    Run the app with the command line arguments argv (defaults to
+    sys.argv[1:]). Return the exit status: 1 if a command failed.
+    '''
+    args = make_parser().parse_args(argv)
+    commands.setup_db()
+    status = 0
+    try:
+        if args.file:
+            status = 1 if run_file(args.file) else 0
+        if args.command:
+            status = max(status, 0 if parse_user_input(to_user_input(args)) else 1)
+        if not args.file and not args.command:
+            run_prompt()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        command_executables['quit'].execute()
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,209 @@
+'''
+A module for tracking orders with Alpaca's trade_updates stream.
+
+A TradeUpdates subscriber holds one WebSocket connection in a
+background thread and collects the orders that close (are filled,
+canceled, expired, or rejected) as Alpaca pushes them. The collected
+orders are applied to the ledger (see ledger.py) in batches by the
+thread that owns the database session, so no order is polled for.
+
+Example:
+    with trade_stream.tracking_fills(session):
+        results = basket_utils.buy_basket(basket)
+'''
+import asyncio
+import contextlib
+import json
+import sys
+import threading
+
+import aiohttp
+
+from portfoliobuilder import alpaca_headers, alpaca_stream_endpoint, ledger
+from portfoliobuilder.models import Trade
+
+
+# The trade update events after which an order is closed
+CLOSED_EVENTS = {'fill', 'canceled', 'expired', 'rejected'}
+
+# Seconds to wait for the stream to connect, and for the orders
+# placed in tracking_fills() to close
+CONNECT_TIMEOUT = 5
+FILL_TIMEOUT = 10
+
+# Number of order ids looked up per query when applying updates
+BATCH_SIZE = 500
+
+
+class TradeUpdates():
+    '''
+    A subscriber to the trade_updates stream. start() connects in a
+    background thread; wait() and apply() are called from the thread
+    that owns the database session.
+    '''
+    def __init__(self, url=alpaca_stream_endpoint, key=None, secret=None):
+        '''
+        url defaults to Alpaca's paper trading stream and can be
+        pointed at a local server for testing. key and secret
+        default to the linked Alpaca account's.
+        '''
+        self.url = url
+        self.key = alpaca_headers['APCA-API-KEY-ID'] if key is None else key
+        self.secret = alpaca_headers['APCA-API-SECRET-KEY'] if secret is None else secret
+        self._closed_orders = {} # maps ids to closed orders not yet applied
+        self._closed_ids = set() # the ids of every closed order seen
+        self._condition = threading.Condition()
+        self._ready = threading.Event() # set once subscribed or disconnected
+        self.listening = False
+        self._thread = None
+        self._loop = None
+        self._ws = None
+
+    def start(self, timeout=CONNECT_TIMEOUT):
+        '''
+        Connect and subscribe to trade_updates in a background thread.
+        Return True once subscribed, or False if that did not happen
+        within timeout seconds.
+        '''
+        self._thread = threading.Thread(target=lambda: asyncio.run(self._listen()),
+                                        daemon=True)
+        self._thread.start()
+        if self._ready.wait(timeout) and self.listening:
+            return True
+        self.stop()
+        return False
+
+    def stop(self):
+        ''' Close the connection and wait for the background thread to end. '''
+        if self._loop and self._ws and not self._loop.is_closed():
+            try:
+                asyncio.run_coroutine_threadsafe(self._ws.close(), self._loop)
+            except RuntimeError: # the loop already stopped
+                pass
+        if self._thread:
+            self._thread.join(CONNECT_TIMEOUT)
+
+    async def _listen(self):
+        self._loop = asyncio.get_running_loop()
+        try:
+            async with aiohttp.ClientSession() as session:
+                async with session.ws_connect(self.url, heartbeat=30) as ws:
+                    self._ws = ws
+                    if not await self._subscribe(ws):
+                        return
+                    self.listening = True
+                    self._ready.set()
+                    while True:
+                        message = await self._receive(ws)
+                        if message is None:
+                            return
+                        self._handle(message)
+        except (aiohttp.ClientError, asyncio.TimeoutError, OSError, ValueError):
+            pass
+        finally:
+            self.listening = False
+            self._ready.set()
+
+    async def _subscribe(self, ws):
+        ''' Authenticate and listen to trade_updates. Return whether both succeeded. '''
+        await ws.send_json({'action': 'auth', 'key': self.key, 'secret': self.secret})
+        reply = await self._receive(ws)
+        if not reply or reply['data'].get('status') != 'authorized':
+            print('Could not authenticate with the trade updates stream.')
+            return False
+        await ws.send_json({'action': 'listen', 'data': {'streams': ['trade_updates']}})
+        reply = await self._receive(ws)
+        return bool(reply) and 'trade_updates' in reply['data'].get('streams', [])
+
+    @staticmethod
+    async def _receive(ws):
+        '''
+        Return the next message as a dict, or None if the connection
+        was closed. Alpaca sends some messages as binary frames.
+        '''
+        message = await ws.receive()
+        if message.type not in (aiohttp.WSMsgType.TEXT, aiohttp.WSMsgType.BINARY):
+            return None
+        return json.loads(message.data)
+
+    def _handle(self, message):
+        if message.get('stream') != 'trade_updates':
+            return
+        if message['data']['event'] not in CLOSED_EVENTS:
+            return
+        order = message['data']['order']
+        with self._condition:
+            self._closed_orders[order['id']] = order
+            self._closed_ids.add(order['id'])
+            self._condition.notify_all()
+
+    def wait(self, order_ids, timeout=FILL_TIMEOUT):
+        '''
+        Block until every order in order_ids has closed, or for at most
+        timeout seconds. Return the set of ids of the orders still open.
+        '''
+        order_ids = set(order_ids)
+        with self._condition:
+            self._condition.wait_for(lambda: order_ids <= self._closed_ids, timeout)
+            return order_ids - self._closed_ids
+
+    def apply(self, session):
+        '''
+        Apply the orders that closed since the last call to their
+        Trades in the ledger, looking the Trades up BATCH_SIZE orders
+        at a time. Closed orders with no pending Trade (e.g., placed
+        outside portfoliobuilder) are ignored.
+
+        Return a dict mapping the final statuses of the applied
+        orders (e.g., 'filled' or 'rejected') to their number.
+        '''
+        with self._condition:
+            closed_orders = self._closed_orders
+            self._closed_orders = {}
+        order_ids = list(closed_orders)
+        statuses = {}
+        holdings_by_basket = {}
+        for i in range(0, len(order_ids), BATCH_SIZE):
+            trades = session.query(Trade).filter(Trade.status == 'placed',
+                                    Trade.order_id.in_(order_ids[i:i + BATCH_SIZE])).all()
+            trades_by_order = {}
+            for trade in trades:
+                trades_by_order.setdefault(trade.order_id, []).append(trade)
+            for order_id, order_trades in trades_by_order.items():
+                order = closed_orders[order_id]
+                ledger.apply_order(order_trades, order, holdings_by_basket)
+                statuses[order['status']] = statuses.get(order['status'], 0) + 1
+        session.flush()
+        return statuses
+
+
+@contextlib.contextmanager
+def tracking_fills(session, timeout=FILL_TIMEOUT, url=alpaca_stream_endpoint):
+    '''
+    Subscribe to trade_updates for the duration of a with block. After
+    the block, wait up to timeout seconds for the orders placed in it
+    to close and apply them to the ledger. Orders still open then, or
+    all of them if the stream could not be connected, are left for
+    ledger.sync_fills().
+    '''
+    updates = TradeUpdates(url)
+    connected = updates.start()
+    if not connected:
+        print('Could not connect to the trade updates stream. Fills will be fetched later.')
+    previous_ids = {trade.order_id for trade in ledger.pending_trades(session)}
+    try:
+        yield updates
+        if connected:
+            order_ids = {trade.order_id for trade in ledger.pending_trades(session)}
+            order_ids -= previous_ids
+            if order_ids:
+                print(f'Waiting for {len(order_ids)} orders to fill...', end='\r')
+            open_ids = updates.wait(order_ids, timeout)
+            statuses = updates.apply(session)
+            if order_ids:
+                sys.stdout.write('\033[K')
+                summary = ', '.join(f'{count} {status}' 
+                                    for status, count in sorted(statuses.items()))
+                print(f'Orders closed: {summary or "none"}; {len(open_ids)} still open.')
+    finally:
+        updates.stop()
@@ -1,6 +1,8 @@
 import sys
+import time
 
 from portfoliobuilder import api_utils
+from portfoliobuilder.response_cache import DAY
 
 
 def has_num_args(user_input, num_args):
@@ -17,17 +19,49 @@ def has_num_args(user_input, num_args):
 
 ################# Functions that use api_utils #################
 
+# Maps each symbol to its Alpaca asset. Built from api_utils.get_assets(),
+# whose response is cached on disk, and rebuilt after _ASSET_INDEX_TTL.
+_asset_index = {}
+_asset_index_built_at = 0
+_ASSET_INDEX_TTL = DAY
+
+def get_asset_index():
+    '''
+    Return a dict mapping each symbol to its Alpaca asset, or an
+    empty dict if the asset list could not be downloaded.
+    '''
+    global _asset_index, _asset_index_built_at
+    if time.time() - _asset_index_built_at > _ASSET_INDEX_TTL:
+        assets = api_utils.get_assets()
+        if not assets:
+            return {}
+        _asset_index = {asset['symbol']: asset for asset in assets}
+        _asset_index_built_at = time.time()
+    return _asset_index
+
+def is_tradable(symbol, asset_index=None):
+    '''
+    Return True if symbol is tradable in Alpaca. Falls back to
+    a call per symbol if the asset index is unavailable.
+
+    asset_index : dict
+        From get_asset_index(), so a loop over symbols downloads the
+        asset list at most once; fetched if not given
+    '''
+    if asset_index is None:
+        asset_index = get_asset_index()
+    if asset_index:
+        asset = asset_index.get(symbol)
+    else:
+        asset = api_utils.get_asset(symbol)
+    return bool(asset and asset['tradable'])
+
 def tradable_symbols_from(symbols):
     ''' 
     Return the given list of symbols less the ones that aren't tradable. 
     '''
-    tradable_symbols = []
-    for symbol in symbols:
-        print(f'Determining whether {symbol} is tradable...', end=f'\r')
-        asset = api_utils.get_asset(symbol)
-        if asset:
-            is_tradable = asset['tradable']
-            if is_tradable:
-                tradable_symbols.append(symbol)
+    print('Determining which symbols are tradable...', end='\r')
+    asset_index = get_asset_index()
+    tradable_symbols = [symbol for symbol in symbols if is_tradable(symbol, asset_index)]
     sys.stdout.write("\033[K")
     return tradable_symbols
\ No newline at end of file
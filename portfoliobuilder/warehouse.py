@@ -0,0 +1,173 @@
+'''
+A module for storing historical fundamentals in the SQLite database
+and exporting them to columnar files.
+'''
+import datetime
+import os
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import func, select
+from sqlalchemy.dialects.sqlite import insert
+
+from portfoliobuilder.models import AnnualFinancials, MetricSnapshot
+
+
+# Maps the Finnhub metric names to MetricSnapshot columns
+METRIC_FIELDS = {
+    'marketCapitalization': 'market_cap',
+    'peBasicExclExtraTTM': 'pe_ttm',
+    'currentEv/freeCashFlowTTM': 'ev_fcf_ttm',
+    'psTTM': 'ps_ttm',
+    'pbQuarterly': 'pb_quarterly',
+    'netProfitMargin5Y': 'net_profit_margin_5y',
+    'revenueGrowth5Y': 'revenue_growth_5y',
+    'ebitdaCagr5Y': 'ebitda_cagr_5y',
+    'roeTTM': 'roe_ttm',
+    'currentRatioQuarterly': 'current_ratio_quarterly'
+}
+
+# Maps the Polygon financials names to AnnualFinancials columns
+FINANCIALS_FIELDS = {
+    'enterpriseValue': 'enterprise_value',
+    'earningsBeforeInterestTaxesDepreciationAmortizationUSD': 'ebitda',
+    'assets': 'assets',
+    'revenuesUSD': 'revenues',
+    'enterpriseValueOverEBITDA': 'ev_ebitda',
+    'freeCashFlow': 'free_cash_flow',
+    'returnOnAverageAssets': 'return_on_average_assets',
+    'returnOnInvestedCapital': 'return_on_invested_capital',
+    'averageEquity': 'average_equity',
+    'investedCapitalAverage': 'invested_capital_average',
+    'totalLiabilities': 'total_liabilities'
+}
+
+
+def metric_rows(metrics_responses, as_of=None):
+    '''
+    metrics_responses : dict
+        Maps symbols to responses from api_utils.get_metrics()
+    as_of : datetime.date
+        The date of the snapshot. Defaults to today.
+
+    Return a list of dicts, one per MetricSnapshot row.
+    '''
+    as_of = as_of or datetime.date.today()
+    rows = []
+    for symbol, response in metrics_responses.items():
+        if not response or not response.get('metric'):
+            continue
+        metrics = response['metric']
+        row = {column: metrics.get(field) for field, column in METRIC_FIELDS.items()}
+        row.update(symbol=symbol, as_of=as_of)
+        rows.append(row)
+    return rows
+
+
+def financials_rows(financials_responses):
+    '''
+    financials_responses : dict
+        Maps symbols to responses from api_utils.get_financials()
+
+    Return a list of dicts, one per AnnualFinancials row.
+    '''
+    rows = []
+    for symbol, response in financials_responses.items():
+        if not response:
+            continue
+        for result in response.get('results', []):
+            as_of = datetime.date.fromisoformat(result['reportPeriod'][:10])
+            row = {column: result.get(field) for field, column in FINANCIALS_FIELDS.items()}
+            row.update(symbol=symbol, as_of=as_of)
+            rows.append(row)
+    return rows
+
+
+def bulk_insert(session, model, rows):
+    '''
+    Insert rows into model's table in a single statement. Rows
+    whose (symbol, as_of) is already stored are skipped.
+
+    Return the number of rows inserted.
+    '''
+    if not rows:
+        return 0
+    statement = insert(model).on_conflict_do_nothing(
+                    index_elements=['symbol', 'as_of'])
+    result = session.execute(statement, rows)
+    session.flush()
+    return result.rowcount
+
+
+def store_fundamentals(session, metrics_responses, financials_responses, as_of=None):
+    '''
+    Store the responses from api_utils.get_metrics() and
+    api_utils.get_financials() (dicts mapping symbols to responses).
+
+    Return a tuple (number of metric rows, number of financials rows)
+    inserted.
+    '''
+    num_metrics = bulk_insert(session, MetricSnapshot,
+                                metric_rows(metrics_responses, as_of))
+    num_financials = bulk_insert(session, AnnualFinancials,
+                                    financials_rows(financials_responses))
+    return num_metrics, num_financials
+
+
+def load_frame(session, model, as_of=None, symbols=None):
+    '''
+    Load model's table into a pd.DataFrame.
+
+    as_of : datetime.date
+        If given, return only the latest row of each symbol dated
+        on or before as_of (i.e., the point-in-time data).
+    symbols : list
+        If given, return only the rows of these symbols.
+    '''
+    query = select(model)
+    if as_of is not None:
+        latest = select(model.symbol, func.max(model.as_of).label('as_of')) \
+                    .where(model.as_of <= as_of).group_by(model.symbol).subquery()
+        query = query.join(latest, (model.symbol == latest.c.symbol) &
+                                    (model.as_of == latest.c.as_of))
+    if symbols is not None:
+        query = query.where(model.symbol.in_(symbols))
+    columns = [column.name for column in model.__table__.columns if column.name != 'id']
+    rows = [[getattr(row, column) for column in columns]
+            for row in session.execute(query).scalars()]
+    return pd.DataFrame(rows, columns=columns)
+
+
+def export_parquet(session, model, path):
+    '''
+    Write model's table to a Parquet file at path.
+    Requires pyarrow (or fastparquet) to be installed.
+    '''
+    load_frame(session, model).to_parquet(path, index=False)
+
+
+def export_numpy(session, model, directory):
+    '''
+    Write each column of model's table to directory/<column>.npy.
+    Symbols are stored as fixed-width strings and dates as
+    datetime64[D], so every file can be memory-mapped with load_numpy().
+    '''
+    os.makedirs(directory, exist_ok=True)
+    frame = load_frame(session, model)
+    for column in frame.columns:
+        if column == 'symbol':
+            values = frame[column].to_numpy(dtype=str)
+        elif column == 'as_of':
+            values = frame[column].to_numpy(dtype='datetime64[D]')
+        else:
+            values = frame[column].to_numpy(dtype=float)
+        np.save(os.path.join(directory, f'{column}.npy'), values)
+
+
+def load_numpy(directory):
+    '''
+    Return a dict mapping each column written by export_numpy()
+    to a read-only memory-mapped array.
+    '''
+    return {name[:-len('.npy')]: np.load(os.path.join(directory, name), mmap_mode='r')
+            for name in sorted(os.listdir(directory)) if name.endswith('.npy')}
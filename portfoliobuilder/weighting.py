@@ -1,10 +1,14 @@
 '''
 A module for the weighting methods.
 '''
+import datetime
 import sys
+import warnings
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import numpy as np
 import pandas as pd
+import requests
 
 from portfoliobuilder import api_utils
 
@@ -21,32 +25,107 @@ class Equal():
         weights = dict(zip(symbols, weights_ls))
         return weights
 
+    @staticmethod
+    def _weights_from_responses(symbols, metrics=None, financials=None):
+        ''' See ValueQuality._weights_from_responses(). '''
+        return Equal.get_weights(symbols)
+
 
 class MarketCap():
     '''
     A namespace for the market_cap weighting method.
+
+    Market caps are the latest closing prices, which come from a
+    single Polygon call for the whole market, multiplied by the
+    shares outstanding from the Finnhub profiles. On a cold cache
+    that is one call per stock plus the price call; the profiles are
+    cached for 30 days, since shares outstanding rarely change, so
+    later runs make only the price call, once a day. The market caps
+    in the profiles would save the price call but are as old as the
+    cached profile.
     '''
+    # Number of days to look back for the latest trading day
+    _MAX_DAYS_BACK = 7
+
     @staticmethod
-    def get_weights(symbols):
-        get_profile = api_utils.get_profile2
-        
-        market_caps = []
+    def _get_closing_prices(today=None):
+        '''
+        Return a dict mapping each US stock symbol to its close on
+        the most recent trading day before today, or an empty dict if
+        no prices could be found.
+        '''
+        today = today or datetime.date.today()
+        for days_back in range(1, MarketCap._MAX_DAYS_BACK + 1):
+            date = today - datetime.timedelta(days=days_back)
+            if date.weekday() >= 5: # Saturday or Sunday
+                continue
+            response = api_utils.get_grouped_daily(date.isoformat())
+            if response and response.get('results'):
+                return {bar['T']: bar['c'] for bar in response['results']}
+        return {}
+
+    @staticmethod
+    def _get_market_caps(symbols):
+        '''
+        Return a tuple (market_caps, failed_symbols) where market_caps
+        maps symbols to market caps in dollars, and failed_symbols is
+        a list of the symbols whose market cap could not be found.
+        '''
+        closes = MarketCap._get_closing_prices()
+        market_caps = {}
+        failed_symbols = []
         for symbol in symbols:
-            profile = get_profile(symbol)
-            if profile:
-                # Finnhub reports a multiple of a million
-                market_cap = profile['marketCapitalization'] * 1000000
-                market_caps.append(market_cap)
+            print(f'Getting market cap for {symbol}...', end='\r')
+            profile = api_utils.get_profile2(symbol)
+            sys.stdout.write("\033[K")
+            # Finnhub reports a multiple of a million
+            if profile and profile.get('shareOutstanding') and symbol in closes:
+                market_caps[symbol] = closes[symbol] * profile['shareOutstanding'] * 1000000
+            elif profile and profile.get('marketCapitalization'):
+                market_caps[symbol] = profile['marketCapitalization'] * 1000000
             else:
-                market_caps.append(1)
+                failed_symbols.append(symbol)
+        return market_caps, failed_symbols
 
-        basket_market_cap = sum(market_caps)
+    @staticmethod
+    def get_weights(symbols):
+        '''
+        Weight each stock by its share of the basket's market cap.
+        NOTE: Stocks whose market cap could not be found are listed
+        and given a weight of 0.
+        '''
+        market_caps, failed_symbols = MarketCap._get_market_caps(symbols)
+        if failed_symbols:
+            print('Could not get the market cap of the following symbols; ' + \
+                    'they will be given a weight of 0: ' + ' '.join(failed_symbols))
+        return MarketCap._weights_from_market_caps(symbols, market_caps)
+
+    @staticmethod
+    def _weights_from_market_caps(symbols, market_caps):
+        ''' Symbols missing from market_caps are given a weight of 0. '''
+        basket_market_cap = sum(market_caps.values())
         weights = {}
-        for i, symbol in enumerate(symbols):
-            stock_weight = market_caps[i] / basket_market_cap
-            weights[symbol] = stock_weight
+        for symbol in symbols:
+            if symbol in market_caps:
+                weights[symbol] = market_caps[symbol] / basket_market_cap
+            else:
+                weights[symbol] = 0
         return weights
 
+    @staticmethod
+    def _weights_from_responses(symbols, metrics, financials=None):
+        '''
+        See ValueQuality._weights_from_responses(). Uses the market
+        caps reported in the metrics responses.
+        '''
+        market_caps = {}
+        for symbol in symbols:
+            response = metrics.get(symbol)
+            if response and response['metric'].get('marketCapitalization'):
+                # Finnhub reports a multiple of a million
+                market_caps[symbol] = response['metric']['marketCapitalization'] * 1000000
+        return MarketCap._weights_from_market_caps(symbols, market_caps)
+
 
 class Value():
     '''
@@ -56,7 +135,13 @@ class Value():
     def get_weights(symbols):
         get_metrics = api_utils.get_metrics
         
-        metrics_ls = [get_metrics(symbol)['metric'] for symbol in symbols]
+        metrics = {symbol: get_metrics(symbol) for symbol in symbols}
+        return Value._weights_from_responses(symbols, metrics)
+
+    @staticmethod
+    def _weights_from_responses(symbols, metrics, financials=None):
+        ''' See ValueQuality._weights_from_responses(). '''
+        metrics_ls = [metrics[symbol]['metric'] for symbol in symbols]
         ev_to_fcfs = [metrics['currentEv/freeCashFlowTTM'] for metrics in metrics_ls]
         
         # If a stock's EV/FCF is negative (i.e., None), give it as much
@@ -95,6 +180,9 @@ class ValueQuality():
             'assets_to_liabilities': np.nan
         })
 
+    # Number of threads that call each API provider
+    _FETCH_WORKERS = 4
+
     @staticmethod
     def _get_measures(symbol):
         '''
@@ -107,15 +195,72 @@ class ValueQuality():
         Return a pd.Series where the indices are the measure names
         and the series name is symbol.
         '''
+        metrics_response = api_utils.get_metrics(symbol)
+        financials_response = api_utils.get_financials(symbol)
+        return ValueQuality._compute_measures(symbol, metrics_response, 
+                                                financials_response)
+
+    @staticmethod
+    def fetch_responses(symbols, financials_symbols=None):
+        '''
+        Fetch the Finnhub metrics of each stock in symbols and the
+        Polygon financials of each stock in financials_symbols
+        (symbols by default). Each provider is called from its own
+        thread pool, so the calls to one provider do not wait on the
+        other provider's rate limit.
+
+        Return two dicts, (metrics, financials), that map each symbol
+        to its response, or to None if the call failed.
+        '''
+        if financials_symbols is None:
+            financials_symbols = symbols
+        def fetch(api_function, symbol):
+            try:
+                return api_function(symbol)
+            except requests.exceptions.RequestException:
+                return None
+
+        workers = ValueQuality._FETCH_WORKERS
+        responses = {'metrics': {}, 'financials': {}}
+        total = len(symbols) + len(financials_symbols)
+        with ThreadPoolExecutor(workers) as finnhub_pool, \
+                ThreadPoolExecutor(workers) as polygon_pool:
+            futures = {}
+            for symbol in symbols:
+                future = finnhub_pool.submit(fetch, api_utils.get_metrics, symbol)
+                futures[future] = ('metrics', symbol)
+            for symbol in financials_symbols:
+                future = polygon_pool.submit(fetch, api_utils.get_financials, symbol)
+                futures[future] = ('financials', symbol)
+
+            for num_done, future in enumerate(as_completed(futures), 1):
+                response_type, symbol = futures[future]
+                responses[response_type][symbol] = future.result()
+                print(f'Fetched {num_done}/{total} responses...', end='\r')
+        sys.stdout.write("\033[K")
+        return responses['metrics'], responses['financials']
+
+    @staticmethod
+    def _compute_measures(symbol, metrics_response, financials_response):
+        '''
+        Compute the measures of valuation and quality for the given
+        stock from its API responses.
+
+        metrics_response : dict
+            The response from api_utils.get_metrics()
+        financials_response : dict
+            The response from api_utils.get_financials()
+
+        Return a pd.Series like the one returned by _get_measures().
+        '''
         #TODO: For each endpoint, ensure the results are expected.
         # For example, ensure market cap is not a multiple of 1 million.
         
         # Finnhub endpoint
-        metrics = api_utils.get_metrics(symbol)
-        metrics = metrics['metric']
+        metrics = metrics_response['metric']
 
         # Polygon endpoint
-        polygon_financials = api_utils.get_financials(symbol)['results'][0]
+        polygon_financials = financials_response['results'][0]
 
         market_cap = metrics['marketCapitalization']
         ev = polygon_financials['enterpriseValue']
@@ -201,6 +346,53 @@ class ValueQuality():
         measures_series.name = symbol
         return measures_series
 
+    @staticmethod
+    def _score_matrix(values, is_quality):
+        '''
+        Compute the scores and weights from a matrix of measures.
+
+        values : np.ndarray
+            A (measures x stocks) array of floats. NaNs are missing
+            measures.
+        is_quality : np.ndarray
+            A bool array with one element per measure that is True for
+            quality measures and False for valuation measures
+
+        Return a tuple (values, scores, valuation, quality, weights)
+        where values has its missing and negative numbers addressed,
+        scores is the (measures x stocks) array of scores, and the
+        last three are arrays with one element per stock.
+        '''
+        with warnings.catch_warnings(), np.errstate(invalid='ignore', divide='ignore'):
+            # Rows of only NaNs stay NaNs
+            warnings.simplefilter('ignore', category=RuntimeWarning)
+
+            # Address Nones. For valuation measures, replace with largest num
+            # in row. For quality measures, replace with smallest num in row.
+            fill = np.where(is_quality, np.nanmin(values, axis=1), 
+                            np.nanmax(values, axis=1))
+            values = np.where(np.isnan(values), fill[:, np.newaxis], values)
+
+            # Address negative numbers by adding the absolute value of
+            # the smallest number in a row to every element in the row.
+            values = values + np.abs(np.nanmin(values, axis=1))[:, np.newaxis]
+
+            # Generate a score for each measure for each stock
+            shares = values / np.nansum(values, axis=1)[:, np.newaxis]
+            scores = np.where(is_quality[:, np.newaxis], shares, 1 - shares)
+
+            # Aggregate valuation measures and quality measures to
+            # get a single valuation score and a single quality score 
+            # for each stock.
+            valuation = np.nansum(scores[~is_quality], axis=0)
+            quality = np.nansum(scores[is_quality], axis=0)
+            valuation = valuation / valuation.sum()
+            quality = quality / quality.sum()
+
+        # Generate a single weight for each stock
+        weights = (valuation/2) + (quality/2)
+        return values, scores, valuation, quality, weights
+
     @staticmethod
     def _get_weighting_data(measures_series_list):
         '''
@@ -211,62 +403,15 @@ class ValueQuality():
         stock and the last row contains the weights.
         '''
         df = pd.concat(measures_series_list, axis=1)
-        measure_type_col = ['quality' if i in ValueQuality._QUALITY_MEASURES else 'valuation' for i in df.index]
-        df['measure_type'] = measure_type_col
-
-        # Address Nones. For valuation measures, replace with largest num
-        # in row. For quality measures, replace with smallest num in row.
-        valuation_max = df[df['measure_type'] == 'valuation'].max(axis=1)
-        for measure in valuation_max.index:
-            df.loc[measure] = df.loc[measure].fillna(valuation_max.loc[measure], inplace=False)
-        quality_min = df[df['measure_type'] == 'quality'].min(axis=1)
-        for measure in quality_min.index:
-            df.loc[measure] = df.loc[measure].fillna(quality_min.loc[measure], inplace=False)
-
-        # Address negative numbers by adding the absolute value of
-        # the smallest number in a row to every element in the row. 
-        symbols_cols = [True for i in range(len(df.columns)-1)]
-        symbols_cols.append(False)
-        df_no_measure_type = df.loc[:,symbols_cols].copy() # excludes 'measure_type' column
-        mins = df_no_measure_type.min(axis=1)
-        for measure in mins.index:
-            df_no_measure_type.loc[measure] += abs(mins.loc[measure])
-        
-        # Generate a score for each measure for each stock
-        valuation_score_rows = []
-        quality_score_rows = []
-        for measure in df_no_measure_type.index:
-            measure_sum = df_no_measure_type.loc[measure].sum()
-            row_name = measure + '_score'
-            if df.loc[measure]['measure_type'] == 'valuation':
-                df_no_measure_type.loc[row_name] = 1 - (df_no_measure_type.loc[measure] / measure_sum)
-                valuation_score_rows.append(row_name)
-            elif df.loc[measure]['measure_type'] == 'quality':
-                df_no_measure_type.loc[row_name] = df_no_measure_type.loc[measure] / measure_sum
-                quality_score_rows.append(row_name)
-
-        # Aggregate valuation measures and quality measures to
-        # get a single valuation score and a single quality score 
-        # for each stock.
-        final_valuation_score_row = {}
-        for col in df_no_measure_type.columns:
-            final_valuation_score = df_no_measure_type.loc[valuation_score_rows][col].sum()
-            final_valuation_score_row[col] = final_valuation_score
-        final_valuation_score_row = pd.Series(final_valuation_score_row)
-        final_quality_score_row = {}
-        for col in df_no_measure_type.columns:
-            final_quality_score = df_no_measure_type.loc[quality_score_rows][col].sum()
-            final_quality_score_row[col] = final_quality_score
-        final_quality_score_row = pd.Series(final_quality_score_row)
-        df_no_measure_type.loc['final_valuation_score'] = final_valuation_score_row / final_valuation_score_row.sum()
-        df_no_measure_type.loc['final_quality_score'] = final_quality_score_row / final_quality_score_row.sum()
-
-        # Generate a single weight for each stock
-        val_row = df_no_measure_type.loc['final_valuation_score']
-        quality_row = df_no_measure_type.loc['final_quality_score']
-        df_no_measure_type.loc['weight'] = (val_row/2) + (quality_row/2)
-
-        return df_no_measure_type
+        measures = list(df.index)
+        is_quality = np.isin(measures, ValueQuality._QUALITY_MEASURES)
+        values, scores, valuation, quality, weights = ValueQuality._score_matrix(
+                                        df.to_numpy(dtype=float), is_quality)
+
+        index = measures + [measure + '_score' for measure in measures] + \
+                ['final_valuation_score', 'final_quality_score', 'weight']
+        data = np.vstack([values, scores, valuation, quality, weights])
+        return pd.DataFrame(data, index=index, columns=df.columns)
     
     @staticmethod
     def get_weights(symbols):
@@ -279,18 +424,32 @@ class ValueQuality():
 
         Return a dict matching the specifications of builder.get_weights()
         '''
+        metrics, financials = ValueQuality.fetch_responses(symbols)
+        return ValueQuality._weights_from_responses(symbols, metrics, financials)
+
+    @staticmethod
+    def _weights_from_responses(symbols, metrics, financials):
+        '''
+        Generate the weights from API responses that have already
+        been fetched (e.g., point-in-time data in a backtest).
+
+        metrics : dict
+            Maps each symbol to its response from api_utils.get_metrics()
+        financials : dict
+            Maps each symbol to its response from api_utils.get_financials()
+
+        Return a dict like the one returned by get_weights().
+        '''
         measures_series_list = []
         failed_symbols = []
         for symbol in symbols:
-            print(f'Getting measures for {symbol}...', end='\r')
             try:
-                measures = ValueQuality._get_measures(symbol)
+                measures = ValueQuality._compute_measures(symbol, metrics.get(symbol),
+                                                            financials.get(symbol))
                 measures_series_list.append(measures)
-            except (IndexError, KeyError) as e:
-                sys.stdout.write("\033[K")
+            except (IndexError, KeyError, TypeError) as e:
                 print(f'{type(e)} for {symbol}')
                 failed_symbols.append(symbol)
-            sys.stdout.write("\033[K")
         
         print('Getting weights...', end='\r')
         data = ValueQuality._get_weighting_data(measures_series_list)
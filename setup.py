@@ -7,4 +7,7 @@ setup(
         'requests',
         'importlib; python_version == "3.7.6"',
     ],
+    entry_points={
+        'console_scripts': ['portfoliobuilder = portfoliobuilder.run:main'],
+    },
 )
\ No newline at end of file
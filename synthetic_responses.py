@@ -0,0 +1,61 @@
+'''
+Made-up API responses shaped like the recorded ones, shared by
+tests.py and benchmarks.py. The same kind and symbol always give the
+same response.
+'''
+import random
+
+
+def synthetic_response(kind, symbol):
+    ''' Return a made-up response for symbol shaped like a recorded one. '''
+    # Metrics are seeded with the bare symbol, which the weights pinned in
+    # tests.py were computed from
+    rand = random.Random(symbol if kind == 'metrics' else f'{symbol}:{kind}')
+    if kind == 'metrics':
+        metric = {'marketCapitalization': rand.uniform(1e3, 1e6),
+            'peBasicExclExtraTTM': rand.uniform(-10, 60),
+            'currentEv/freeCashFlowTTM': rand.uniform(5, 80),
+            'psTTM': rand.uniform(0.5, 20), 'pbQuarterly': rand.uniform(0.5, 30),
+            'netProfitMargin5Y': rand.uniform(-5, 40),
+            'revenueGrowth5Y': rand.uniform(-10, 30),
+            'ebitdaCagr5Y': rand.uniform(-10, 30), 'roeTTM': rand.uniform(-20, 60),
+            'currentRatioQuarterly': rand.uniform(0.3, 4)}
+        # The real response has about a hundred metrics
+        metric.update({f'other{i}': rand.uniform(0, 100) for i in range(100)})
+        return {'symbol': symbol, 'metricType': 'all', 'metric': metric, 'series': {}}
+    if kind == 'financials':
+        results = []
+        for year in range(2020, 2010, -1):
+            results.append({'ticker': symbol, 'period': 'Y',
+                'reportPeriod': f'{year}-12-31',
+                'enterpriseValue': rand.uniform(1e9, 1e12),
+                'earningsBeforeInterestTaxesDepreciationAmortizationUSD':
+                    rand.uniform(-1e8, 1e11),
+                'assets': rand.uniform(1e9, 1e12), 'revenuesUSD': rand.uniform(1e8, 1e11),
+                'enterpriseValueOverEBITDA': rand.uniform(-5, 50),
+                'freeCashFlow': rand.uniform(1e7, 1e10),
+                'returnOnAverageAssets': rand.uniform(-0.1, 0.3),
+                'returnOnInvestedCapital': rand.uniform(-0.1, 0.4),
+                'averageEquity': rand.uniform(1e8, 1e11),
+                'investedCapitalAverage': rand.uniform(1e8, 1e11),
+                'totalLiabilities': rand.uniform(1e8, 1e11)})
+        return {'status': 'OK', 'count': len(results), 'results': results}
+    if kind == 'profile2':
+        return {'ticker': symbol, 'name': f'{symbol} Inc',
+                'shareOutstanding': rand.uniform(10, 10000),
+                'marketCapitalization': rand.uniform(1e3, 1e6)}
+    if kind == 'financials_as_reported':
+        def items(prefix, num_items):
+            return [{'concept': f'us-gaap_{prefix}{i}', 'label': f'{prefix} {i}',
+                    'unit': 'usd', 'value': rand.uniform(-1e9, 1e9)}
+                    for i in range(num_items)]
+        reports = []
+        for year in range(2020, 2010, -1):
+            income_statement = items('Expense', 30)
+            income_statement.insert(0, {'concept': 'us-gaap_Revenues',
+                'label': 'Total revenues', 'unit': 'usd', 'value': rand.uniform(1e8, 1e11)})
+            reports.append({'symbol': symbol, 'year': year, 'quarter': 0, 'form': '10-K',
+                'report': {'ic': income_statement, 'bs': items('Balance', 40),
+                            'cf': items('CashFlow', 30)}})
+        return {'symbol': symbol, 'data': reports}
+    raise ValueError(f'Unknown fixture kind: {kind}')
@@ -1,8 +1,33 @@
 '''
 Unit tests.
 '''
+import asyncio
+import contextlib
+import datetime
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
 
-from portfoliobuilder import api_utils
+import numpy as np
+import pandas as pd
+from aiohttp import web
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+from portfoliobuilder import (api_utils, async_api_utils, backtest, basket_utils, 
+    commands, financials_reader, incremental_weighting, ledger, orders, portfolio, 
+    run, trade_stream, utils, warehouse, weighting)
+from portfoliobuilder.api_stats import ApiStats
+from portfoliobuilder.models import (Base, Basket, Stock, MetricSnapshot, 
+    AnnualFinancials, Trade)
+from portfoliobuilder.rate_limiter import TokenBucket
+from portfoliobuilder.response_cache import ResponseCache
+from synthetic_responses import synthetic_response
 
 
 
@@ -16,6 +41,10 @@ def test_api_utils_get_asset():
     asset = api_utils.get_asset('AAPL')
     assert asset['symbol'] == 'AAPL'
 
+def test_api_utils_get_assets():
+    assets = api_utils.get_assets()
+    assert 'AAPL' in [asset['symbol'] for asset in assets]
+
 # place_order() works
 
 def test_api_utils_get_position():
@@ -57,18 +86,1153 @@ def test_api_utils_get_financials():
     assert 'results' in fins.keys()
     assert len(fins.keys()) == 2
 
+def test_api_utils_iter_financials_as_reported_streams_reports():
+    body = json.dumps(_FAKE_FINANCIALS_AS_REPORTED).encode()
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.end_headers()
+            # Send the body in small chunks, as a long response would arrive
+            for i in range(0, len(body), 64):
+                self.wfile.write(body[i:i+64])
+        def log_message(self, *args):
+            pass
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    endpoint = api_utils.finnhub_endpoint
+    api_utils.finnhub_endpoint = f'http://127.0.0.1:{server.server_port}/'
+    try:
+        reports = list(api_utils.iter_financials_as_reported('XYZ', statements=('ic',)))
+    finally:
+        api_utils.finnhub_endpoint = endpoint
+        server.shutdown()
+
+    assert [report['year'] for report in reports] == [2020, 2020, 2019]
+    assert list(reports[0]['report']) == ['ic']
+    assert reports[0]['report']['ic'][0]['value'] == 200
+
+
+################# async_api_utils tests #################
+
+async def _run_async_client_against_stub():
+    metrics_requests = []
+    async def metrics(request):
+        metrics_requests.append(request.query['symbol'])
+        return web.json_response({'symbol': request.query['symbol'], 'metric': {}})
+    async def account(request):
+        return web.json_response({'currency': 'USD'})
+    async def orders(request):
+        payload = await request.json()
+        return web.json_response({'id': 'order-1', 'symbol': payload['symbol']})
+    app = web.Application()
+    app.router.add_get('/stock/metric', metrics)
+    app.router.add_get('/account', account)
+    app.router.add_post('/orders', orders)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    url = f'http://127.0.0.1:{runner.addresses[0][1]}/'
+    try:
+        async with async_api_utils.AsyncClient(alpaca_url=url, finnhub_url=url) as client:
+            symbols = [f'S{i}' for i in range(20)]
+            metrics = await client.map_symbols(client.get_metrics, symbols)
+            # Served from the response cache
+            cached_metrics = await client.map_symbols(client.get_metrics, symbols)
+            account = await client.get_account()
+            order = await client.place_order('AAPL', 10, 'buy')
+    finally:
+        await runner.cleanup()
+    return symbols, metrics, cached_metrics, metrics_requests, account, order
+
+def test_async_client_against_local_stub():
+    rate_limits = dict(api_utils.RATE_LIMITS)
+    response_cache = api_utils.response_cache
+    api_utils.response_cache = ResponseCache(os.path.join(tempfile.mkdtemp(), 'cache.db'),
+                                                api_utils._CACHE_TTLS)
+    for provider in rate_limits:
+        api_utils.set_rate_limit(provider, 1000, 100)
+    try:
+        symbols, metrics, cached_metrics, metrics_requests, account, order = \
+            asyncio.run(_run_async_client_against_stub())
+    finally:
+        api_utils.response_cache = response_cache
+        for provider, (rate, burst) in rate_limits.items():
+            api_utils.set_rate_limit(provider, rate, burst)
+
+    assert [metrics[symbol]['symbol'] for symbol in symbols] == symbols
+    assert cached_metrics == metrics and sorted(metrics_requests) == sorted(symbols)
+    assert account['currency'] == 'USD'
+    assert order == {'id': 'order-1', 'symbol': 'AAPL'}
+
+
+def test_async_client_fails_cut_off_and_slow_calls_like_connection_errors():
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            symbol = parse_qs(urlparse(self.path).query)['symbol'][0]
+            if symbol == 'SLOW':
+                time.sleep(0.5) # no response before the client times out
+                return
+            body = json.dumps({'symbol': symbol, 'metric': {}}).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            # The connection closes before the promised body is sent
+            self.send_header('Content-Length', str(len(body) + 100 * (symbol == 'CUT')))
+            self.end_headers()
+            self.wfile.write(body)
+        def log_message(self, *args):
+            pass
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_port}/'
+    async def map_metrics(symbols):
+        async with async_api_utils.AsyncClient(finnhub_url=url) as client:
+            return await client.map_symbols(client.get_metrics, symbols)
+    settings = api_utils.TIMEOUT, api_utils.MAX_RETRIES, api_utils.response_cache.enabled
+    api_utils.TIMEOUT, api_utils.MAX_RETRIES, api_utils.response_cache.enabled = 0.2, 0, False
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            metrics = asyncio.run(map_metrics(['A', 'CUT', 'SLOW']))
+    finally:
+        api_utils.TIMEOUT, api_utils.MAX_RETRIES, api_utils.response_cache.enabled = settings
+        server.shutdown()
+
+    assert metrics == {'A': {'symbol': 'A', 'metric': {}}, 'CUT': None, 'SLOW': None}
+
+################# response_cache tests #################
+
+def test_response_cache_ttl_and_lru():
+    path = os.path.join(tempfile.mkdtemp(), 'cache.db')
+    cache = ResponseCache(path, {'fresh': 60, 'stale': -1}, max_entries=2)
+    cache._EVICT_EVERY = 1
+
+    assert cache.get('fresh', 'a') is None
+    cache.put('fresh', 'a', {'value': 1})
+    cache.put('stale', 'b', {'value': 2})
+    assert cache.get('stale', 'b') is None
+    cache.put('uncached', 'c', {'value': 3})
+    assert cache.get('uncached', 'c') is None
+    assert cache.get('fresh', 'a') == {'value': 1}
+
+    cache.put('fresh', 'd', {'value': 4}) # evicts 'b', the least recently used
+    assert cache.stats()['entries'] == 2
+    assert cache.get('fresh', 'a') == {'value': 1}
+    assert cache.hits == 2 and cache.misses == 2
+
+
+################# rate_limiter tests #################
+
+def test_token_bucket_burst_then_rate():
+    bucket = TokenBucket(rate=10, capacity=3)
+    waits = [bucket.reserve() for _ in range(5)]
+    assert waits[:3] == [0, 0, 0]
+    assert 0.05 < waits[3] <= 0.1
+    assert 0.15 < waits[4] <= 0.2
+
+
+@contextlib.contextmanager
+def _stub_api_server(respond, providers=('alpaca', 'finnhub', 'polygon')):
+    '''
+    For the duration of a with block, serve every GET and POST from a
+    local server and point the providers' api_utils endpoints at it,
+    with the response cache off. Yield the server's URL.
+
+    respond : function
+        Takes the request's path and returns (status, body, headers),
+        or None to send nothing
+    '''
+    class Handler(BaseHTTPRequestHandler):
+        def respond(self):
+            response = respond(self.path)
+            if response is None:
+                return
+            status, body, headers = response
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        do_GET = do_POST = respond
+        def log_message(self, *args):
+            pass
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_port}/'
+    endpoints = {provider: getattr(api_utils, f'{provider}_endpoint')
+                    for provider in providers}
+    for provider in providers:
+        setattr(api_utils, f'{provider}_endpoint', url)
+    api_utils.response_cache.enabled = False
+    try:
+        yield url
+    finally:
+        for provider, endpoint in endpoints.items():
+            setattr(api_utils, f'{provider}_endpoint', endpoint)
+        api_utils.response_cache.enabled = True
+        server.shutdown()
+
+def test_call_api_retries_transient_failures():
+    # Each path fails with the statuses listed, in order, then succeeds
+    failures = {'/stock/metric': [429, 503], '/orders': [500], 
+                '/financials/AAPL': [404]}
+    requests_seen = []
+    def respond(path):
+        requests_seen.append(path.split('?')[0])
+        statuses = failures.get(path.split('?')[0], [])
+        status = statuses.pop(0) if statuses else 200
+        return status, b'{"id": "1"}', {'Retry-After': '0.1'} if status == 429 else {}
+    rate_limits = dict(api_utils.RATE_LIMITS)
+    api_utils.set_rate_limit('finnhub', 100, 1)
+    try:
+        with _stub_api_server(respond):
+            start = time.time()
+            metrics = api_utils.get_metrics('AAPL')
+            elapsed = time.time() - start
+            slowed_rate = api_utils.rate_limiters['finnhub'].rate
+            order = api_utils.place_order('AAPL', 10, 'buy')
+            financials = api_utils.get_financials('AAPL')
+    finally:
+        for provider, (rate, burst) in rate_limits.items():
+            api_utils.set_rate_limit(provider, rate, burst)
+
+    assert metrics == {'id': '1'}
+    assert requests_seen[:3] == ['/stock/metric'] * 3
+    assert elapsed >= 0.1 # waited for the Retry-After
+    assert slowed_rate < 100
+    # An order that may have been placed is not sent again after a 500
+    assert order is None and requests_seen.count('/orders') == 1
+    # Client errors are not retried
+    assert financials is None and requests_seen.count('/financials/AAPL') == 1
+
+
+def test_call_api_retries_timeouts_within_the_deadline():
+    requests_seen = []
+    def respond(path):
+        requests_seen.append(path.split('?')[0])
+        if len(requests_seen) == 1:
+            time.sleep(0.5) # longer than the read timeout
+            return None
+        return 200 if 'metric' in path else 500, b'{"metric": {}}', {}
+    settings = api_utils.TIMEOUT, api_utils.RETRY_BACKOFF, api_utils.MAX_RETRY_SECONDS
+    api_utils.TIMEOUT, api_utils.RETRY_BACKOFF, api_utils.MAX_RETRY_SECONDS = 0.2, 0.001, 1
+    rate_limiters = dict(api_utils.rate_limiters)
+    api_utils.rate_limiters['finnhub'] = TokenBucket(100, 1)
+    # A retry would wait 2 seconds for a token, past the deadline
+    api_utils.rate_limiters['polygon'] = TokenBucket(0.5, 1)
+    try:
+        with _stub_api_server(respond, ('finnhub', 'polygon')):
+            metrics = api_utils.get_metrics('AAPL')
+            start = time.time()
+            financials = api_utils.get_financials('AAPL')
+            elapsed = time.time() - start
+    finally:
+        api_utils.TIMEOUT, api_utils.RETRY_BACKOFF, api_utils.MAX_RETRY_SECONDS = settings
+        api_utils.rate_limiters.update(rate_limiters)
+
+    assert metrics == {'metric': {}}
+    assert requests_seen[:2] == ['/stock/metric'] * 2
+    assert financials is None and requests_seen[2:] == ['/financials/AAPL']
+    assert elapsed < 1
+
+
+################# api_stats tests #################
+
+def test_api_calls_are_recorded_per_endpoint():
+    def respond(path):
+        return 200 if 'metric' in path else 500, b'{"metric": {}}', {}
+    stats, backoff = api_utils.api_stats, api_utils.RETRY_BACKOFF
+    api_utils.api_stats = ApiStats()
+    api_utils.RETRY_BACKOFF = 0.001
+    rate_limiters = dict(api_utils.rate_limiters)
+    api_utils.rate_limiters['polygon'] = TokenBucket(100, 10)
+    try:
+        with _stub_api_server(respond, ('finnhub', 'polygon')):
+            api_utils.get_metrics('AAPL')
+            api_utils.get_metrics('MSFT')
+            api_utils.get_financials('AAPL')
+        recorded = {stats.endpoint: stats for stats in api_utils.api_stats.endpoints()}
+        prometheus = api_utils.api_stats.to_prometheus()
+    finally:
+        api_utils.api_stats, api_utils.RETRY_BACKOFF = stats, backoff
+        api_utils.rate_limiters.update(rate_limiters)
+
+    metrics = recorded['get_metrics']
+    assert metrics.provider == 'finnhub'
+    assert metrics.calls == 2 and metrics.status_codes == {200: 2}
+    assert metrics.bytes_received == 28
+    assert sum(metrics.latency_counts) == 2
+    assert recorded['get_financials'].status_codes == {500: api_utils.MAX_RETRIES + 1}
+    assert recorded['get_financials'].retries == api_utils.MAX_RETRIES
+    assert 'portfoliobuilder_api_latency_seconds_bucket{provider="finnhub",' + \
+            'endpoint="get_metrics",le="+Inf"} 2' in prometheus
+
+
+################# utils tests #################
+
+def test_tradable_symbols_from_uses_one_asset_list_call():
+    get_assets, get_asset = api_utils.get_assets, api_utils.get_asset
+    get_assets_calls = []
+    def fake_get_assets():
+        get_assets_calls.append(1)
+        return [{'symbol': 'AAPL', 'tradable': True},
+                {'symbol': 'HALT', 'tradable': False}]
+    def fail_get_asset(symbol):
+        raise AssertionError('get_asset should not be called')
+    api_utils.get_assets, api_utils.get_asset = fake_get_assets, fail_get_asset
+    utils._asset_index_built_at = 0
+    try:
+        tradable = utils.tradable_symbols_from(['AAPL', 'HALT', 'UNKNOWN'])
+        assert utils.is_tradable('AAPL')
+    finally:
+        api_utils.get_assets, api_utils.get_asset = get_assets, get_asset
+        utils._asset_index_built_at = 0
+
+    assert tradable == ['AAPL']
+    assert len(get_assets_calls) == 1
+
+def test_tradable_symbols_from_tries_the_asset_list_once_if_it_fails():
+    get_assets, get_asset = api_utils.get_assets, api_utils.get_asset
+    calls = []
+    def fail_get_assets():
+        calls.append('assets')
+        return None
+    def fake_get_asset(symbol):
+        calls.append(symbol)
+        return {'symbol': symbol, 'tradable': symbol != 'HALT'}
+    api_utils.get_assets, api_utils.get_asset = fail_get_assets, fake_get_asset
+    utils._asset_index_built_at = 0
+    try:
+        tradable = utils.tradable_symbols_from(['AAPL', 'HALT', 'MSFT'])
+    finally:
+        api_utils.get_assets, api_utils.get_asset = get_assets, get_asset
+        utils._asset_index_built_at = 0
+
+    assert tradable == ['AAPL', 'MSFT']
+    assert calls == ['assets', 'AAPL', 'HALT', 'MSFT']
+
+
+################# weighting tests #################
+
+def _fake_metrics(symbol):
+    return synthetic_response('metrics', symbol)
+
+def _fake_financials(symbol):
+    return synthetic_response('financials', symbol)
+
+def test_value_quality_fetches_providers_concurrently():
+    get_metrics, get_financials = api_utils.get_metrics, api_utils.get_financials
+    def slow(fake):
+        def api_function(symbol):
+            time.sleep(0.05)
+            return None if symbol == 'FAIL' else fake(symbol)
+        return api_function
+    api_utils.get_metrics = slow(_fake_metrics)
+    api_utils.get_financials = slow(_fake_financials)
+    try:
+        symbols = ['A', 'B', 'C', 'D', 'FAIL']
+        start = time.time()
+        weights = weighting.ValueQuality.get_weights(symbols)
+        elapsed = time.time() - start
+    finally:
+        api_utils.get_metrics, api_utils.get_financials = get_metrics, get_financials
+
+    # 10 sequential calls would take 0.5 seconds
+    assert elapsed < 0.3
+    assert weights['FAIL'] == 0
+    assert abs(sum(weights.values()) - 1) < 1e-9
+
+def test_value_quality_weighting_data_matches_row_by_row_method():
+    symbols = ['A', 'B', 'C', 'D', 'E']
+    measures_series_list = [weighting.ValueQuality._compute_measures(
+            symbol, _fake_metrics(symbol), _fake_financials(symbol)) 
+            for symbol in symbols]
+    measures_series_list[1]['pe_ttm'] = np.nan
+    measures_series_list[2]['roe_income'] = np.nan
+    data = weighting.ValueQuality._get_weighting_data(measures_series_list)
+
+    # Weights computed by the row-by-row pandas implementation
+    expected = {'A': 0.191109178806, 'B': 0.220863936329, 'C': 0.183012183697,
+                'D': 0.197430605098, 'E': 0.20758409607}
+    for symbol in symbols:
+        assert abs(data.loc['weight', symbol] - expected[symbol]) < 1e-11
+    assert data.index[-1] == 'weight'
+    assert 'pe_ttm_score' in data.index
+
+def test_market_cap_uses_one_bulk_price_call():
+    get_grouped_daily, get_profile2 = api_utils.get_grouped_daily, api_utils.get_profile2
+    grouped_daily_calls = []
+    def fake_grouped_daily(date):
+        grouped_daily_calls.append(date)
+        return {'resultsCount': 2, 'results': [{'T': 'A', 'c': 10.0}, {'T': 'B', 'c': 30.0}]}
+    shares = {'A': 3, 'B': 1}
+    api_utils.get_grouped_daily = fake_grouped_daily
+    api_utils.get_profile2 = lambda symbol: {'shareOutstanding': shares[symbol]} \
+                                                if symbol in shares else None
+    try:
+        weights = weighting.MarketCap.get_weights(['A', 'B', 'MISSING'])
+    finally:
+        api_utils.get_grouped_daily, api_utils.get_profile2 = get_grouped_daily, get_profile2
+
+    assert len(grouped_daily_calls) == 1
+    assert weights == {'A': 0.5, 'B': 0.5, 'MISSING': 0}
+
+
+def test_empty_grouped_daily_response_is_not_cached():
+    originals = (api_utils.response_cache, api_utils.call_api)
+    calls = []
+    def fake_call_api(provider, func, date):
+        calls.append(date)
+        # Polygon has no bars for the day until after its close
+        return {'resultsCount': 0} if len(calls) == 1 else \
+                {'resultsCount': 1, 'results': [{'T': 'A', 'c': 10.0}]}
+    api_utils.response_cache = ResponseCache(os.path.join(tempfile.mkdtemp(), 'cache.db'),
+                                                api_utils._CACHE_TTLS)
+    api_utils.call_api = fake_call_api
+    try:
+        responses = [api_utils.get_grouped_daily('2021-03-01') for _ in range(3)]
+    finally:
+        api_utils.response_cache, api_utils.call_api = originals
+
+    assert calls == ['2021-03-01'] * 2
+    assert responses[1] == responses[2] and responses[2]['results'][0]['T'] == 'A'
+
+
+################# orders tests #################
+
+def test_submit_orders_retries_without_duplicating():
+    place_order = api_utils.place_order
+    get_order = api_utils.get_order_by_client_order_id
+    last_failure_status = api_utils.last_failure_status
+    backoff = orders.BACKOFF
+    placed = {} # client_order_id -> symbol
+    attempts = []
+    failure = threading.local()
+    def flaky_place_order(symbol, notional, side, client_order_id=None, qty=None):
+        attempts.append(symbol)
+        failure.status = None
+        if symbol == 'DOWN':
+            return None
+        if symbol == 'REJECTED':
+            failure.status = 403 # e.g., insufficient buying power
+            return None
+        placed[client_order_id] = symbol
+        if attempts.count(symbol) == 1 and symbol == 'LOST':
+            return None # the order went through but the response was lost
+        return {'id': f'order-{symbol}', 'symbol': symbol}
+    def fake_get_order(client_order_id):
+        if client_order_id in placed:
+            return {'id': f'order-{placed[client_order_id]}'}
+        return None
+    api_utils.place_order = flaky_place_order
+    api_utils.get_order_by_client_order_id = fake_get_order
+    api_utils.last_failure_status = lambda: failure.status
+    orders.BACKOFF = 0
+    try:
+        results = orders.submit_orders([('AAPL', 10, 'buy'), ('LOST', 10, 'buy'),
+                                        ('DOWN', 10, 'buy'), ('REJECTED', 10, 'buy')])
+    finally:
+        api_utils.place_order = place_order
+        api_utils.get_order_by_client_order_id = get_order
+        api_utils.last_failure_status = last_failure_status
+        orders.BACKOFF = backoff
+
+    assert [result.symbol for result in results] == ['AAPL', 'LOST', 'DOWN', 'REJECTED']
+    assert [result.status for result in results] == ['placed', 'placed', 'failed', 'failed']
+    assert results[1].order_id == 'order-LOST'
+    assert attempts.count('LOST') == 1
+    assert attempts.count('DOWN') == orders.MAX_ATTEMPTS
+    # A permanent failure is not retried
+    assert attempts.count('REJECTED') == 1 and results[3].attempts == 1
+
+
+def test_submit_orders_places_sells_before_buys():
+    submit_order = orders.submit_order
+    events = []
+    def slow_submit_order(symbol, notional, side, qty=None):
+        events.append(('start', side))
+        time.sleep(0.05 if side == 'sell' else 0)
+        events.append(('end', side))
+        return orders.OrderResult(symbol, side, notional, 'placed', symbol, 0, 1, qty)
+    orders.submit_order = slow_submit_order
+    try:
+        results = orders.submit_orders([('A', 10, 'buy'), ('B', 10, 'sell'), 
+                                        ('C', 10, 'buy'), ('D', 10, 'sell', 2)])
+    finally:
+        orders.submit_order = submit_order
+
+    assert [result.symbol for result in results] == list('ABCD')
+    assert results[3].qty == 2
+    # Every sell is placed before the first buy is sent
+    assert events.index(('start', 'buy')) > max(i for i, event in enumerate(events) 
+                                                if event == ('end', 'sell'))
+
+def test_buy_basket_skips_zero_weights_and_stays_inactive_if_no_order_is_placed():
+    session = _make_session()
+    basket = Basket(weighting_method='equal', weight=50, 
+                    stocks=[Stock(symbol=symbol) for symbol in 'ABZ'])
+    session.add(basket)
+    session.flush()
+    originals = (api_utils.get_account, basket_utils.get_basket_weights, orders.submit_orders, 
+                    trade_stream.tracking_fills, getattr(commands, 'session', None), 
+                    commands.user_input)
+    submitted = []
+    api_utils.get_account = lambda: {'equity': '1000', 'cash': '1000'}
+    basket_utils.get_basket_weights = lambda basket: {'A': 0.5, 'B': 0.5, 'Z': 0}
+    orders.submit_orders = lambda batch: submitted.extend(batch) or \
+        [orders.OrderResult(symbol, side, notional, 'failed', None, 0, 1)
+            for symbol, notional, side in batch]
+    trade_stream.tracking_fills = lambda session: contextlib.nullcontext()
+    commands.session, commands.user_input = session, f'buybasket {basket.id}'
+    try:
+        status = commands.BuyBasket.execute()
+    finally:
+        (api_utils.get_account, basket_utils.get_basket_weights, orders.submit_orders, 
+            trade_stream.tracking_fills, commands.session, commands.user_input) = originals
+
+    assert submitted == [('A', 250, 'buy'), ('B', 250, 'buy')]
+    assert not basket.active and status is False
+
+
+def test_incremental_weighting_refetches_only_changed_fundamentals():
+    session = _make_session()
+    basket = Basket(weighting_method='value_quality', weight=50, 
+                    stocks=[Stock(symbol=symbol) for symbol in 'ABCDE'])
+    session.add(basket)
+    session.flush()
+    originals = (api_utils.get_metrics, api_utils.get_financials, 
+                    api_utils.get_earnings_calendar)
+    calls = []
+    def counted(fake, name):
+        return lambda symbol: calls.append((name, symbol)) or fake(symbol)
+    api_utils.get_metrics = counted(_fake_metrics, 'metrics')
+    api_utils.get_financials = counted(_fake_financials, 'financials')
+    # C released earnings on the first day, D after the second run
+    releases = [{'symbol': 'C', 'date': '2021-03-01'}, {'symbol': 'D', 'date': '2021-03-05'}]
+    api_utils.get_earnings_calendar = lambda from_date, to_date: {
+        'earningsCalendar': [release for release in releases 
+                                if from_date <= release['date'] <= to_date]}
+    start = datetime.datetime(2021, 3, 1, 9)
+    runs = []
+    try:
+        for days in [0, 1, 8]:
+            calls.clear()
+            weights = incremental_weighting.get_weights(basket, 
+                                        now=start + datetime.timedelta(days=days))
+            runs.append((sorted(calls), weights))
+        # Removing a stock forgets its fundamentals
+        basket.stocks = basket.stocks[:4]
+        incremental_weighting.get_weights(basket, now=start + datetime.timedelta(days=9))
+        session.flush()
+    finally:
+        (api_utils.get_metrics, api_utils.get_financials, 
+            api_utils.get_earnings_calendar) = originals
+
+    symbols = list('ABCDE')
+    expected = weighting.ValueQuality._weights_from_responses(symbols, 
+                {symbol: _fake_metrics(symbol) for symbol in symbols},
+                {symbol: _fake_financials(symbol) for symbol in symbols})
+    assert len(runs[0][0]) == 10
+    assert runs[1][0] == [('financials', 'C'), ('metrics', 'C')]
+    # The metrics fetched in the first run expire after a week; the
+    # financials do not. C's release predates its refetch, so of the
+    # two reported stocks only D is refetched.
+    assert runs[2][0] == [('financials', 'D')] + [('metrics', symbol) for symbol in 'ABDE']
+    for _, weights in runs:
+        for symbol in symbols:
+            assert abs(weights[symbol] - expected[symbol]) < 1e-9
+    assert sorted(state.symbol for state in basket.weighting_states) == list('ABCD')
+
+
+def test_incremental_weighting_refetches_past_the_response_cache():
+    basket = Basket(weighting_method='value_quality', weight=50,
+                    stocks=[Stock(symbol=symbol) for symbol in 'AB'])
+    originals = (api_utils.response_cache, api_utils.call_api)
+    calls = []
+    fakes = {'get_metrics': _fake_metrics, 'get_financials': _fake_financials}
+    def fake_call_api(provider, func, symbol):
+        calls.append((func.__name__, symbol))
+        return fakes[func.__name__](symbol)
+    api_utils.response_cache = ResponseCache(os.path.join(tempfile.mkdtemp(), 'cache.db'),
+                                                api_utils._CACHE_TTLS)
+    api_utils.call_api = fake_call_api
+    start = datetime.datetime(2021, 3, 1, 9)
+    try:
+        incremental_weighting.get_weights(basket, now=start)
+        first_run = len(calls)
+        incremental_weighting.get_weights(basket, refresh=True, 
+                                            now=start + datetime.timedelta(hours=1))
+    finally:
+        api_utils.response_cache, api_utils.call_api = originals
+
+    assert first_run == 4
+    # The refresh is not served the cached responses of the first run
+    assert len(calls) == 8
+
+
+################# basket_utils tests #################
+
+def test_rebalance_basket_uses_one_positions_snapshot():
+    originals = (api_utils.get_account, api_utils.get_positions, 
+                api_utils.get_position, orders.submit_orders)
+    submitted = []
+    api_utils.get_account = lambda: {'equity': '1000', 'cash': '500'}
+    api_utils.get_positions = lambda: [{'symbol': 'A', 'market_value': '300'},
+                                        {'symbol': 'B', 'market_value': '250'}]
+    def fail_get_position(symbol):
+        raise AssertionError('get_position should not be called')
+    api_utils.get_position = fail_get_position
+    orders.submit_orders = lambda batch: submitted.extend(batch) or []
+    basket = Basket(weighting_method='equal', weight=50, 
+                    stocks=[Stock(symbol='A'), Stock(symbol='B'), Stock(symbol='C')])
+    try:
+        basket_utils.rebalance_basket(basket)
+    finally:
+        (api_utils.get_account, api_utils.get_positions, 
+            api_utils.get_position, orders.submit_orders) = originals
+
+    # Each stock's goal is 1000 * 0.5 / 3
+    goal = 500 / 3
+    assert [(symbol, side) for symbol, _, side in submitted] == \
+            [('A', 'sell'), ('B', 'sell'), ('C', 'buy')]
+    for (_, notional, _), expected in zip(submitted, [300 - goal, 250 - goal, goal]):
+        assert abs(notional - expected) < 0.005
+
+def test_portfolio_nets_orders_across_baskets():
+    originals = (api_utils.get_account, api_utils.get_positions, 
+                    api_utils.close_position, orders.submit_orders)
+    submitted, closed = [], []
+    api_utils.get_account = lambda: {'equity': '1000', 'cash': '500'}
+    api_utils.get_positions = lambda: [{'symbol': 'A', 'market_value': '200'},
+                                        {'symbol': 'B', 'market_value': '100'},
+                                        {'symbol': 'OTHER', 'market_value': '50'}]
+    api_utils.close_position = lambda symbol: closed.append(symbol) or {}
+    orders.submit_orders = lambda batch: submitted.append(batch) or []
+    broad = Basket(id=1, weighting_method='equal', weight=40, 
+                    stocks=[Stock(symbol=symbol) for symbol in 'ABCD'])
+    tech = Basket(id=2, weighting_method='equal', weight=20, 
+                    stocks=[Stock(symbol=symbol) for symbol in 'AB'])
+    try:
+        portfolio.rebalance_portfolio([broad, tech])
+        portfolio.sell_basket(tech, [broad, tech])
+        portfolio.sell_basket(broad, [broad])
+    finally:
+        (api_utils.get_account, api_utils.get_positions, 
+            api_utils.close_position, orders.submit_orders) = originals
+
+    # A and B are each 100 from the broad basket and 100 from the tech basket
+    assert submitted[0] == [('B', 100, 'buy'), ('C', 100, 'buy'), ('D', 100, 'buy')]
+    # Selling the tech basket keeps the broad basket's share of A and B
+    assert submitted[1] == [('A', 100, 'sell')]
+    assert closed == ['A', 'B', 'C', 'D']
+
+def test_ledger_tracks_basket_fills_and_sells_by_qty():
+    originals = (api_utils.get_account, api_utils.get_positions, api_utils.get_orders,
+                    api_utils.close_position, orders.submit_orders)
+    submitted, placed, order_calls = [], [], []
+    prices = {'A': 100, 'B': 50}
+    def fake_submit_orders(batch):
+        submitted.append(batch)
+        results = [orders.OrderResult(order[0], order[2], order[1], 'placed', 
+                                        f'{order[0]}{len(submitted)}', 0, 1, *order[3:])
+                    for order in batch]
+        placed.extend(results)
+        return results
+    def fake_get_orders(status, after, limit):
+        order_calls.append(status)
+        # Every order fills in full at the current price
+        return [{'id': result.order_id, 'status': 'filled', 'submitted_at': after,
+                    'filled_at': '2024-01-02T15:30:00.123456789Z',
+                    'filled_qty': str(result.qty or result.notional / prices[result.symbol]), 
+                    'filled_avg_price': str(prices[result.symbol])}
+                for result in placed]
+
+    api_utils.get_account = lambda: {'equity': '1000', 'cash': '1000'}
+    api_utils.get_positions = lambda: [{'symbol': symbol, 'current_price': str(price)} 
+                                        for symbol, price in prices.items()]
+    api_utils.get_orders = fake_get_orders
+    api_utils.close_position = lambda symbol: 1 / 0
+    orders.submit_orders = fake_submit_orders
+    broad = Basket(id=1, weighting_method='equal', weight=50, 
+                    stocks=[Stock(symbol=symbol) for symbol in 'AB'])
+    tech = Basket(id=2, weighting_method='equal', weight=20, stocks=[Stock(symbol='A')])
+    try:
+        basket_utils.buy_basket(broad)
+        basket_utils.buy_basket(tech)
+        assert ledger.sync_fills(broad.trades + tech.trades) == 3
+        # A has doubled, so the broad basket sells some of its shares of A
+        prices['A'] = 200
+        trades = basket_utils.plan_rebalance(broad)
+        portfolio.sell_basket(broad, [broad, tech])
+    finally:
+        (api_utils.get_account, api_utils.get_positions, api_utils.get_orders,
+            api_utils.close_position, orders.submit_orders) = originals
+
+    assert order_calls == ['closed']
+    assert [trade.status for trade in broad.trades] == ['filled', 'filled', 'placed', 'placed']
+    holdings = {holding.symbol: (holding.qty, holding.cost_basis) for holding in broad.holdings}
+    assert holdings == {'A': (2.5, 250), 'B': (5, 250)}
+    assert [(holding.symbol, holding.qty) for holding in tech.holdings] == [('A', 2)]
+    # The goal of A and B is 250 each; A is worth 500
+    assert trades == [('A', 250, 'sell', 1.25)]
+    # Only the broad basket's shares are sold, by quantity
+    assert submitted[2] == [('A', 250, 'sell', 2.5), ('B', 250, 'sell', 5)]
+
+def test_sell_basket_waits_for_open_orders():
+    submit_orders = orders.submit_orders
+    submitted = []
+    orders.submit_orders = lambda batch: submitted.append(batch) or []
+    basket = Basket(id=1, weighting_method='equal', weight=50, stocks=[Stock(symbol='A')],
+                    trades=[Trade(symbol='A', side='buy', status='placed', share=1)])
+    try:
+        sold = portfolio.sell_basket(basket, [basket])
+    finally:
+        orders.submit_orders = submit_orders
+    # The buy has not filled, so the basket's shares are not known yet
+    assert sold is None
+    assert submitted == []
+
+def test_allocate_netted_trades_among_tracked_baskets():
+    broad = Basket(id=1, weight=50, trades=[Trade()])
+    tech = Basket(id=2, weight=20, trades=[Trade()])
+    untracked = Basket(id=3, weight=10)
+    ledger.apply_fill(broad, {}, 'A', 3, 100)
+    tech_holdings = {}
+    ledger.apply_fill(tech, tech_holdings, 'A', 2, 100)
+    ledger.apply_fill(tech, tech_holdings, 'A', -0.5, 120)
+    positions = {'A': {'current_price': '100'}}
+    goals = {1: {'A': 250}, 2: {'A': 250}, 3: {'A': 100}}
+    allocations = portfolio.allocate_trades([('A', 150, 'buy')], [broad, tech, untracked], 
+                                            goals, positions)
+    # broad is 50 over its goal and tech 100 under; the rest of the buy
+    # is for the untracked basket
+    assert [(basket.id, round(share, 9)) for basket, share in allocations['A']] == \
+            [(1, round(-1 / 3, 9)), (2, round(2 / 3, 9))]
+    # Shares sold take their average cost out of the cost basis
+    assert (tech.holdings[0].qty, tech.holdings[0].cost_basis) == (1.5, 150)
+    ledger.apply_fill(tech, tech_holdings, 'A', -1.5, 100)
+    assert tech.holdings == []
+
+def test_allocate_trades_in_mixed_tracked_and_untracked_portfolio():
+    tracked = Basket(id=1, weight=10, trades=[Trade()])
+    ledger.apply_fill(tracked, {}, 'A', 0.9, 100)
+    untracked = Basket(id=2, weight=50)
+    positions = {'A': {'current_price': '100'}}
+    goals = {1: {'A': 100}, 2: {'A': 5000}}
+    baskets = [tracked, untracked]
+    # The tracked basket is 10 under its goal, whichever way the order goes
+    buy = portfolio.allocate_trades([('A', 1000, 'buy')], baskets, goals, positions)
+    sell = portfolio.allocate_trades([('A', 1000, 'sell')], baskets, goals, positions)
+    assert [(basket.id, round(share, 9)) for basket, share in buy['A']] == [(1, 0.01)]
+    assert [(basket.id, round(share, 9)) for basket, share in sell['A']] == [(1, -0.01)]
+    # A sell's filled shares are taken away, so -0.01 of them are added
+    trade = Trade(side='sell', share=sell['A'][0][1], basket=tracked, symbol='A')
+    ledger.apply_order([trade], {'status': 'filled', 'filled_qty': '10', 
+                                    'filled_avg_price': '100'})
+    assert round(tracked.holdings[0].qty, 9) == 1.0
+
+    # Tracked baskets on the trade's side share no more than the trade
+    other = Basket(id=3, weight=10, trades=[Trade()])
+    goals = {1: {'A': 700}, 3: {'A': 600}} # both 600 under
+    capped = portfolio.allocate_trades([('A', 1000, 'buy')], [tracked, other], goals, positions)
+    assert [(basket.id, round(share, 9)) for basket, share in capped['A']] == [(1, 0.5), (3, 0.5)]
+
+def test_plan_trades_skips_small_drift_and_sells_first():
+    goal_values = {'A': 100, 'B': 100, 'C': 100, 'D': 100, 'E': 0}
+    curr_values = {'A': '100.50', 'B': 160, 'C': 99.2, 'E': 20, 'OTHER': 50}
+    trades = basket_utils.plan_trades(goal_values, curr_values, 
+                                        min_trade_value=1, min_drift=0.01)
+    assert trades == [('B', 60, 'sell'), ('E', 20, 'sell'), ('D', 100, 'buy')]
+
+
+################# trade_stream tests #################
+
+class _TradeUpdatesStub():
+    '''
+    A local stand-in for Alpaca's trade_updates stream, served from a
+    background thread. push() sends messages to the subscribed clients.
+    '''
+    def __init__(self):
+        self.received = []
+        self.url = None
+        self._clients = []
+        self._loop = asyncio.new_event_loop()
+        self._started = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        self._started.wait()
+        return self.url
+
+    def _run(self):
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_until_complete(self._serve())
+        self._loop.run_forever()
+
+    async def _serve(self):
+        app = web.Application()
+        app.router.add_get('/stream', self._stream)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, '127.0.0.1', 0)
+        await site.start()
+        self.url = f'ws://127.0.0.1:{self._runner.addresses[0][1]}/stream'
+        self._started.set()
+
+    async def _stream(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        async for message in ws:
+            data = json.loads(message.data)
+            self.received.append(data)
+            if data['action'] == 'auth':
+                await ws.send_json({'stream': 'authorization', 
+                                    'data': {'status': 'authorized', 'action': 'authenticate'}})
+            elif data['action'] == 'listen':
+                self._clients.append(ws)
+                await ws.send_json({'stream': 'listening', 
+                                    'data': {'streams': data['data']['streams']}})
+        return ws
+
+    def push(self, messages, binary=False):
+        async def send():
+            for ws in self._clients:
+                for message in messages:
+                    if binary:
+                        await ws.send_bytes(json.dumps(message).encode())
+                    else:
+                        await ws.send_str(json.dumps(message))
+        asyncio.run_coroutine_threadsafe(send(), self._loop).result()
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+def _trade_update(event, symbol, status, filled_qty=0, price=100):
+    order = {'id': f'order-{symbol}', 'symbol': symbol, 'status': status, 
+                'filled_qty': str(filled_qty), 'filled_avg_price': None, 'filled_at': None}
+    if filled_qty:
+        order.update(filled_avg_price=str(price), filled_at='2024-01-02T15:30:00Z')
+    return {'stream': 'trade_updates', 'data': {'event': event, 'order': order}}
+
+def test_trade_updates_stream_applies_fills_to_ledger():
+    stub = _TradeUpdatesStub()
+    url = stub.start()
+    session = _make_session()
+    basket = Basket(weighting_method='equal', weight=50, 
+                    stocks=[Stock(symbol=symbol) for symbol in 'ABC'])
+    session.add(basket)
+    session.flush()
+    originals = (api_utils.get_account, orders.submit_orders)
+    api_utils.get_account = lambda: {'equity': '1200', 'cash': '1200'}
+    orders.submit_orders = lambda batch: [orders.OrderResult(symbol, side, notional, 'placed', 
+                                            f'order-{symbol}', 0, 1) 
+                                            for symbol, notional, side in batch]
+    try:
+        with trade_stream.tracking_fills(session, timeout=5, url=url):
+            basket_utils.buy_basket(basket)
+            stub.push([_trade_update('new', 'A', 'new'),
+                        _trade_update('partial_fill', 'A', 'partially_filled', 1),
+                        _trade_update('fill', 'A', 'filled', 2),
+                        _trade_update('rejected', 'B', 'rejected'),
+                        _trade_update('fill', 'OTHER', 'filled', 5)])
+            # Alpaca sends some messages as binary frames
+            stub.push([_trade_update('canceled', 'C', 'canceled', 0.5)], binary=True)
+        unreachable = trade_stream.TradeUpdates('ws://127.0.0.1:9/stream').start(timeout=2)
+    finally:
+        (api_utils.get_account, orders.submit_orders) = originals
+        stub.stop()
+
+    assert stub.received[0]['action'] == 'auth'
+    assert stub.received[1] == {'action': 'listen', 'data': {'streams': ['trade_updates']}}
+    assert {trade.symbol: trade.status for trade in basket.trades} == \
+            {'A': 'filled', 'B': 'rejected', 'C': 'canceled'}
+    holdings = {holding.symbol: (holding.qty, holding.cost_basis) for holding in basket.holdings}
+    assert holdings == {'A': (2, 200), 'C': (0.5, 50)}
+    assert ledger.pending_trades(session) == []
+    assert unreachable is False
+
+
+################# financials_reader tests #################
+
+_FAKE_FINANCIALS_AS_REPORTED = {'symbol': 'XYZ', 'data': [
+    {'year': 2020, 'report': {
+        'ic': [{'concept': 'Revenues', 'label': 'Total revenues', 'value': 200},
+                {'concept': 'NetIncomeLoss', 'label': 'Net income', 'value': 20}],
+        'bs': [{'concept': 'Assets', 'label': 'Total assets', 'value': 900}],
+        'cf': {'NetCashProvidedByUsedInOperatingActivities': 35}}},
+    {'year': 2020, 'report': {'ic': [], 'bs': [], 'cf': []}}, # amended filing
+    {'year': 2019, 'report': {
+        'ic': [{'concept': 'SalesRevenueNet', 'label': 'Net sales', 'value': 150}],
+        'bs': [], 'cf': []}}]}
+
+def test_financials_store_parses_payload_once():
+    store, iter_financials_as_reported = (financials_reader.store, 
+                                            api_utils.iter_financials_as_reported)
+    financials_reader.store = financials_reader.FinancialsStore(
+                                os.path.join(tempfile.mkdtemp(), 'financials.db'))
+    calls = []
+    def fake_iter_financials_as_reported(symbol):
+        calls.append(symbol)
+        return iter(_FAKE_FINANCIALS_AS_REPORTED['data'])
+    api_utils.iter_financials_as_reported = fake_iter_financials_as_reported
+    try:
+        income_statements = financials_reader.get_income_statements('XYZ')
+        balance_sheets = financials_reader.get_balance_sheets('XYZ')
+        cash_flows = financials_reader.get_cash_flow_statements('XYZ')
+        assets = financials_reader.store.get_value('XYZ', 2020, 'bs', 'Assets')
+    finally:
+        financials_reader.store = store
+        api_utils.iter_financials_as_reported = iter_financials_as_reported
+
+    assert calls == ['XYZ']
+    assert [len(statement) for statement in income_statements] == [2, 1]
+    assert income_statements[0][0] == {'concept': 'Revenues', 
+                                        'label': 'Total revenues', 'value': 200}
+    # 2019's balance sheet is empty, but the year keeps its place
+    assert balance_sheets == [[{'concept': 'Assets', 'label': 'Total assets', 
+                                'value': 900}], []]
+    assert cash_flows[0][0]['value'] == 35
+    assert assets == 900
+
+def test_financials_store_keeps_the_last_filing_of_each_year():
+    store = financials_reader.FinancialsStore(os.path.join(tempfile.mkdtemp(), 'financials.db'))
+    reports = [
+        {'year': 2020, 'filedDate': '2021-02-01 00:00:00', 'report': {
+            'ic': [{'concept': 'Revenues', 'label': 'Revenues', 'value': 200}]}},
+        {'year': 2020, 'filedDate': '2021-05-01 00:00:00', 'report': { # 10-K/A
+            'ic': [{'concept': 'Revenues', 'label': 'Total revenues', 'value': 210},
+                    {'concept': 'Revenues', 'label': 'Product revenues', 'value': 150}]}},
+        {'year': 2019, 'filedDate': '2020-02-01 00:00:00', 'report': {
+            'bs': [{'concept': 'Assets', 'label': 'Total assets', 'value': 900}]}}]
+    store.add('XYZ', financials_reader.FinancialsStore.parse_reports(reports))
+
+    # One statement per year, even when the year has no income statement
+    assert store.get_statements('XYZ', 'ic') == [
+        [{'concept': 'Revenues', 'label': 'Total revenues', 'value': 210}], []]
+    assert financials_reader._revenues_from_rows(store.get_rows('XYZ'), 'XYZ', 
+                financials_reader.revenue_matcher) == [(2020, 210, 'concept'), 
+                                                        (2019, None, None)]
+
+def test_financials_store_loads_the_amended_filing_from_the_stream():
+    payload = {'symbol': 'XYZ', 'data': [
+        {'year': 2020, 'filedDate': '2021-02-01 00:00:00', 'report': {
+            'ic': [{'concept': 'Revenues', 'label': 'Revenues', 'value': 200}]}},
+        {'year': 2020, 'filedDate': '2021-05-01 00:00:00', 'report': { # 10-K/A
+            'ic': [{'concept': 'Revenues', 'label': 'Revenues', 'value': 210}]}}]}
+    def respond(path):
+        return 200, json.dumps(payload).encode(), {'Content-Type': 'application/json'}
+    store = financials_reader.store
+    financials_reader.store = financials_reader.FinancialsStore(
+                                os.path.join(tempfile.mkdtemp(), 'financials.db'))
+    try:
+        with _stub_api_server(respond, ('finnhub',)):
+            assert financials_reader.load('XYZ')
+        streamed_rows = financials_reader.store.get_rows('XYZ')
+    finally:
+        financials_reader.store = store
+
+    # The streamed and the whole payload agree on the amended revenue
+    assert streamed_rows == [(2020, 'ic', 'Revenues', 'Revenues', 210)]
+    assert financials_reader.FinancialsStore.parse_payload(payload) == streamed_rows
+
+def test_revenue_matcher_rules():
+    matcher = financials_reader.revenue_matcher
+    statement = [{'concept': 'CostOfRevenue', 'label': 'Cost of revenue', 'value': 5},
+                {'concept': 'xyz:Revenues', 'label': 'Revenues', 'value': 8},
+                {'concept': 'ElectricUtilityRevenue', 'label': 'Total', 'value': 9}]
+    assert matcher.match(statement, 'XYZ') == (8, 'prefixed_concept')
+    assert matcher.match(statement, 'AES') == (9, 'override')
+    assert matcher.match(statement[:1] + [{'concept': 'Other', 'label': 'Net Sales', 
+                        'value': 7}], 'XYZ') == (7, 'label')
+    assert matcher.match([{'concept': 'us-gaap_SalesRevenueNet', 'label': '', 
+                        'value': 6}], 'XYZ') == (6, 'prefixed_concept')
+    assert matcher.match({'Revenues': 4}, 'XYZ') == (4, 'concept')
+    assert financials_reader._find_revenue(statement[:1], 'XYZ') is None
+
+def test_get_revenues_bulk():
+    store, get_financials_as_reported_body = (financials_reader.store, 
+                                                api_utils.get_financials_as_reported_body)
+    financials_reader.store = financials_reader.FinancialsStore(
+                                os.path.join(tempfile.mkdtemp(), 'financials.db'))
+    no_revenue = {'data': [{'year': 2020, 'report': {'ic': [
+                    {'concept': 'NetIncomeLoss', 'label': 'Net income', 'value': 1}]}}]}
+    bodies = {'XYZ': json.dumps(_FAKE_FINANCIALS_AS_REPORTED).encode(), 
+                'ABC': json.dumps(no_revenue).encode(), 'QRS': json.dumps(no_revenue).encode()}
+    api_utils.get_financials_as_reported_body = bodies.get
+    try:
+        # With one worker, the third payload waits for the first to be parsed
+        revenues, unresolved = financials_reader.get_revenues_bulk(
+                                    ['XYZ', 'ABC', 'GONE', 'QRS'], max_workers=1)
+        # The second run reads from the store
+        api_utils.get_financials_as_reported_body = lambda symbol: None
+        cached_revenues, _ = financials_reader.get_revenues_bulk(['XYZ'], max_workers=2)
+    finally:
+        financials_reader.store = store
+        api_utils.get_financials_as_reported_body = get_financials_as_reported_body
+
+    assert revenues.values.tolist() == [['XYZ', 2020, 200, 'concept'], 
+                                        ['XYZ', 2019, 150, 'concept']]
+    assert unresolved == ['ABC', 'GONE', 'QRS']
+    assert cached_revenues.values.tolist() == revenues.values.tolist()
+
+
+################# warehouse tests #################
+
+def _make_session():
+    engine = create_engine('sqlite://', future=True)
+    Base.metadata.create_all(bind=engine)
+    return Session(engine)
+
+def test_warehouse_point_in_time_and_numpy_export():
+    session = _make_session()
+    metrics = {symbol: _fake_metrics(symbol) for symbol in ['A', 'B']}
+    financials = {'A': {'results': [
+        dict(_fake_financials('A')['results'][0], reportPeriod='2020-12-31'),
+        dict(_fake_financials('A')['results'][0], reportPeriod='2019-12-31',
+                revenuesUSD=1.0)]}}
+    stored = warehouse.store_fundamentals(session, metrics, financials, 
+                                            as_of=datetime.date(2021, 3, 1))
+    # Storing the same dates again adds nothing
+    stored_again = warehouse.store_fundamentals(session, metrics, financials, 
+                                                as_of=datetime.date(2021, 3, 1))
+    assert stored == (2, 2) and stored_again == (0, 0)
+    assert len(warehouse.load_frame(session, MetricSnapshot)) == 2
+    assert len(warehouse.load_frame(session, AnnualFinancials)) == 2
+
+    point_in_time = warehouse.load_frame(session, AnnualFinancials, 
+                                            as_of=datetime.date(2020, 6, 30))
+    assert point_in_time['revenues'].tolist() == [1.0]
+
+    directory = tempfile.mkdtemp()
+    warehouse.export_numpy(session, MetricSnapshot, directory)
+    columns = warehouse.load_numpy(directory)
+    assert columns['symbol'].tolist() == ['A', 'B']
+    assert columns['as_of'].dtype == np.dtype('datetime64[D]')
+    assert isinstance(columns['pe_ttm'], np.memmap)
+    assert columns['pe_ttm'][0] == metrics['A']['metric']['peBasicExclExtraTTM']
+
+
+################# backtest tests #################
+
+def test_backtest_equal_weights_drift_between_rebalances():
+    dates = pd.to_datetime(['2020-01-02', '2020-01-03', '2020-02-03', '2020-02-04'])
+    prices = pd.DataFrame({'A': [1.0, 2.0, 2.0, 2.0], 'B': [1.0, 1.0, 1.0, 2.0]}, 
+                            index=dates)
+    result = backtest.run_backtest(prices, 'equal', frequency='M')
+
+    # Day 1: A doubles. Day 2: rebalance back to 50/50. Day 3: B doubles.
+    assert np.allclose(result.values.to_numpy(), [1, 1.5, 1.5, 2.25])
+    # Before the second rebalance, A is 2/3 of the portfolio
+    assert np.allclose(result.turnover.to_numpy(), [1, 1/6])
+    assert result.summary['max_drawdown'] == 0
+
+def test_backtest_uses_point_in_time_fundamentals():
+    dates = pd.bdate_range('2020-01-01', '2020-12-31')
+    prices = pd.DataFrame({'A': 1.0, 'B': 1.0, 'C': 1.0}, index=dates)
+    metric_rows = warehouse.metric_rows({'A': _fake_metrics('A'), 'B': _fake_metrics('B')},
+                                        as_of=datetime.date(2020, 1, 1))
+    metric_rows += warehouse.metric_rows({'C': _fake_metrics('C')}, 
+                                        as_of=datetime.date(2020, 6, 15))
+    financial_rows = warehouse.financials_rows({symbol: {'results': [dict(
+                        _fake_financials(symbol)['results'][0], reportPeriod='2019-09-30')]}
+                        for symbol in ['A', 'B', 'C']})
+    result = backtest.run_backtest(prices, 'value_quality', pd.DataFrame(metric_rows),
+                                    pd.DataFrame(financial_rows), frequency='Q')
+
+    weights = result.weights
+    assert weights.loc['2020-01-01', 'C'] == 0
+    assert weights.loc['2020-07-01', 'C'] > 0
+    assert np.allclose(weights.sum(axis=1), 1)
+
+
+################# run tests #################
+
+def test_cli_arguments_and_command_files():
+    parser = run.make_parser()
+    parsed = [run.to_user_input(parser.parse_args(argv.split())) for argv in 
+                ['buy 3', 'rebalance --all', 'rebalance 2 --full', 'planrebalance --all --full',
+                'newbasket equal 10 AAPL MSFT']]
+    assert parsed == ['buybasket 3', 'rebalanceall', 'rebalance 2 full', 
+                        'planrebalanceall full', 'newbasket equal 10 AAPL MSFT']
 
+    executed = []
+    class Recorder():
+        @staticmethod
+        def execute():
+            executed.append(run.commands.user_input)
+    class Failing():
+        @staticmethod
+        def execute():
+            executed.append(run.commands.user_input)
+            return False
+    class Raising():
+        @staticmethod
+        def execute():
+            raise TypeError('not subscriptable')
+    executables = run.command_executables
+    run.command_executables = {'listbaskets': Recorder, 'rebalanceall': Recorder, 
+                                'buybasket': Failing, 'inspectbasket': Raising}
+    try:
+        num_failed = run.run_lines(['listbaskets', '# nightly rebalance', '', 
+                                    '  rebalanceall   full ', 'unknown 1', 'buybasket 9',
+                                    'inspectbasket 1', 'listbaskets', 'quit', 'listbaskets'])
+    finally:
+        run.command_executables = executables
+    assert executed == ['listbaskets', 'rebalanceall full', 'buybasket 9', 'listbaskets']
+    # The unknown, failed, and raising commands
+    assert num_failed == 3
 
 
 def run_tests():
     test_api_utils_get_account()
     test_api_utils_get_asset()
+    test_api_utils_get_assets()
     test_api_utils_get_position()
     test_api_utils_get_profil2()
     test_api_utils_get_metrics()
     test_api_utils_get_financials_as_reported()
     test_api_utils_get_index_constituents()
     test_api_utils_get_financials()
+    test_api_utils_iter_financials_as_reported_streams_reports()
+    test_async_client_against_local_stub()
+    test_async_client_fails_cut_off_and_slow_calls_like_connection_errors()
+    test_response_cache_ttl_and_lru()
+    test_token_bucket_burst_then_rate()
+    test_call_api_retries_transient_failures()
+    test_call_api_retries_timeouts_within_the_deadline()
+    test_api_calls_are_recorded_per_endpoint()
+    test_tradable_symbols_from_uses_one_asset_list_call()
+    test_tradable_symbols_from_tries_the_asset_list_once_if_it_fails()
+    test_value_quality_fetches_providers_concurrently()
+    test_value_quality_weighting_data_matches_row_by_row_method()
+    test_market_cap_uses_one_bulk_price_call()
+    test_empty_grouped_daily_response_is_not_cached()
+    test_submit_orders_retries_without_duplicating()
+    test_submit_orders_places_sells_before_buys()
+    test_buy_basket_skips_zero_weights_and_stays_inactive_if_no_order_is_placed()
+    test_incremental_weighting_refetches_only_changed_fundamentals()
+    test_incremental_weighting_refetches_past_the_response_cache()
+    test_rebalance_basket_uses_one_positions_snapshot()
+    test_portfolio_nets_orders_across_baskets()
+    test_ledger_tracks_basket_fills_and_sells_by_qty()
+    test_sell_basket_waits_for_open_orders()
+    test_allocate_netted_trades_among_tracked_baskets()
+    test_allocate_trades_in_mixed_tracked_and_untracked_portfolio()
+    test_trade_updates_stream_applies_fills_to_ledger()
+    test_plan_trades_skips_small_drift_and_sells_first()
+    test_financials_store_parses_payload_once()
+    test_financials_store_keeps_the_last_filing_of_each_year()
+    test_financials_store_loads_the_amended_filing_from_the_stream()
+    test_revenue_matcher_rules()
+    test_get_revenues_bulk()
+    test_warehouse_point_in_time_and_numpy_export()
+    test_backtest_equal_weights_drift_between_rebalances()
+    test_backtest_uses_point_in_time_fundamentals()
+    test_cli_arguments_and_command_files()
 
     print('Tests ran successfully')
 